@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Time each stage of pkg-deps on synthetic environments of several sizes.
+
+Results are written as JSON, and can be compared with an earlier run's to
+catch regressions:
+
+    python benchmarks/run.py --output new.json --compare old.json
+"""
+from __future__ import print_function
+import contextlib
+import copy
+import importlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import click
+
+import synthetic
+
+from pkg_deps import annotators
+from pkg_deps import collector
+from pkg_deps import writers
+
+
+@contextlib.contextmanager
+def stdout_to(stream):
+    "Send the writers' output somewhere else."
+    old, sys.stdout = sys.stdout, stream
+    try:
+        yield
+    finally:
+        sys.stdout = old
+
+
+@contextlib.contextmanager
+def quiet_stdout():
+    with open(os.devnull, 'w') as devnull:
+        with stdout_to(devnull):
+            yield
+
+
+def best_time(func, repeat):
+    "Run func repeat times, returning the fastest time in seconds."
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+
+def bench_probe(deps, repeat):
+    "Time the probe script on a site-packages made from deps."
+    directory = tempfile.mkdtemp()
+    old_path = os.environ.get('PYTHONPATH')
+    try:
+        synthetic.make_site_packages(directory, deps)
+        os.environ['PYTHONPATH'] = directory
+        packages = [node.split('==')[0] for node in deps[0]]
+        return best_time(
+            lambda: collector.run_probe(sys.executable, packages), repeat)
+    finally:
+        if old_path is None:
+            del os.environ['PYTHONPATH']
+        else:
+            os.environ['PYTHONPATH'] = old_path
+        shutil.rmtree(directory)
+
+
+def bench_combine(graph, repeat):
+    "Time combine_json_graphs on two copies of the graph."
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = [os.path.join(directory, '%d.json' % num)
+                     for num in range(2)]
+        for filename in filenames:
+            with open(filename, 'w') as out:
+                with stdout_to(out):
+                    writers.json(graph)
+
+        return best_time(
+            lambda: collector.combine_json_graphs(filenames), repeat)
+    finally:
+        shutil.rmtree(directory)
+
+
+def checked_graph(deps):
+    graph, top_nodes = collector.dependencies_to_graph(*copy.deepcopy(deps))
+    annotators.check_dag(graph)
+    annotators.dependencies_should_be_met(graph)
+    return graph, top_nodes
+
+
+def bench_scale(size, fanout, cycle_density, stages, repeat, probe_max):
+    """
+    Time the stages on one synthetic environment.
+
+    Yields (stage, seconds) pairs.
+    """
+    deps = synthetic.make_dependencies(
+        size, fanout=fanout, cycle_density=cycle_density,
+        tops=max(1, size // 100))
+
+    def wanted(stage):
+        return not stages or stage in stages
+
+    if wanted('probe') and size <= probe_max:
+        yield 'probe', bench_probe(deps, repeat)
+
+    if wanted('dependencies_to_graph'):
+        yield 'dependencies_to_graph', best_time(
+            lambda: collector.dependencies_to_graph(*deps), repeat)
+
+    if wanted('dependencies_to_graph.compact'):
+        yield 'dependencies_to_graph.compact', best_time(
+            lambda: collector.dependencies_to_graph(*deps, compact=True),
+            repeat)
+
+    # Annotators that change the graph get a fresh copy each time, which
+    # isn't counted.
+    annotator_stages = [
+        ('check_dag', annotators.check_dag),
+        ('check_dag.compact', annotators.check_dag),
+        ('dependencies_should_be_met', annotators.dependencies_should_be_met),
+        ('dependencies_should_be_met.compact',
+         annotators.dependencies_should_be_met),
+        ('should_pin_precisely',
+         lambda graph: annotators.should_pin_precisely(
+             graph, graph.graph['query packages'])),
+        ('should_pin_all',
+         lambda graph: annotators.should_pin_all(
+             graph, graph.graph['query packages'])),
+    ]
+    for stage, annotate in annotator_stages:
+        if wanted(stage):
+            times = []
+            for i in range(repeat):
+                graph, top_nodes = collector.dependencies_to_graph(
+                    *copy.deepcopy(deps),
+                    compact=stage.endswith('.compact'))
+                times.append(best_time(lambda: annotate(graph), 1))
+            yield stage, min(times)
+
+    graph, top_nodes = checked_graph(deps)
+
+    if wanted('combine_json_graphs'):
+        yield 'combine_json_graphs', bench_combine(graph, repeat)
+
+    for writer in ['human', 'dot', 'json', 'teamcity']:
+        stage = 'writers.' + writer
+        if not wanted(stage):
+            continue
+        if writer == 'teamcity' and not available('teamcity.messages'):
+            continue
+
+        def write():
+            with quiet_stdout():
+                getattr(writers, writer)(graph)
+
+        yield stage, best_time(write, repeat)
+
+
+def available(module):
+    "Can module be imported?"
+    try:
+        importlib.import_module(module)
+    except ImportError:
+        return False
+    return True
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_results, new_results, threshold):
+    "Print stages that got slower; return whether any did."
+    old = dict(((r['scale'], r['stage']), r['seconds'])
+               for r in old_results['results'])
+
+    slower = False
+    for result in new_results['results']:
+        before = old.get((result['scale'], result['stage']))
+        if not before:
+            continue
+
+        ratio = result['seconds'] / before
+        if ratio > threshold:
+            slower = True
+            print("SLOWER: %s at %d nodes: %.4fs -> %.4fs (x%.2f)" % (
+                result['stage'], result['scale'], before,
+                result['seconds'], ratio))
+
+    return slower
+
+
+@click.command()
+@click.option('--scales', default='100,1000,10000,50000',
+              help="Comma-separated numbers of packages to try.")
+@click.option('--fanout', type=int, default=3,
+              help="Average number of requirements per package.")
+@click.option('--cycle-density', type=float, default=0.01,
+              help="Fraction of packages that close a dependency cycle.")
+@click.option('--stage', 'stages', multiple=True,
+              help="Only time this stage (can be repeated).")
+@click.option('--repeat', type=int, default=3,
+              help="Time each stage this many times and keep the fastest.")
+@click.option('--probe-max', type=int, default=10000,
+              help="Skip the probe stage for bigger environments.")
+@click.option('--output', '-o', type=click.Path(), default='bench.json',
+              help="Where to write the results.")
+@click.option('--compare', 'compare_to', type=click.File('r'), default=None,
+              help="Compare with results from an earlier run, and exit with"
+              " an error if anything is slower by more than --threshold.")
+@click.option('--threshold', type=float, default=1.25,
+              help="Ratio of new to old time that counts as slower.")
+def main(scales, fanout, cycle_density, stages, repeat, probe_max, output,
+         compare_to, threshold):
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'fanout': fanout,
+        'cycle_density': cycle_density,
+        'results': [],
+    }
+
+    for size in [int(scale) for scale in scales.split(',')]:
+        for stage, seconds in bench_scale(size, fanout, cycle_density,
+                                          stages, repeat, probe_max):
+            print("%8d  %-36s %9.4fs" % (size, stage, seconds))
+            results['results'].append(
+                {'scale': size, 'stage': stage, 'seconds': seconds})
+
+    with open(output, 'w') as out:
+        json.dump(results, out, indent=2)
+
+    if compare_to and compare(json.load(compare_to), results, threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
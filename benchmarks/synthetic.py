@@ -0,0 +1,79 @@
+"""
+Generate synthetic dependency data for benchmarks.
+
+Everything is deterministic for a given seed, so results from different
+commits are comparable.
+"""
+import os
+import random
+
+
+def package_name(num):
+    return 'pkg%05d' % num
+
+
+def make_dependencies(size, fanout=3, cycle_density=0.01, unmet=0.01,
+                      tops=1, seed=0):
+    """
+    Make probe-style (top_nodes, nodes, edges) for a synthetic environment.
+
+    Parameters:
+        size - number of packages.
+        fanout - average number of requirements per package.  Package N
+            only requires packages numbered higher than N, so the graph is
+            a DAG apart from the cycles added below.
+        cycle_density - fraction of packages that also require a
+            lower-numbered package, closing a cycle.
+        unmet - fraction of requirements that the installed version
+            doesn't satisfy.
+        tops - how many of the first packages are top-level packages.
+        seed - for the random number generator.
+    """
+    rng = random.Random(seed)
+    nodes = ['%s==1.0' % package_name(num) for num in range(size)]
+    edges = set()
+
+    def requirement(num):
+        kind = rng.random()
+        if kind < unmet:
+            spec = '>1.0'
+        elif kind < 0.5:
+            spec = '>=1.0'
+        elif kind < 0.8:
+            spec = '==1.0'
+        else:
+            spec = ''
+        return package_name(num) + spec
+
+    for num in range(size - 1):
+        count = min(size - num - 1, rng.randint(0, 2 * fanout))
+        for dep in rng.sample(range(num + 1, size), count):
+            edges.add((nodes[num], requirement(dep), nodes[dep]))
+
+        if num and rng.random() < cycle_density:
+            dep = rng.randrange(num)
+            edges.add((nodes[num], requirement(dep), nodes[dep]))
+
+    return (nodes[:tops], nodes, sorted(edges))
+
+
+def make_site_packages(directory, deps):
+    """
+    Write a *.dist-info directory for each package, so the probe can run.
+    """
+    top_nodes, nodes, edges = deps
+    requires = dict((node, []) for node in nodes)
+    for source, req, target in edges:
+        requires[source].append(req)
+
+    for node, reqs in requires.items():
+        name, version = node.split('==')
+        dist_info = os.path.join(
+            directory, '%s-%s.dist-info' % (name, version))
+        os.mkdir(dist_info)
+        with open(os.path.join(dist_info, 'METADATA'), 'w') as metadata:
+            metadata.write('Metadata-Version: 2.1\n')
+            metadata.write('Name: %s\n' % name)
+            metadata.write('Version: %s\n' % version)
+            for req in sorted(reqs):
+                metadata.write('Requires-Dist: %s\n' % req)
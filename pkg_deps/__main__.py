@@ -0,0 +1,3 @@
+from pkg_deps.main import main
+
+main(prog_name='pkg-deps')
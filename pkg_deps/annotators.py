@@ -1,10 +1,11 @@
+import itertools
 import logging
-from pkg_resources import Requirement
 import re
 import subprocess
 
-import networkx as nx
-
+from pkg_deps.compact import CompactGraph
+from pkg_deps.index import node_index, split_node
+from pkg_deps import requirements
 
 logger = logging.getLogger(__name__)
 
@@ -13,20 +14,12 @@ str_types = (type(u''), type(b''))
 
 
 def find_matching_node(graph, requirement):
-    # Could certainly make this faster, but maybe that's not important?
-    # First off, cache parsed versions of all the nodes in the graph...
-
-    orig = requirement
-
-    if type(requirement) in str_types:
-        requirement = Requirement.parse(requirement)
+    node = node_index(graph).find(requirements.parse(requirement))
+    if node is None:
+        raise ValueError("Couldn't find any packages matching %s" %
+                         requirement)
 
-    for n in graph:
-        (name, ver) = n.split('==')
-        if requirement.key == name.lower() and ver in requirement:
-            return n
-
-    raise ValueError("Couldn't find any packages matching %s" % orig)
+    return node
 
 
 def mark_check_failed(obj, check_name, message=''):
@@ -34,28 +27,62 @@ def mark_check_failed(obj, check_name, message=''):
     fails[check_name] = message
 
 
+def clear_check(obj, check_name):
+    fails = obj.get('failed_checks', {})
+    fails.pop(check_name, None)
+    if not fails:
+        obj.pop('failed_checks', None)
+
+
+def forget_check(graph, check_name):
+    "Clear a check's failures everywhere, and unmark it as run."
+    for node, data in graph.nodes_iter(data=True):
+        clear_check(data, check_name)
+    for source, dest, data in graph.edges_iter(data=True):
+        clear_check(data, check_name)
+
+    checks = graph_checks(graph)
+    if check_name in checks:
+        checks.remove(check_name)
+
+
 def failed_checks(obj):
     return obj.get('failed_checks', {})
 
 
+def any_failed(graph):
+    "Is any check failed anywhere in the graph?"
+    return (any(failed_checks(data) for n, data in graph.nodes_iter(data=True))
+            or any(failed_checks(data)
+                   for s, d, data in graph.edges_iter(data=True)))
+
+
 def mark_graph_checked(graph, check_name):
-    graph.graph.setdefault('checks', []).append(check_name)
+    checks = graph.graph.setdefault('checks', [])
+    if check_name not in checks:
+        checks.append(check_name)
 
 
 def graph_checks(graph):
     return graph.graph.get('checks', [])
 
 
-def dependencies_should_be_met(graph):
+def dependencies_should_be_met(graph, nodes=None):
+    """
+    Annotate requirements that the installed packages don't satisfy.
+
+    If nodes is given, only their outgoing edges are checked.
+    """
+    if isinstance(graph, CompactGraph):
+        return _compact_dependencies_should_be_met(graph, nodes)
+
     bad = False
 
-    for source, dest, data in graph.edges_iter(data=True):
-        requirement = data['requirement']
-        if type(requirement) in str_types:
-            requirement = Requirement.parse(requirement)
+    for source, dest, data in graph.edges_iter(nodes, data=True):
+        requirement = requirements.parse(data['requirement'])
 
-        name, ver = dest.split('==')
-        if ver not in requirement:
+        clear_check(data, 'unmet')
+        if not _satisfied(requirement, dest):
             mark_check_failed(data, 'unmet',
                               '%s is not installed' % data['requirement'])
             bad = True
@@ -64,18 +91,58 @@ def dependencies_should_be_met(graph):
     return bad
 
 
-def add_available_updates(graph):
+def _compact_dependencies_should_be_met(graph, nodes):
+    bad = False
+
+    ids = range(len(graph)) if nodes is None else \
+        [graph.ids[node] for node in nodes]
+    for source in ids:
+        for pos in range(graph.offsets[source], graph.offsets[source + 1]):
+            record = graph.edge_records[pos]
+            if record.attrs:
+                clear_check(record.attrs, 'unmet')
+
+            requirement = requirements.parse(record.requirement)
+            dest = graph.keys[graph.targets[pos]]
+            if not _satisfied(requirement, dest):
+                mark_check_failed(record.data(), 'unmet',
+                                  '%s is not installed' % record.requirement)
+                bad = True
+
+    mark_graph_checked(graph, 'unmet')
+    return bad
+
+
+def _satisfied(requirement, node):
+    # A node without a version is a package that isn't installed at all
+    version = split_node(node)[1]
+    return bool(version) and requirement.satisfied_by(version)
+
+
+def add_available_updates(graph, nodes=None, latest=None, index=None):
     """
     Add outdated package info to a dependency graph.
 
     Parameters:
         graph - a networkx.DiGraph to which info is added.
-
-    This function runs and parses ``pip list --outdated``.  For
-    each package that pip thinks is outdated, a 'latest' attribute
-    is added to its node in the graph, with the latest available
-    version as the value.
+        nodes - optional collection of nodes; only these are annotated.
+        latest - optional dict of canonical project name to latest
+            version, from ``snapshot.load_latest_versions``.
+        index - optional index_client.IndexClient, to look up the
+            latest versions of just these nodes on a package index.
+
+    Without latest or index, this function runs and parses
+    ``pip list --outdated``.  For each package that is outdated, an
+    'outdated' check failure is added to its node in the graph, with the
+    latest available version in the message.
     """
+    if index is not None:
+        latest = index.latest_versions(
+            split_node(node)[0] for node in
+            (graph if nodes is None else nodes))
+    if latest is not None:
+        return _add_updates_from(graph, nodes, latest)
+
     bad = False  # found anything bad yet?
 
     # It might be possible to do this with
@@ -87,6 +154,9 @@ def add_available_updates(graph):
     # default encoding.. hopefully what pip also used?
     outdated = outdated_b.decode()
 
+    for node in graph if nodes is None else nodes:
+        clear_check(graph.node[node], 'outdated')
+
     # Example: six (Current: 1.6.1 Latest: 1.9.0)
     line_re = re.compile(r'^([^ ]+) \(Current: ([^ ]+) Latest: ([^)]+)\)$')
 
@@ -107,6 +177,9 @@ def add_available_updates(graph):
                         name)
             continue
 
+        if nodes is not None and node not in nodes:
+            continue
+
         mark_check_failed(graph.node[node], 'outdated',
                           message='latest is %s' % latest)
         bad = True
@@ -116,22 +189,113 @@ def add_available_updates(graph):
     return bad
 
 
-def check_dag(graph):
-    "Make sure the dependency graph is acyclic."
+def _add_updates_from(graph, nodes, latest):
+    from pkg_deps.snapshot import canonical_name
 
-    cycles = list(nx.simple_cycles(graph))
+    index = node_index(graph)
+    bad = False
+    for node in graph if nodes is None else nodes:
+        clear_check(graph.node[node], 'outdated')
+
+        version = latest.get(canonical_name(split_node(node)[0]))
+        installed = index.version(node)
+        if version and installed is not None and \
+                requirements.parse_version(version) > installed:
+            mark_check_failed(graph.node[node], 'outdated',
+                              message='latest is %s' % version)
+            bad = True
+
+    mark_graph_checked(graph, 'outdated')
 
-    if cycles:
+    return bad
+
+
+def check_dag(graph, max_cycles=None):
+    """
+    Make sure the dependency graph is acyclic.
+
+    Every edge inside a strongly connected component (or a self-loop) lies
+    on some cycle, so those edges get the check "cyclic dependency" without
+    enumerating the cycles themselves, which can take exponential time.
+
+    If max_cycles is given, up to that many example cycles from each
+    component are also listed, as lists of nodes, in the graph attribute
+    'cycles' for the writers to show.
+    """
+    if isinstance(graph, CompactGraph):
+        return _check_compact_dag(graph, max_cycles)
+
+    import networkx as nx
+
+    bad = False
+    examples = []
+
+    for src, dest, data in graph.edges_iter(data=True):
+        clear_check(data, 'cyclic dependency')
+
+    for component in nx.strongly_connected_components(graph):
+        if len(component) == 1:
+            node, = component
+            if not graph.has_edge(node, node):
+                continue
+
+        bad = True
+        for src in component:
+            for dest, data in graph[src].items():
+                if dest in component:
+                    mark_check_failed(data, 'cyclic dependency')
+
+        if max_cycles:
+            examples.extend(itertools.islice(
+                nx.simple_cycles(graph.subgraph(component)), max_cycles))
+
+    if bad:
+        logger.warning("There are circular dependencies!")
+
+    if max_cycles:
+        graph.graph['cycles'] = examples
+
+    mark_graph_checked(graph, 'cyclic dependency')
+    return bad
+
+
+def _check_compact_dag(graph, max_cycles):
+    bad = False
+    examples = []
+
+    for record in graph.edge_records:
+        if record.attrs:
+            clear_check(record.attrs, 'cyclic dependency')
+
+    for component in graph.strongly_connected_components():
+        members = set(component)
+        if len(members) == 1 and component[0] not in \
+                graph.successors(component[0]):
+            continue
+
+        bad = True
+        cycle_edges = []
+        for src in component:
+            for pos in range(graph.offsets[src], graph.offsets[src + 1]):
+                if graph.targets[pos] in members:
+                    mark_check_failed(graph.edge_records[pos].data(),
+                                      'cyclic dependency')
+                    cycle_edges.append((graph.keys[src],
+                                        graph.keys[graph.targets[pos]]))
+
+        if max_cycles:
+            import networkx as nx
+            examples.extend(itertools.islice(
+                nx.simple_cycles(nx.DiGraph(cycle_edges)), max_cycles))
+
+    if bad:
         logger.warning("There are circular dependencies!")
 
-    for nodelist in cycles:
-        for i in range(len(nodelist)):
-            # -1 = index of last element in nodelist
-            mark_check_failed(graph[nodelist[i - 1]][nodelist[i]],
-                              'cyclic dependency')
+    if max_cycles:
+        graph.graph['cycles'] = examples
 
     mark_graph_checked(graph, 'cyclic dependency')
-    return bool(cycles)
+    return bad
 
 
 def should_pin_precisely(graph, top_packages):
@@ -142,7 +306,7 @@ def should_pin_precisely(graph, top_packages):
     """
     bad = False
     for src, dest, data in graph.out_edges(top_packages, data=True):
-        if '==' not in data['requirement']:
+        if not requirements.is_pinned(data['requirement']):
             mark_check_failed(data, 'not precise', data['requirement'])
             bad = True
 
@@ -159,13 +323,18 @@ def should_pin_all(graph, top_packages):
     check "missing pin" failed on it.
 
     This actually looks at *all* descendants, including ones more than two
-    "generations" away.
+    "generations" away.  Edges added by an earlier run are replaced.
     """
     bad = False
 
+    for src, dest, data in graph.out_edges(top_packages, data=True):
+        if 'missing pin' in failed_checks(data):
+            graph.remove_edge(src, dest)
+
+    descendants = descendant_sets(graph, top_packages)
     for package in top_packages:
         direct = set(dest for src, dest in graph.out_edges([package]))
-        for dest in nx.descendants(graph, package):
+        for dest in descendants[package]:
             if dest not in direct:
                 bad = True
                 node_data = graph.node[dest]
@@ -180,3 +349,74 @@ def should_pin_all(graph, top_packages):
 
     mark_graph_checked(graph, 'missing pin')
     return bad
+
+
+def descendant_sets(graph, sources):
+    """
+    Find the descendants of several nodes at once.
+
+    Returns a dict mapping each source to the same set networkx.descendants
+    would give.  Instead of walking the graph from each source separately,
+    the strongly connected components reachable from any source are visited
+    once, sinks first, building up what each one can reach as a bitset (a
+    Python int, one bit per node) that its predecessors then share.
+    """
+    sources = list(sources)
+    structure = CompactGraph.from_networkx(graph, data=False)
+    source_ids = [structure.ids[source] for source in sources]
+
+    # Tarjan's algorithm finds components sinks first, which is the order
+    # we need.  Bits are numbered in the same order, so a component's
+    # descendants all have lower bits than its own members, which keeps
+    # the ints short.
+    components = list(structure.strongly_connected_components(source_ids))
+    comp_of = [-1] * len(structure)
+    order = []  # node ids by bit number
+    member_bits = []
+    for idx, comp in enumerate(components):
+        for node in comp:
+            comp_of[node] = idx
+        member_bits.append(((1 << len(comp)) - 1) << len(order))
+        order.extend(comp)
+
+    # How many edges from other components still need each one's reach
+    remaining = [0] * len(components)
+    for node in order:
+        for succ in structure.successors(node):
+            if comp_of[succ] != comp_of[node]:
+                remaining[comp_of[succ]] += 1
+
+    kept = set(comp_of[source] for source in source_ids)
+    reach = {}
+    for idx, comp in enumerate(components):
+        bits = 0
+        for node in comp:
+            for succ in structure.successors(node):
+                succ_idx = comp_of[succ]
+                if succ_idx != idx:
+                    bits |= member_bits[succ_idx] | reach[succ_idx]
+                    remaining[succ_idx] -= 1
+                    if not remaining[succ_idx] and succ_idx not in kept:
+                        # Nothing else needs it, so free the memory
+                        del reach[succ_idx]
+        reach[idx] = bits
+
+    keys = [structure.keys[node] for node in order]
+    position = dict((node, pos) for pos, node in enumerate(order))
+    result = {}
+    for source, source_id in zip(sources, source_ids):
+        comp = comp_of[source_id]
+        bits = reach[comp]
+        if len(components[comp]) > 1:
+            # The rest of its cycle
+            bits |= member_bits[comp] & ~(1 << position[source_id])
+        result[source] = set(_bit_members(bits, keys))
+
+    return result
+
+
+def _bit_members(bits, nodes):
+    # Going through the binary string is much faster than shifting and
+    # masking a long int one bit at a time
+    digits = bin(bits)[:1:-1]
+    return [nodes[pos] for pos, digit in enumerate(digits) if digit == '1']
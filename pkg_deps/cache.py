@@ -0,0 +1,194 @@
+"""
+Small on-disk caches, used to avoid redoing work between runs.
+
+DiskCache stores values as JSON files named by their key, in a directory
+that's kept under a size limit by evicting the least recently used entries;
+it's for big values, like probe results.  JSONFileCache keeps many small
+values together in one JSON file.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+
+DEFAULT_MAX_ENTRIES = 50000
+
+# Bump this when the format of cached probe results changes
+PROBE_FORMAT = 1
+
+
+def default_cache_dir():
+    "$PKG_DEPS_CACHE_DIR, or pkg-deps in the user's cache directory."
+    if os.environ.get('PKG_DEPS_CACHE_DIR'):
+        return os.environ['PKG_DEPS_CACHE_DIR']
+
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pkg-deps')
+
+
+def make_key(*parts):
+    "Hash some JSON-serializable values into a cache key."
+    data = json.dumps(parts, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def probe_key(python, packages, stamps):
+    """
+    Key for a probe result.
+
+    Parameters:
+        python - path to the interpreter that was probed.
+        packages - the package names that were asked for.
+        stamps - the environment's metadata stamps, from
+            ``probe.metadata_stamps``; any installed, removed, or changed
+            distribution gives a different key.
+    """
+    return make_key(PROBE_FORMAT, os.path.abspath(python), list(packages),
+                    sorted(stamps.items()))
+
+
+class DiskCache(object):
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        "Return the value stored under key, or None."
+        path = self._path(key)
+        try:
+            with open(path, 'r') as cached:
+                value = json.load(cached)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # Reading counts as a use, for eviction purposes
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        logger.debug("Cache hit: %s", path)
+        return value
+
+    def put(self, key, value):
+        "Store a JSON-serializable value, evicting old entries if needed."
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            # Write then rename, so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            suffix='.tmp')
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump(value, tmp)
+            os.rename(tmp_path, self._path(key))
+        except (IOError, OSError) as exc:
+            logger.warning("Couldn't write to cache %s: %s",
+                           self.directory, exc)
+            return
+
+        self.evict()
+
+    def evict(self):
+        "Remove least recently used entries until under max_bytes."
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        while entries and total > self.max_bytes:
+            mtime, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class JSONFileCache(object):
+    """
+    Many small values, saved in one JSON file between runs.
+
+    Unlike DiskCache, which keeps a file per entry, this is read once, and
+    written once by save() if anything was added.  The entries used least
+    recently are dropped to keep it under max_entries.  Using an entry
+    isn't reason enough to save the file, so when an entry was last used
+    is only brought up to date when something else changes.
+    """
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = None
+        self._run = 0
+        self._changed = False
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as saved:
+                data = json.load(saved)
+            self._entries = data['entries']
+            self._run = data['run'] + 1
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            self._entries = {}
+
+    def get(self, key):
+        "Return the value stored under key, or None."
+        if self._entries is None:
+            self._load()
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        entry[0] = self._run
+        return entry[1]
+
+    def put(self, key, value):
+        "Store a JSON-serializable value, to be written by save()."
+        if self._entries is None:
+            self._load()
+        self._entries[key] = [self._run, value]
+        self._changed = True
+
+    def save(self):
+        "Write the cache out, if anything changed."
+        if not self._changed:
+            return
+
+        entries = self._entries
+        if len(entries) > self.max_entries:
+            keep = sorted(entries, key=lambda key: entries[key][0])
+            entries = dict((key, entries[key])
+                           for key in keep[-self.max_entries:])
+
+        directory = os.path.dirname(self.path) or '.'
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump({'run': self._run, 'entries': entries}, tmp)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as exc:
+            logger.warning("Couldn't write cache %s: %s", self.path, exc)
+            return
+        self._changed = False
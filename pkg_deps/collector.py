@@ -6,20 +6,33 @@ installed the packages you're insterested in.  In particular, you must
 also install the top-level package (Django project, for example).
 """
 import ast
+import gzip
+import io
 import json
 import logging
 import subprocess
+import sys
+import threading
 
-import networkx as nx
-from networkx.readwrite.json_graph import node_link
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
 
+from pkg_deps import cache as _cache
+from pkg_deps import jsonstream
 from pkg_deps import probe
+from pkg_deps import requirements
+from pkg_deps.annotators import failed_checks
+from pkg_deps.compact import CompactGraph
+from pkg_deps.index import add_node, invalidate, remove_node, split_node
 
 
 logger = logging.getLogger(__name__)
 
 
-def collect_dependencies_here(packages, graph=None):
+def collect_dependencies_here(packages, graph=None, cache=None,
+                              compact=False):
     """
     Consult setuptools for dependencies of a package, returning  a graph.
 
@@ -28,6 +41,10 @@ def collect_dependencies_here(packages, graph=None):
             the dependency tree.
         graph - optional networkx.DiGraph to update, otherwise a new
             one is created.
+        cache - optional cache.DiskCache; if the environment hasn't changed
+            since the same packages were last probed, the saved result is
+            used instead.
+        compact - make a compact.CompactGraph instead (and ignore graph).
 
     Returns:
         A networkx.DiGraph with nodes and edges representing the dependencies
@@ -38,19 +55,247 @@ def collect_dependencies_here(packages, graph=None):
         information).  The edges have an attribute ``requirement`` that is the
         canonical form of the exact requirement one package used to depend on
         another.  "Canonical" means that, for example, version numbers are
-        sorted: 'Django<1.7,>=1.6' becomes 'Django>=1.6,<1.7'.
+        sorted: 'Django<1.7,>=1.6' becomes 'Django>=1.6,<1.7'.  Nodes also
+        have a ``stamp`` attribute, from ``probe.metadata_stamps``, that
+        update_graph uses to tell which ones are out of date.
 
     See also:
         networkx.relabel_nodes
     """
-    return dependencies_to_graph(
-        *probe.find_dependencies(packages),
-        graph=graph)
+    return collect_dependencies_with(LocalProbe(), packages, graph=graph,
+                                     cache=cache, compact=compact)
 
 
-def collect_dependencies_elsewhere(python, packages, graph=None):
-    deps = run_probe(python, packages)
-    return dependencies_to_graph(*deps, graph=graph)
+def collect_dependencies_elsewhere(python, packages, graph=None, cache=None,
+                                   timeout=None, compact=False):
+    return collect_dependencies_with(ScriptProbe(python, timeout), packages,
+                                     graph=graph, cache=cache,
+                                     compact=compact)
+
+
+def collect_dependencies_with(prober, packages, graph=None, cache=None,
+                              compact=False):
+    """
+    Like collect_dependencies_here, but using any kind of probe.
+
+    prober is a LocalProbe, ScriptProbe or ProbeServer.
+    """
+    if cache is None:
+        deps, stamps = prober.stamped_dependencies(packages)
+    else:
+        # The stamps are needed first, for the cache key
+        stamps = prober.stamps()
+        deps = _cached_probe(
+            cache, prober.python, packages, stamps,
+            lambda: prober.find_dependencies(packages))
+    return dependencies_to_graph(*deps, graph=graph, stamps=stamps,
+                                 compact=compact)
+
+
+def collect_dependencies_from_lock(requirements_file, wheelhouse, packages,
+                                   graph=None, verify_hashes=False,
+                                   metadata_cache=None, compact=False):
+    """
+    Find dependencies from a lock file instead of an environment.
+
+    Parameters:
+        requirements_file - a requirements file with every package pinned.
+        wheelhouse - a directory with the pinned packages' wheels or sdists.
+        packages - the names of the top-level packages, which must be in
+            the lock file.
+        graph - optional networkx.DiGraph to update.
+        verify_hashes - check the archives against the lock file's hashes.
+        metadata_cache - optional cache.JSONFileCache.
+        compact - make a compact.CompactGraph instead (and ignore graph).
+
+    Returns the same as collect_dependencies_here, without stamps.
+    """
+    from pkg_deps import lockfile
+
+    deps = lockfile.find_dependencies(requirements_file, wheelhouse, packages,
+                                      verify_hashes=verify_hashes,
+                                      metadata_cache=metadata_cache)
+    return dependencies_to_graph(*deps, graph=graph, compact=compact)
+
+
+def collect_dependencies_many(pythons, packages, cache=None, jobs=None,
+                              timeout=None):
+    """
+    Probe several Python installations at once.
+
+    Parameters:
+        pythons - paths to the python executables.
+        packages - the names of the packages to look for in each one.
+        cache - optional cache.DiskCache.
+        jobs - how many probes to run at a time (default: one per CPU,
+            or fewer if there are fewer pythons).
+        timeout - optional number of seconds each probe may take.
+
+    Returns:
+        A list of (graph, top_nodes), one per python, in order.  Each
+        graph and its nodes have an ``environments`` attribute listing the
+        python it came from, so the graphs can be merged with
+        combine_graphs and still be told apart.
+    """
+    def collect(python):
+        graph, top_nodes = collect_dependencies_elsewhere(
+            python, packages, cache=cache, timeout=timeout)
+
+        graph.graph['environments'] = [python]
+        for node, data in graph.nodes_iter(data=True):
+            data['environments'] = [python]
+        return graph, top_nodes
+
+    # The work happens in the probe subprocesses, so threads are plenty
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(jobs or _default_jobs(len(pythons)))
+    try:
+        return pool.map(collect, pythons)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _default_jobs(count):
+    "How many of count probes to run at once: at most one per CPU."
+    import multiprocessing
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    return max(1, min(count, cpus))
+
+
+def update_dependencies_here(graph, packages):
+    """
+    Bring a graph from an earlier run up to date with this environment.
+
+    See update_graph.
+    """
+    return update_dependencies_with(LocalProbe(), graph, packages)
+
+
+def update_dependencies_elsewhere(python, graph, packages):
+    """
+    Bring a graph from an earlier run up to date with another environment.
+
+    See update_graph.
+    """
+    return update_dependencies_with(ScriptProbe(python), graph, packages)
+
+
+def update_dependencies_with(prober, graph, packages):
+    "Like update_dependencies_here, but using any kind of probe."
+    return update_graph(graph, packages, prober.stamps(),
+                        prober.find_dependencies)
+
+
+class LocalProbe(object):
+    "Look up dependencies in this Python."
+    def __init__(self):
+        self.python = sys.executable
+        self.prober = probe.Prober()
+
+    def stamps(self):
+        return probe.metadata_stamps()
+
+    def find_dependencies(self, packages, known=()):
+        return self.prober.find_dependencies(packages, known)
+
+    def stamped_dependencies(self, packages):
+        "(find_dependencies(packages), the stamps from before that)"
+        stamps = self.stamps()
+        return self.find_dependencies(packages), stamps
+
+
+class ScriptProbe(object):
+    "Look up dependencies by running the probe script with another Python."
+    def __init__(self, python, timeout=None):
+        self.python = python
+        self.timeout = timeout
+
+    def stamps(self):
+        return run_probe(self.python, ['--stamps'], timeout=self.timeout)
+
+    def find_dependencies(self, packages, known=()):
+        if not known:
+            return run_probe(self.python, packages, timeout=self.timeout)
+
+        return run_probe(self.python, ['--known'] + list(packages),
+                         input_lines=known, timeout=self.timeout)
+
+    def stamped_dependencies(self, packages):
+        "Like LocalProbe.stamped_dependencies, with one run of the probe."
+        return run_probe(self.python, ['--stamped'] + list(packages),
+                         timeout=self.timeout)
+
+
+class ProbeServer(object):
+    """
+    A long-running probe in another Python, for answering repeated queries.
+
+    It keeps what it has looked up until the environment's metadata changes,
+    so repeat queries don't pay for starting Python or re-reading metadata.
+    Use it as a context manager, or call close() when done.
+    """
+    def __init__(self, python):
+        self.python = python
+        self.proc = subprocess.Popen(
+            [python, _not_pyc(probe.__file__), '--serve'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, request):
+        self.proc.stdin.write(json.dumps(request).encode('ascii') + b'\n')
+        self.proc.stdin.flush()
+
+        lines = iter(self.proc.stdout.readline, b'')
+        try:
+            header = json.loads(next(lines, b'').decode('ascii'))
+            return probe.read_wire(header, lines)
+        except ValueError:
+            raise RuntimeError("Problem talking to probe server with %s"
+                               % self.python)
+
+    def stamps(self):
+        return self._request({'stamps': True})
+
+    def find_dependencies(self, packages, known=()):
+        return self._request({'packages': list(packages),
+                              'known': list(known)})
+
+    def stamped_dependencies(self, packages):
+        "Same as LocalProbe.stamped_dependencies."
+        stamps = self.stamps()
+        return self.find_dependencies(packages), stamps
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+        self.proc.stdout.close()
+
+
+def _cached_probe(cache, python, packages, stamps, find_dependencies):
+    "Look up probe results in the cache, or find and store them."
+    if cache is None:
+        return find_dependencies()
+
+    key = _cache.probe_key(python, packages, stamps)
+    deps = cache.get(key)
+    if deps is None:
+        deps = find_dependencies()
+        cache.put(key, deps)
+
+    return deps
 
 
 def _not_pyc(path):
@@ -58,66 +303,447 @@ def _not_pyc(path):
     return path.rstrip('c')
 
 
-def run_probe(python, packages):
+def run_probe(python, packages, input_lines=None, timeout=None):
     # Could do this, would maybe be zip-safe, but it's annoying for debugging.
-    #probe_stream = pkg_resources.resource_stream('pkg_deps', 'probe.py')
+    # probe_stream = pkg_resources.resource_stream('pkg_deps', 'probe.py')
     # And then stdin=probe_stream.
 
     proc = subprocess.Popen(
         [python, _not_pyc(probe.__file__)] + list(packages),
+        stdin=subprocess.PIPE if input_lines is not None else None,
         stdout=subprocess.PIPE,
     )
 
-    output = proc.communicate()[0]
-
-    if proc.wait() != 0:
+    timer = None
+    timed_out = []
+    if timeout is not None:
+        def kill():
+            timed_out.append(True)
+            proc.kill()
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+
+    try:
+        if input_lines is not None:
+            # The probe reads all of this before writing anything
+            proc.stdin.write(b''.join(line.encode('utf-8') + b'\n'
+                                      for line in input_lines))
+            proc.stdin.close()
+
+        result = read_probe_output(proc.stdout)
+    except ValueError:
+        result = None
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+        if timer is not None:
+            timer.cancel()
+
+    if timed_out:
+        raise RuntimeError("Probe with %s took more than %s seconds"
+                           % (python, timeout))
+    if returncode != 0 or result is None:
         raise RuntimeError("Problem executing probe with %s" % python)
 
-    return ast.literal_eval(output.decode())  # default encoding...
+    return result
 
 
-def dependencies_to_graph(top_nodes, nodes, edges, graph=None):
-    if not graph:
+def read_probe_output(stream):
+    """
+    Parse what the probe script wrote, as it's being written.
+
+    Older copies of the probe wrote a single pprint'ed Python literal
+    instead of the newline-delimited JSON described in probe.py; that's
+    still understood.
+    """
+    lines = iter(stream.readline, b'')
+    first = next(lines, b'')
+    try:
+        header = json.loads(first.decode('ascii'))
+    except ValueError:
+        header = None
+
+    if not isinstance(header, dict):
+        # Old format
+        output = (first + b''.join(lines)).decode()  # default encoding...
+        try:
+            return ast.literal_eval(output)
+        except SyntaxError:
+            raise ValueError("Couldn't parse probe output: %r" % output)
+
+    return probe.read_wire(header, lines)
+
+
+def dependencies_to_graph(top_nodes, nodes, edges, graph=None, stamps=None,
+                          compact=False):
+    """
+    Build a graph from probe output.
+
+    With compact, a compact.CompactGraph is returned instead of a
+    networkx.DiGraph; it takes much less memory, and check_dag,
+    dependencies_should_be_met and the writers all accept it.
+    """
+    if compact:
+        return (CompactGraph.from_dependencies(top_nodes, nodes, edges,
+                                               stamps),
+                top_nodes)
+
+    if graph is None:
+        import networkx as nx
         graph = nx.DiGraph()
 
+    _add_dependencies(graph, nodes, edges, stamps)
+
+    graph.graph.setdefault('query packages', []).extend(top_nodes)
+    return (graph, top_nodes)
+
+
+def _add_dependencies(graph, nodes, edges, stamps):
     for node in nodes:
         if node not in graph:
-            graph.add_node(node, as_requirement=node)
+            add_node(graph, node, as_requirement=node)
+            if stamps is not None:
+                graph.node[node]['stamp'] = stamps.get(_node_key(node))
 
     for source, requirement, target in edges:
+        # Parse it now, so the checks only have to look it up
+        requirements.parse(requirement)
         graph.add_edge(
             source,
             target,
             requirement=requirement)
 
-    graph.graph.setdefault('query packages', []).extend(top_nodes)
-    return (graph, top_nodes)
 
+def _node_key(node):
+    return probe.project_key(split_node(node)[0])
 
-def combine_json_graphs(filenames):
-    if not filenames:
-        return nx.DiGraph()
 
-    graphs = []
-    for fn in filenames:
-        with open(fn, 'r') as json_file:
-            graph_data = json.load(json_file)
-            graphs.append(node_link.node_link_graph(graph_data))
-    composed = nx.compose_all(graphs)
+def stale_nodes(graph, stamps):
+    """
+    The nodes whose distributions have changed since they were added.
+
+    Nodes without a version stand for packages that weren't installed (see
+    update_graph); they're stale once the package is installed.
+    """
+    stale = set()
+    for node, data in graph.nodes_iter(data=True):
+        name, version = split_node(node)
+        stamp = stamps.get(probe.project_key(name))
+        if not version:
+            if stamp is not None:
+                stale.add(node)
+        elif data.get('stamp') is None or data['stamp'] != stamp:
+            stale.add(node)
+    return stale
+
+
+def update_graph(graph, packages, stamps, find_dependencies):
+    """
+    Patch a dependency graph in place to match an environment's metadata.
+
+    Only distributions whose stamp differs from the ``stamp`` attribute
+    recorded on their node are looked up again.  Their nodes are replaced,
+    edges that pointed at them are re-pointed to whatever now satisfies the
+    same requirement, and nodes that are no longer needed are dropped.  If
+    a distribution was removed, edges that pointed at it are re-pointed to
+    a node with just its name and no version, which the "unmet" check
+    flags.
+
+    Parameters:
+        graph - a graph made by dependencies_to_graph, perhaps saved as JSON
+            and loaded again.
+        packages - the names of the top-level packages.
+        stamps - the environment's current ``probe.metadata_stamps()``.
+        find_dependencies - a function like ``probe.find_dependencies``.
+
+    Returns:
+        (graph, top_nodes, affected), where affected is the set of nodes
+        that are new, or whose outgoing edges changed.  Annotations on the
+        rest of the graph are left alone.
+    """
+    stale = stale_nodes(graph, stamps)
+
+    # Edges from nodes that stay to nodes that go, to re-point afterwards.
+    # Edges added by the "missing pin" check aren't real requirements.
+    repoint = []
+    orphans = set()
+    for node in stale:
+        for parent, _, data in graph.in_edges_iter([node], data=True):
+            if parent not in stale and \
+                    'missing pin' not in failed_checks(data):
+                repoint.append((parent, split_node(node)[0],
+                                data['requirement']))
+        orphans.update(dest for dest in graph.successors(node)
+                       if dest not in stale)
+
+    # Asking the probe about a distribution that's gone would fail
+    gone = set(name for parent, name, req in repoint
+               if probe.project_key(name) not in stamps)
+
+    # Look everything up before changing the graph, so that if the probe
+    # fails, the graph is left as it was
+    roots = list(packages) + [name for parent, name, req in repoint
+                              if name not in gone]
+    found, nodes, edges = find_dependencies(
+        roots, (set(graph) - stale) | gone)
+    resolved = dict(zip(roots, found))
+    resolved.update((name, name) for name in gone)
+
+    for node in stale:
+        remove_node(graph, node)
+    for name in gone:
+        if name not in graph:
+            add_node(graph, name, as_requirement=name)
+
+    _add_dependencies(graph, nodes, edges, stamps)
+    for parent, name, requirement in repoint:
+        graph.add_edge(parent, resolved[name], requirement=requirement)
+
+    top_nodes = found[:len(packages)]
+    old_top_nodes = graph.graph.get('query packages', [])
+    graph.graph['query packages'] = top_nodes
+
+    if orphans:
+        _remove_unreachable(graph, top_nodes)
+
+    affected = set(nodes)
+    affected.update(parent for parent, name, req in repoint)
+    affected.update(set(top_nodes) - set(old_top_nodes))
+    return (graph, top_nodes, set(n for n in affected if n in graph))
+
+
+def _remove_unreachable(graph, top_nodes):
+    "Remove nodes that aren't (really) depended on from the top nodes."
+    seen = set(top_nodes)
+    todo = list(top_nodes)
+    while todo:
+        for dest, data in graph[todo.pop()].items():
+            if dest not in seen and 'missing pin' not in failed_checks(data):
+                seen.add(dest)
+                todo.append(dest)
+
+    for node in [node for node in graph if node not in seen]:
+        remove_node(graph, node)
+
+
+def combine_graphs(graphs):
+    """
+    Merge several dependency graphs into a new one.
+
+    Nodes and edges are matched by key.  Failed checks from all the graphs
+    are kept, as are ``environments`` lists from collect_dependencies_many.
+    """
+    import networkx as nx
+
+    combined = nx.DiGraph()
+    for graph in graphs:
+        merge_graph(combined, graph)
+    return combined
+
+
+def merge_graph(combined, graph):
+    "Merge one dependency graph into another, in place."
+    for node, data in graph.nodes_iter(data=True):
+        _merge_node(combined, node, data)
+
+    for source, target, data in graph.edges_iter(data=True):
+        _merge_edge(combined, source, target, data)
 
-    # TODO: try to merge edge annotations that may differ between graphs
-    query_packages = sum([G.graph['query packages'] for G in graphs], [])
-    composed.graph['query packages'] = query_packages
+    invalidate(combined)
+    _merge_graph_attrs(combined.graph, graph.graph)
 
-    check_lists = [G.graph['checks'] for G in graphs]
+
+def _merge_node(combined, node, data):
+    if node not in combined.node:
+        # Not through index.add_node: parsing every version as it's added
+        # is slow, so merge_graph invalidates the index instead
+        combined.add_node(node)
+    _merge_attrs(combined.node[node], data)
+
+
+def _merge_edge(combined, source, target, data):
+    attrs = combined.succ[source].get(target)
+    if attrs is None:
+        combined.add_edge(source, target)
+        attrs = combined.succ[source][target]
+    _merge_attrs(attrs, data)
+
+
+def _merge_graph_attrs(attrs, other):
+    attrs.setdefault('query packages', []).extend(
+        other.get('query packages', []))
+
+    for key in ('checks', 'environments'):
+        values = attrs.setdefault(key, [])
+        values.extend(v for v in other.get(key, []) if v not in values)
+
+    if 'cycles' in other:
+        attrs.setdefault('cycles', []).extend(other['cycles'])
+
+
+def _merge_attrs(data, other):
+    for key, value in other.items():
+        if key == 'failed_checks':
+            data.setdefault(key, {}).update(value)
+        elif key == 'environments':
+            envs = data.setdefault(key, [])
+            envs.extend(env for env in value if env not in envs)
+        else:
+            data.setdefault(key, value)
+
+
+def open_json_graph(filename):
+    "Open a file written by writers.json for reading, gzipped or not."
+    with open(filename, 'rb') as raw:
+        gzipped = raw.read(2) == b'\x1f\x8b'
+
+    if gzipped:
+        return io.TextIOWrapper(gzip.GzipFile(filename, 'rb'),
+                                encoding='utf-8')
+    return io.open(filename, 'r', encoding='utf-8')
+
+
+def combine_json_graphs(filenames, jobs=None, compact=False):
+    """
+    Load graphs saved by writers.json and merge them into one.
+
+    Each file is streamed straight into the combined graph (see
+    merge_graph), so memory use doesn't grow with the size or number of
+    the files beyond what the combined graph itself needs.  With jobs,
+    node and edge attributes other than failed checks and environments
+    come from whichever file is read first, rather than the first given.
+
+    Parameters:
+        filenames - the files, plain or gzipped.
+        jobs - optional number of files to read at a time, in threads.
+        compact - return a compact.CompactGraph.  A single file is read
+            straight into one, without networkx.
+    """
+    if compact and len(filenames) == 1:
+        graph = CompactGraph.from_node_link(_read_json_graph(filenames[0]))
+        attrs = graph.graph
+        graph.graph = {}
+        _merge_graph_attrs(graph.graph, attrs)
+        return graph
+
+    import networkx as nx
+
+    combined = nx.DiGraph()
+    if not filenames:
+        return CompactGraph.from_networkx(combined) if compact else combined
+
+    if jobs and jobs > 1 and len(filenames) > 1:
+        records = _read_json_graphs_threaded(filenames, jobs)
+    else:
+        records = ((num, record) for num, filename in enumerate(filenames)
+                   for record in _read_json_graph(filename))
+
+    graph_attrs = {}
+    for num, record in records:
+        kind = record[0]
+        if kind == 'node':
+            _merge_node(combined, record[1], record[2])
+        elif kind == 'link':
+            _merge_edge(combined, record[1], record[2], record[3])
+        else:
+            graph_attrs[num] = record[1]
+
+    # In the order given, whatever order they were read in
     last = None
-    for check_list in check_lists:
-        # TODO test this
-        if last is not None and set(check_list) != last:
-            logger.warning("Loading several dependency graphs, but they were"
-                           " run with different consistency checks - edge"
-                           " annotations may be incorrect!")
+    for num in sorted(graph_attrs):
+        _merge_graph_attrs(combined.graph, graph_attrs[num])
+
+        checks = set(graph_attrs[num].get('checks', []))
+        if last is not None and checks != last:
+            logger.warning("Loading several dependency graphs, but they"
+                           " were run with different consistency checks"
+                           " - edge annotations may be incorrect!")
+        last = checks
+
+    return CompactGraph.from_networkx(combined) if compact else combined
 
-        last = set(check_list)
 
-    return composed
+def _read_json_graph(filename):
+    with open_json_graph(filename) as json_file:
+        for record in jsonstream.read_node_link(json_file):
+            yield record
+
+
+_BATCH_SIZE = 1000
+
+
+def _read_json_graphs_threaded(filenames, jobs):
+    """
+    Read several JSON graph files at once, yielding their records.
+
+    Each thread reads whole files, passing (file number, record) pairs back
+    in batches through a bounded queue, so a slow consumer holds up the
+    readers instead of letting parsed records pile up.  Records from one
+    file stay in order.
+
+    A reader's exception is raised here.  Whenever this stops, because of
+    that or because the caller stopped early, the readers are told to stop
+    too, and waited for, so no file is left half read.
+    """
+    results = queue.Queue(maxsize=4 * jobs)
+    todo = queue.Queue()
+    for num, filename in enumerate(filenames):
+        todo.put((num, filename))
+    stop = threading.Event()
+
+    def put(item):
+        # Don't wait on a full queue that nobody is reading any more
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def reader():
+        try:
+            while not stop.is_set():
+                try:
+                    num, filename = todo.get_nowait()
+                except queue.Empty:
+                    break
+
+                records = _read_json_graph(filename)
+                try:
+                    batch = []
+                    for record in records:
+                        batch.append((num, record))
+                        if len(batch) >= _BATCH_SIZE:
+                            put(batch)
+                            batch = []
+                            if stop.is_set():
+                                return
+                    put(batch)
+                finally:
+                    records.close()
+        except Exception as exc:
+            put(exc)
+        finally:
+            put(None)
+
+    threads = [threading.Thread(target=reader)
+               for num in range(min(jobs, len(filenames)))]
+    for thread in threads:
+        thread.start()
+
+    try:
+        running = len(threads)
+        while running:
+            batch = results.get()
+            if batch is None:
+                running -= 1
+            elif isinstance(batch, Exception):
+                raise batch
+            else:
+                for record in batch:
+                    yield record
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
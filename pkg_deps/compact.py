@@ -0,0 +1,307 @@
+"""
+A compact, array-backed dependency graph.
+
+networkx keeps a dict per node, two per edge (successors and predecessors)
+and one for each node's and edge's attributes, keyed by the full
+requirement strings.  CompactGraph instead numbers the nodes, keeps each
+node's and edge's data in a small record with ``__slots__``, and stores the
+adjacency in CSR form: the successors of node ``i`` are
+``targets[offsets[i]:offsets[i + 1]]``, two flat arrays of ints.
+
+It's fixed once built, which suits whole-graph traversals: the annotators
+use it for finding cycles and descendants, and
+``collector.dependencies_to_graph(..., compact=True)`` builds one straight
+from probe output.  ``from_networkx`` and ``to_networkx`` convert for
+everything that needs a mutable graph (or a networkx one, like the dot
+writer).
+"""
+from array import array
+
+from pkg_deps import requirements
+from pkg_deps.index import project_key, split_node
+
+
+class NodeRecord(object):
+    __slots__ = ('as_requirement', 'attrs')
+
+    def __init__(self, as_requirement, attrs=None):
+        self.as_requirement = as_requirement
+        self.attrs = attrs  # anything else, or None
+
+    def data(self):
+        "The attributes dict, to annotate (made when first needed)."
+        if self.attrs is None:
+            self.attrs = {}
+        return self.attrs
+
+    def to_dict(self):
+        data = {'as_requirement': self.as_requirement}
+        data.update(self.attrs or ())
+        return data
+
+
+class EdgeRecord(object):
+    __slots__ = ('requirement', 'attrs')
+
+    def __init__(self, requirement, attrs=None):
+        self.requirement = requirement
+        self.attrs = attrs
+
+    def data(self):
+        "The attributes dict, to annotate (made when first needed)."
+        if self.attrs is None:
+            self.attrs = {}
+        return self.attrs
+
+    def to_dict(self):
+        data = {'requirement': self.requirement}
+        data.update(self.attrs or ())
+        return data
+
+
+def _split_attrs(data, main):
+    "Split one attribute out of a dict, returning (it, the rest or None)."
+    rest = dict(data)
+    value = rest.pop(main, None)
+    return value, rest or None
+
+
+class CompactGraph(object):
+    """
+    Parameters:
+        keys - the node keys, in order; node ids are positions in this.
+        edges - (source id, target id, EdgeRecord or None) triples.
+        nodes - optional list of NodeRecords, one per key.
+        graph - optional dict of graph attributes.
+    """
+    def __init__(self, keys, edges, nodes=None, graph=None):
+        self.keys = list(keys)
+        self.ids = dict((key, num) for num, key in enumerate(self.keys))
+        self.nodes = nodes
+        self.graph = graph if graph is not None else {}
+
+        # Counting sort of the edges by source gives the CSR arrays
+        count = len(self.keys)
+        offsets = [0] * (count + 1)
+        edges = list(edges)
+        for source, target, record in edges:
+            offsets[source + 1] += 1
+        for num in range(count):
+            offsets[num + 1] += offsets[num]
+
+        fill = offsets[:-1]
+        targets = [0] * len(edges)
+        records = [None] * len(edges)
+        for source, target, record in edges:
+            pos = fill[source]
+            targets[pos] = target
+            records[pos] = record
+            fill[source] = pos + 1
+
+        self.offsets = array('l', offsets)
+        self.targets = array('l', targets)
+        self.edge_records = records
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def number_of_edges(self):
+        return len(self.targets)
+
+    def successors(self, num):
+        "Ids of the nodes that node id num depends on."
+        return self.targets[self.offsets[num]:self.offsets[num + 1]]
+
+    def edges(self):
+        "Yield (source key, target key, EdgeRecord) for every edge."
+        keys = self.keys
+        targets = self.targets
+        offsets = self.offsets
+        for source in range(len(keys)):
+            for pos in range(offsets[source], offsets[source + 1]):
+                yield keys[source], keys[targets[pos]], self.edge_records[pos]
+
+    @classmethod
+    def from_dependencies(cls, top_nodes, nodes, edges, stamps=None):
+        """
+        Build a graph from probe output, like dependencies_to_graph does.
+
+        stamps is an optional dict of project key -> metadata stamp.
+        """
+        keys = []
+        ids = {}
+        for node in nodes:
+            if node not in ids:
+                ids[node] = len(keys)
+                keys.append(node)
+
+        records = []
+        for node in keys:
+            attrs = None
+            if stamps is not None:
+                key = project_key(split_node(node)[0])
+                attrs = {'stamp': stamps.get(key)}
+            records.append(NodeRecord(node, attrs))
+
+        # Later duplicates of an edge win, as with add_edge
+        edge_map = {}
+        for source, requirement, target in edges:
+            requirements.parse(requirement)
+            edge_map[ids[source], ids[target]] = EdgeRecord(requirement)
+
+        return cls(keys,
+                   ((source, target, record)
+                    for (source, target), record in edge_map.items()),
+                   nodes=records,
+                   graph={'query packages': list(top_nodes)})
+
+    @classmethod
+    def from_networkx(cls, graph, data=True):
+        """
+        Convert a networkx graph.
+
+        With data=False only the structure is copied, which is all the
+        traversals need.
+        """
+        keys = list(graph)
+        ids = dict((key, num) for num, key in enumerate(keys))
+
+        def edges():
+            for source, targets in graph.succ.items():
+                source_id = ids[source]
+                for target, attrs in targets.items():
+                    record = None
+                    if data:
+                        record = EdgeRecord(
+                            *_split_attrs(attrs, 'requirement'))
+                    yield source_id, ids[target], record
+
+        nodes = None
+        if data:
+            nodes = [NodeRecord(*_split_attrs(graph.node[key],
+                                              'as_requirement'))
+                     for key in keys]
+
+        return cls(keys, edges(), nodes=nodes,
+                   graph=dict(graph.graph) if data else None)
+
+    @classmethod
+    def from_node_link(cls, records):
+        """
+        Build a graph from jsonstream.read_node_link records.
+
+        As when loading into a networkx graph, a node or link that appears
+        twice has its attributes updated by the later one.
+        """
+        keys = []
+        ids = {}
+        node_data = []
+        edge_data = {}
+        graph_attrs = {}
+        for record in records:
+            kind = record[0]
+            if kind == 'node':
+                key = record[1]
+                if key in ids:
+                    node_data[ids[key]].update(record[2])
+                else:
+                    ids[key] = len(keys)
+                    keys.append(key)
+                    node_data.append(record[2])
+            elif kind == 'link':
+                edge_data.setdefault((ids[record[1]], ids[record[2]]),
+                                     {}).update(record[3])
+            else:
+                graph_attrs.update(record[1])
+
+        return cls(keys,
+                   ((source, target,
+                     EdgeRecord(*_split_attrs(data, 'requirement')))
+                    for (source, target), data in edge_data.items()),
+                   nodes=[NodeRecord(*_split_attrs(data, 'as_requirement'))
+                          for data in node_data],
+                   graph=graph_attrs)
+
+    def to_networkx(self):
+        "Make an equivalent networkx.DiGraph."
+        import networkx as nx
+
+        graph = nx.DiGraph()
+        graph.graph.update(self.graph)
+        for num, key in enumerate(self.keys):
+            if self.nodes is None:
+                graph.add_node(key)
+            else:
+                graph.add_node(key, **self.nodes[num].to_dict())
+
+        for source, target, record in self.edges():
+            if record is None:
+                graph.add_edge(source, target)
+            else:
+                graph.add_edge(source, target, **record.to_dict())
+        return graph
+
+    def strongly_connected_components(self, roots=None):
+        """
+        Yield the strongly connected components, as lists of node ids.
+
+        This is Tarjan's algorithm, so components come sinks first: every
+        component is yielded after all those it depends on.  With roots,
+        only the nodes reachable from those ids are visited.
+        """
+        offsets = self.offsets
+        targets = self.targets
+        count = len(self.keys)
+
+        # index is -1 for nodes not visited yet, and done once they're in a
+        # component, which is bigger than any real index, so finished nodes
+        # never lower anything's low-link
+        done = count
+        index = [-1] * count
+        low = [0] * count
+        where = [0] * count  # position on the stack
+        stack = []
+        counter = 0
+
+        for root in (range(count) if roots is None else roots):
+            if index[root] != -1:
+                continue
+
+            index[root] = low[root] = counter
+            counter += 1
+            where[root] = len(stack)
+            stack.append(root)
+            work = [(root, iter(targets[offsets[root]:offsets[root + 1]]))]
+
+            while work:
+                node, succs = work[-1]
+                for succ in succs:
+                    succ_index = index[succ]
+                    if succ_index == -1:
+                        # Go deeper; succs carries on from here afterwards
+                        index[succ] = low[succ] = counter
+                        counter += 1
+                        where[succ] = len(stack)
+                        stack.append(succ)
+                        work.append((succ, iter(
+                            targets[offsets[succ]:offsets[succ + 1]])))
+                        break
+                    elif succ_index < low[node]:
+                        low[node] = succ_index
+                else:
+                    work.pop()
+                    node_low = low[node]
+                    if work:
+                        parent = work[-1][0]
+                        if node_low < low[parent]:
+                            low[parent] = node_low
+
+                    if node_low == index[node]:
+                        component = stack[where[node]:]
+                        del stack[where[node]:]
+                        for member in component:
+                            index[member] = done
+                        yield component
@@ -0,0 +1,192 @@
+"""
+Compare two dependency graphs saved by ``writers.json``.
+
+Node keys include versions (``lxml==3.2.4``), so after an upgrade the same
+project has a different node in each graph.  Both graphs are instead
+indexed by project key, the normalized name, as they're streamed in with
+``jsonstream.read_node_link``.  Nothing but the index is kept, and one pass
+over the projects in either index finds what changed: packages added,
+removed or at different versions, dependencies added, removed or with
+different requirements, and checks that newly failed or now pass.
+
+Edges added by the "missing pin" check aren't real requirements, so they
+only count for their failed checks.
+"""
+from pkg_deps import jsonstream
+from pkg_deps.collector import open_json_graph
+from pkg_deps.index import split_node
+from pkg_deps.probe import project_key
+
+
+class _Package(object):
+    __slots__ = ('name', 'versions', 'failed')
+
+    def __init__(self, name):
+        self.name = name
+        self.versions = []
+        self.failed = None  # failed checks, if any
+
+
+class _Dependency(object):
+    __slots__ = ('requirement', 'failed')
+
+    def __init__(self):
+        self.requirement = None
+        self.failed = None
+
+
+def index_records(records):
+    """
+    Index a graph's records from jsonstream.read_node_link.
+
+    Returns (graph attributes, packages, dependencies): packages maps each
+    project key to its name, versions and failed checks; dependencies maps
+    (source key, target key) to the requirement and failed checks.
+    """
+    attrs = {}
+    packages = {}
+    dependencies = {}
+    keys = {}  # node -> project key
+
+    for record in records:
+        kind = record[0]
+        if kind == 'link':
+            data = record[3]
+            pair = (keys[record[1]], keys[record[2]])
+            dependency = dependencies.get(pair)
+            if dependency is None:
+                dependency = dependencies[pair] = _Dependency()
+
+            fails = data.get('failed_checks')
+            if not fails or 'missing pin' not in fails:
+                dependency.requirement = data['requirement']
+            if fails:
+                dependency.failed = _merged(dependency.failed, fails)
+        elif kind == 'node':
+            node, data = record[1], record[2]
+            name, version = split_node(node)
+            key = keys[node] = project_key(name)
+            package = packages.get(key)
+            if package is None:
+                package = packages[key] = _Package(name)
+            package.versions.append(version)
+
+            fails = data.get('failed_checks')
+            if fails:
+                package.failed = _merged(package.failed, fails)
+        else:
+            attrs = record[1]
+
+    return attrs, packages, dependencies
+
+
+def _merged(failed, more):
+    if failed is None:
+        return dict(more)
+    failed.update(more)
+    return failed
+
+
+def index_file(filename):
+    "index_records for a file written by writers.json, gzipped or not."
+    with open_json_graph(filename) as stream:
+        return index_records(jsonstream.read_node_link(stream))
+
+
+def diff_files(old_filename, new_filename):
+    "diff_indexes for two files written by writers.json."
+    return diff_indexes(index_file(old_filename), index_file(new_filename))
+
+
+def diff_indexes(old, new):
+    """
+    Compare two graphs, as indexed by index_records.
+
+    Returns a dict of lists, all sorted by project:
+        added, removed - {'package', 'versions'} for packages in only one
+            graph.
+        changed - {'package', 'old', 'new'} for packages at different
+            versions.
+        added_dependencies, removed_dependencies - {'source', 'target',
+            'requirement'} for dependencies in only one graph.
+        changed_requirements - {'source', 'target', 'old', 'new'}.
+        new_failures, fixed_failures - {'package'} or {'source',
+            'target'}, with 'check' and 'message', for checks that fail in
+            only the new or the old graph.
+
+    and 'checks', {'old', 'new'}: which checks each graph was run with.
+    """
+    old_attrs, old_packages, old_dependencies = old
+    new_attrs, new_packages, new_dependencies = new
+    result = {
+        'checks': {'old': old_attrs.get('checks', []),
+                   'new': new_attrs.get('checks', [])},
+        'added': [], 'removed': [], 'changed': [],
+        'added_dependencies': [], 'removed_dependencies': [],
+        'changed_requirements': [],
+        'new_failures': [], 'fixed_failures': [],
+    }
+
+    for key in sorted(set(old_packages) | set(new_packages)):
+        before = old_packages.get(key)
+        after = new_packages.get(key)
+        if before is None:
+            result['added'].append({'package': after.name,
+                                    'versions': sorted(after.versions)})
+        elif after is None:
+            result['removed'].append({'package': before.name,
+                                      'versions': sorted(before.versions)})
+        elif before.versions != after.versions and \
+                sorted(before.versions) != sorted(after.versions):
+            result['changed'].append({'package': after.name,
+                                      'old': sorted(before.versions),
+                                      'new': sorted(after.versions)})
+
+        old_failed = before and before.failed
+        new_failed = after and after.failed
+        if old_failed != new_failed:
+            _diff_failures(result, {'package': (after or before).name},
+                           old_failed, new_failed)
+
+    for pair in sorted(set(old_dependencies) | set(new_dependencies)):
+        before = old_dependencies.get(pair)
+        after = new_dependencies.get(pair)
+        old_req = before and before.requirement
+        new_req = after and after.requirement
+        old_failed = before and before.failed
+        new_failed = after and after.failed
+        if old_req == new_req and old_failed == new_failed:
+            continue
+
+        packages = new_packages if after else old_packages
+        where = {'source': packages[pair[0]].name,
+                 'target': packages[pair[1]].name}
+        if old_req == new_req:
+            pass
+        elif old_req is None:
+            result['added_dependencies'].append(
+                dict(where, requirement=new_req))
+        elif new_req is None:
+            result['removed_dependencies'].append(
+                dict(where, requirement=old_req))
+        else:
+            result['changed_requirements'].append(
+                dict(where, old=old_req, new=new_req))
+
+        if old_failed != new_failed:
+            _diff_failures(result, where, old_failed, new_failed)
+
+    return result
+
+
+def _diff_failures(result, where, before, after):
+    before = before or {}
+    after = after or {}
+    for check in sorted(after):
+        if check not in before:
+            result['new_failures'].append(
+                dict(where, check=check, message=after[check]))
+    for check in sorted(before):
+        if check not in after:
+            result['fixed_failures'].append(
+                dict(where, check=check, message=before[check]))
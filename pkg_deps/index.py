@@ -0,0 +1,121 @@
+"""
+Name-keyed index over the nodes of a dependency graph.
+
+Node keys are requirement strings like ``lxml==3.2.4``.  The index maps each
+project key (the lowercased, normalized project name, as in
+``Requirement.key``) to the nodes for that project, along with their
+versions, so finding the node that satisfies a requirement doesn't mean
+re-splitting every key in the graph.  Versions are only parsed when
+they're first compared, and then kept, so building the index doesn't
+import pkg_resources.
+
+The index is attached to the graph object, but not stored in ``graph.graph``,
+so it never ends up in JSON output.  Code that adds or removes nodes should
+go through ``add_node`` and ``remove_node`` to keep it current, or else call
+``invalidate`` afterwards, so it's rebuilt the next time it's asked for.
+"""
+import weakref
+
+from pkg_deps.probe import project_key
+from pkg_deps.requirements import parse_version
+
+
+_indexes = weakref.WeakKeyDictionary()
+
+
+def split_node(node):
+    "Split a node key like 'lxml==3.2.4' into ('lxml', '3.2.4')."
+    name, _, version = node.partition('==')
+    return name, version.lstrip('=')
+
+
+class NodeIndex(object):
+    def __init__(self, nodes=()):
+        self._nodes = set()
+        self._by_key = {}  # project key -> {node: version string}
+        self._parsed = {}  # version string -> parsed version
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def add(self, node):
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+
+        # No version means the package isn't installed (see
+        # collector.update_graph), so it can't satisfy anything
+        name, version = split_node(node)
+        self._by_key.setdefault(project_key(name), {})[node] = version
+
+    def remove(self, node):
+        if node not in self._nodes:
+            return
+        self._nodes.remove(node)
+
+        key = project_key(split_node(node)[0])
+        versions = self._by_key[key]
+        del versions[node]
+        if not versions:
+            del self._by_key[key]
+
+    def nodes_for(self, name):
+        "All the nodes for a project name (any version)."
+        return list(self._by_key.get(project_key(name), ()))
+
+    def version(self, node):
+        "The parsed version of a node in the index, or None."
+        name, _ = split_node(node)
+        version = self._by_key[project_key(name)][node]
+        return self._parse(version) if version else None
+
+    def _parse(self, version):
+        try:
+            return self._parsed[version]
+        except KeyError:
+            parsed = self._parsed[version] = parse_version(version)
+            return parsed
+
+    def find(self, requirement):
+        """
+        Return a node satisfying a parsed requirement, or None.
+
+        Only the nodes with the requirement's project key are considered.
+        """
+        for node, version in self._by_key.get(requirement.key, {}).items():
+            if version and requirement.satisfied_by(version, self._parse):
+                return node
+        return None
+
+
+def node_index(graph):
+    "Return the graph's NodeIndex, building it if needed."
+    index = _indexes.get(graph)
+    # The count is only a last resort: it misses a node being replaced
+    if index is None or len(index) != graph.number_of_nodes():
+        index = _indexes[graph] = NodeIndex(graph)
+    return index
+
+
+def invalidate(graph):
+    "Forget the graph's NodeIndex, after changing its nodes directly."
+    _indexes.pop(graph, None)
+
+
+def add_node(graph, node, **attr):
+    "Add a node to the graph and its index."
+    index = node_index(graph)
+    graph.add_node(node, **attr)
+    index.add(node)
+
+
+def remove_node(graph, node):
+    "Remove a node (and its edges) from the graph and its index."
+    index = node_index(graph)
+    graph.remove_node(node)
+    index.remove(node)
@@ -0,0 +1,193 @@
+"""
+Look up the latest versions of packages on a package index.
+
+This talks to a PEP 503 / PEP 691 "simple" index directly, asking only for
+the projects in the dependency graph.  Several pages are fetched at a time,
+each worker thread keeping its own connection open between requests until
+the lookup is done, and pages are saved in a cache.DiskCache along with
+their ETag and Last-Modified headers, so later runs mostly get "304 Not
+Modified" back.
+"""
+import logging
+import threading
+
+try:
+    import http.client as httplib
+    from urllib.parse import urljoin, urlsplit
+except ImportError:  # Python 2
+    import httplib
+    from urlparse import urljoin, urlsplit
+
+from pkg_deps import cache as _cache
+from pkg_deps.snapshot import canonical_name, latest_version, parse_page
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_INDEX_URL = 'https://pypi.org/simple/'
+
+DEFAULT_JOBS = 8
+
+JSON_TYPE = 'application/vnd.pypi.simple.v1+json'
+ACCEPT = JSON_TYPE + ', text/html;q=0.1'
+
+MAX_REDIRECTS = 5
+
+
+class IndexFetchError(Exception):
+    pass
+
+
+class IndexClient(object):
+    """
+    Fetch project pages from an index.
+
+    Its connections stay open for more requests until close() is called;
+    latest_versions closes them when it's done, and it can be used as a
+    context manager around other requests.
+
+    Parameters:
+        index_url - the index's base URL, like https://pypi.org/simple/
+        cache - optional cache.DiskCache for pages.
+        jobs - how many pages to fetch at a time.
+        timeout - seconds to wait for the index to answer.
+    """
+    def __init__(self, index_url=DEFAULT_INDEX_URL, cache=None,
+                 jobs=DEFAULT_JOBS, timeout=30):
+        self.index_url = index_url.rstrip('/') + '/'
+        self.cache = cache
+        self.jobs = jobs
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def close(self):
+        "Close all the connections the client has open."
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        for conn in connections:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _connection(self, scheme, netloc):
+        # One connection per thread and host, kept open between requests
+        connections = self._local.__dict__.setdefault('connections', {})
+        conn = connections.get((scheme, netloc))
+        if conn is None:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            elif scheme == 'http':
+                conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            else:
+                raise IndexFetchError("Can't fetch %s URLs" % scheme)
+            connections[(scheme, netloc)] = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _request(self, url, headers):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        conn = self._connection(parts.scheme, parts.netloc)
+        for attempt in range(2):
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                return response, response.read()
+            except (httplib.HTTPException, IOError, OSError) as exc:
+                # Most likely the server closed an idle connection, so
+                # try once more on a new one
+                conn.close()
+                if attempt:
+                    raise IndexFetchError(
+                        "Couldn't fetch %s: %s" % (url, exc))
+
+    def fetch(self, url):
+        """
+        Fetch a page, using the cache if it's still current.
+
+        Returns (content type, text), or None if there's no such page.
+        """
+        key = _cache.make_key('index page', url)
+        cached = self.cache.get(key) if self.cache else None
+
+        headers = {'Accept': ACCEPT}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        location = url
+        for redirect in range(MAX_REDIRECTS):
+            response, body = self._request(location, headers)
+            if response.status not in (301, 302, 303, 307, 308):
+                break
+            location = urljoin(location, response.getheader('Location'))
+        else:
+            raise IndexFetchError("Too many redirects for %s" % url)
+
+        if response.status == 304 and cached:
+            logger.debug("Not modified: %s", url)
+            return cached['content_type'], cached['text']
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise IndexFetchError("Couldn't fetch %s: %s %s" % (
+                url, response.status, response.reason))
+
+        content_type = response.getheader('Content-Type', 'text/html')
+        text = body.decode('utf-8')
+        if self.cache and (response.getheader('ETag') or
+                           response.getheader('Last-Modified')):
+            self.cache.put(key, {
+                'etag': response.getheader('ETag'),
+                'last_modified': response.getheader('Last-Modified'),
+                'content_type': content_type,
+                'text': text,
+            })
+        return content_type, text
+
+    def project_latest(self, name):
+        "The latest version of a project, or None if it's not there."
+        page = self.fetch(self.index_url + canonical_name(name) + '/')
+        if page is None:
+            logger.info("%s isn't on %s", name, self.index_url)
+            return None
+
+        content_type, text = page
+        page_name, files = parse_page(text, content_type.startswith(
+            JSON_TYPE))
+        return latest_version(page_name or name, files)
+
+    def latest_versions(self, names):
+        """
+        Look up the latest version of several projects at once.
+
+        Returns a dict of canonical project name -> latest version, like
+        snapshot.load_latest_versions, leaving out those not found.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        names = sorted(set(canonical_name(name) for name in names))
+        pool = ThreadPool(max(1, min(self.jobs, len(names))))
+        try:
+            versions = pool.map(self.project_latest, names)
+        finally:
+            pool.close()
+            pool.join()
+            self.close()
+
+        return dict((name, version) for name, version in zip(names, versions)
+                    if version)
@@ -0,0 +1,124 @@
+"""
+Time the stages of a pkg-deps run.
+
+A Recorder measures each stage run inside ``recorder.stage(name)``.  For
+every stage it records:
+- wall-clock time;
+- CPU time of this process;
+- CPU time of the subprocesses waited for during it (pip, or the probe of
+  another Python);
+- the peak resident memory so far;
+- the graph's size, for stages that build one.
+
+``report()`` returns all of this as a dict, for writing out as JSON or as
+TeamCity statistics (``writers.teamcity_statistics``).
+
+One stage can also be run under cProfile, to see where its time goes.
+"""
+import contextlib
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# os.times() only counts in clock ticks, so this process's own CPU time
+# comes from these where they're there
+_wall_clock = getattr(time, 'perf_counter', time.time)
+_cpu_clock = getattr(time, 'process_time', None) or time.clock
+
+
+def peak_rss():
+    "The most memory this process has had resident, in bytes, or None."
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts in kilobytes, macOS in bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Recorder(object):
+    """
+    Collects the measurements of a run's stages.
+
+    Parameters:
+        profile_stage - optional name of a stage to run under cProfile.
+        profile_output - where to save that stage's profile, for pstats or
+            a viewer.  Without it, the top of the profile is printed to
+            stderr.
+    """
+    def __init__(self, profile_stage=None, profile_output=None):
+        self.profile_stage = profile_stage
+        self.profile_output = profile_output
+        self.stages = []
+        self._started = _clocks()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure the code run inside this, as a stage called name.
+
+        Yields the stage's record, a dict; pass it to graph_size to add
+        the size of the graph the stage made.
+        """
+        record = {'stage': name}
+        profiler = None
+        if name == self.profile_stage:
+            import cProfile
+            profiler = cProfile.Profile()
+
+        before = _clocks()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record.update(_times(before, _clocks()))
+            record['peak_rss'] = peak_rss()
+            self.stages.append(record)
+
+            if profiler is not None:
+                self._save_profile(profiler)
+
+    def _save_profile(self, profiler):
+        if self.profile_output:
+            profiler.dump_stats(self.profile_output)
+        else:
+            import pstats
+            stats = pstats.Stats(profiler, stream=sys.stderr)
+            stats.sort_stats('cumulative').print_stats(25)
+
+    def graph_size(self, record, graph):
+        "Note the size of a graph (networkx or compact) in a stage record."
+        record['nodes'] = len(graph)
+        record['edges'] = graph.number_of_edges()
+
+    def report(self):
+        """
+        All the measurements so far.
+
+        Returns a dict with 'stages', the stage records in the order they
+        ran, and 'total', for the whole run up to now.
+        """
+        total = _times(self._started, _clocks())
+        total['peak_rss'] = peak_rss()
+        return {'stages': list(self.stages), 'total': total}
+
+
+def _clocks():
+    "(wall time, CPU time, subprocesses' CPU time), all in seconds."
+    times = os.times()
+    return _wall_clock(), _cpu_clock(), times[2] + times[3]
+
+
+def _times(before, after):
+    return {
+        'wall': after[0] - before[0],
+        'cpu': after[1] - before[1],
+        'subprocess_cpu': after[2] - before[2],
+    }
@@ -0,0 +1,172 @@
+"""
+Read node-link JSON graphs a piece at a time.
+
+``json.load`` needs the whole document, and then node_link_graph builds a
+graph from it, so loading a big file takes several times its size in
+memory.  ``read_node_link`` instead reads the file in chunks and yields each
+node and link as soon as it's decoded, so only one item (plus the ids of
+the nodes seen so far, which links refer to by position) is held at a time.
+"""
+import json
+import re
+
+
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_not_whitespace = re.compile(r'[^ \t\n\r]')
+_whitespace = re.compile(r'[ \t\n\r]*')
+_separator = re.compile(r'[ \t\n\r]*([,\]])[ \t\n\r]*')
+
+
+class _Scanner(object):
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, at_least=0):
+        "Read more, keeping what's left of the buffer.  False at EOF."
+        if self.eof:
+            return False
+        data = self.stream.read(max(self.chunk_size, at_least))
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        "The next non-whitespace character, or '' at the end."
+        while True:
+            match = _not_whitespace.search(self.buffer, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.buffer[self.pos]
+            self.pos = len(self.buffer)
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of %r at %r" % (
+                chars, self.buffer[self.pos:self.pos + 20] or 'end of file'))
+        self.pos += 1
+        return char
+
+    def value(self):
+        "Decode the next JSON value."
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # Probably cut off: read at least as much again, so a long
+                # value isn't re-decoded too many times
+                if self._fill(len(self.buffer) - self.pos):
+                    continue
+                raise
+
+            # A number at the very end might have more digits to come
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def _items(scanner):
+    "Yield the values in a JSON array."
+    scanner.expect('[')
+    if scanner.peek() == ']':
+        scanner.pos += 1
+        return
+
+    scan_once = _decoder.scan_once
+    separator = _separator.match
+    whitespace = _whitespace.match
+    while True:
+        # Fast path: the item and what follows are already in the buffer
+        buffer = scanner.buffer
+        try:
+            value, end = scan_once(buffer,
+                                   whitespace(buffer, scanner.pos).end())
+        except (StopIteration, ValueError):
+            end = None
+        if end is not None:
+            match = separator(buffer, end)
+            if match and match.end() < len(buffer):
+                scanner.pos = match.end()
+                yield value
+                if match.group(1) == ']':
+                    return
+                continue
+
+        yield scanner.value()
+        if scanner.expect(',]') == ']':
+            return
+
+
+def read_node_link(stream, chunk_size=CHUNK_SIZE):
+    """
+    Read a node-link JSON document, as written by writers.json.
+
+    Yields tuples:
+        ('graph', attrs) - the graph's attributes,
+        ('node', node, attrs) - a node's key and attributes,
+        ('link', source, target, attrs) - an edge, with node keys.
+
+    Links are expected after the nodes they refer to, as writers.json and
+    node_link_data write them; if they come first they're kept until the
+    nodes have been read.
+    """
+    scanner = _Scanner(stream, chunk_size)
+    ids = []
+    nodes_read = False
+    early_links = []
+
+    def link(attrs):
+        source = ids[attrs.pop('source')]
+        target = ids[attrs.pop('target')]
+        return ('link', source, target, attrs)
+
+    scanner.expect('{')
+    if scanner.peek() == '}':
+        return
+
+    while True:
+        key = scanner.value()
+        scanner.expect(':')
+
+        if key == 'nodes':
+            for attrs in _items(scanner):
+                node = attrs.pop('id', len(ids))
+                ids.append(node)
+                yield ('node', node, attrs)
+            nodes_read = True
+            for attrs in early_links:
+                yield link(attrs)
+            early_links = []
+        elif key == 'links':
+            for attrs in _items(scanner):
+                if nodes_read:
+                    yield link(attrs)
+                else:
+                    early_links.append(attrs)
+        elif key == 'graph':
+            attrs = scanner.value()
+            if isinstance(attrs, list):
+                # Older networkx wrote the attributes as a list of pairs
+                attrs = dict(attrs)
+            yield ('graph', attrs)
+        else:
+            scanner.value()
+
+        if scanner.expect(',}') == '}':
+            break
+
+    if early_links:
+        raise ValueError("Links but no nodes in node-link JSON")
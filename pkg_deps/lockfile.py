@@ -0,0 +1,384 @@
+"""
+Find dependencies from a lock file, without installing anything.
+
+A lock file here is a pip requirements file with every package pinned
+(``name==version``, usually with ``--hash`` options, as pip-compile writes
+them), and a wheelhouse: a directory of the locked packages' wheels or
+sdists, as ``pip download`` or ``pip wheel`` leave them.  The metadata is
+read straight out of the archives, so the graph is the same as probing a
+virtualenv with exactly those packages installed would give.
+"""
+import collections
+import email.parser
+import hashlib
+import io
+import logging
+import os
+import re
+import tarfile
+import zipfile
+
+from pkg_resources import (Requirement, evaluate_marker, safe_name,
+                           safe_version)
+
+from pkg_deps import probe, wheelmeta
+from pkg_deps.snapshot import canonical_name
+
+
+logger = logging.getLogger(__name__)
+
+
+LockEntry = collections.namedtuple('LockEntry', 'name version hashes')
+
+# Options that can appear in requirements files, and take an argument
+_OPTIONS_WITH_ARGS = set([
+    '-i', '--index-url', '--extra-index-url', '-f', '--find-links',
+    '--trusted-host', '--no-binary', '--only-binary',
+])
+
+_ARCHIVE_SUFFIXES = ('.whl', '.tar.gz', '.tar.bz2', '.tgz', '.zip')
+
+# The --hash algorithms pip accepts
+HASH_ALGORITHMS = ('sha256', 'sha384', 'sha512')
+
+
+class LockError(Exception):
+    pass
+
+
+def _logical_lines(path):
+    "Lines of a requirements file, with continuations joined."
+    with io.open(path, encoding='utf-8') as lines:
+        pending = ''
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if line.endswith('\\'):
+                pending += line[:-1] + ' '
+                continue
+            yield pending + line
+            pending = ''
+        if pending:
+            yield pending
+
+
+def read_requirements(path):
+    """
+    Read the pins from a requirements file, following -r and -c.
+
+    Returns a dict of canonical project name -> LockEntry.  Lines whose
+    markers don't apply to this Python are left out; unpinned or editable
+    requirements are skipped with a warning.
+    """
+    entries = {}
+    for line in _logical_lines(path):
+        line = re.sub(r'(^|\s)#.*$', '', line).strip()
+        if not line:
+            continue
+
+        words = line.split()
+        if words[0] in ('-r', '--requirement', '-c', '--constraint'):
+            included = os.path.join(os.path.dirname(path), words[1])
+            entries.update(read_requirements(included))
+            continue
+        if words[0] in ('-e', '--editable'):
+            logger.warning("Skipping editable requirement in %s: %s",
+                           path, line)
+            continue
+
+        requirement, hashes = _split_options(line)
+        if not requirement:
+            continue
+
+        req = Requirement.parse(requirement)
+        if req.marker and not req.marker.evaluate():
+            continue
+
+        pins = [version for op, version in req.specs if op in ('==', '===')]
+        if len(pins) != 1:
+            logger.warning("Skipping requirement that isn't pinned in %s: %s",
+                           path, requirement)
+            continue
+
+        entries[canonical_name(req.project_name)] = LockEntry(
+            req.project_name, pins[0], hashes)
+
+    return entries
+
+
+def _split_options(line):
+    "Split a requirement line into (requirement, list of hashes)."
+    words = line.split()
+    requirement = []
+    hashes = []
+    pos = 0
+    while pos < len(words):
+        word = words[pos]
+        if word.startswith('--hash'):
+            if word == '--hash':
+                pos += 1
+                word = words[pos]
+            hashes.append(word.split('=', 1)[-1] if word.startswith('--')
+                          else word)
+        elif word in _OPTIONS_WITH_ARGS:
+            pos += 1
+        elif not word.startswith('-'):
+            requirement.append(word)
+        pos += 1
+    return ' '.join(requirement), hashes
+
+
+def _archive_name(filename):
+    """
+    Split a wheel or sdist filename into (canonical name, version).
+
+    Returns None for anything else.
+    """
+    if filename.endswith('.whl.metadata'):
+        filename = filename[:-len('.metadata')]
+
+    if filename.endswith('.whl'):
+        parts = filename.split('-')
+        if len(parts) < 5:
+            return None
+        return canonical_name(parts[0]), safe_version(parts[1])
+
+    for suffix in _ARCHIVE_SUFFIXES:
+        if filename.endswith(suffix):
+            base = filename[:-len(suffix)]
+            # The version is after the last dash, and starts with a digit
+            match = re.match(r'^(.+?)-(\d[^-]*)$', base)
+            if match:
+                return (canonical_name(match.group(1)),
+                        safe_version(match.group(2)))
+    return None
+
+
+def find_archives(wheelhouse):
+    """
+    Find the distributions in a wheelhouse directory.
+
+    Returns a dict of (canonical name, version) -> list of paths, with
+    PEP 658 ``.whl.metadata`` files first, then wheels, then sdists, since
+    that's the order they're cheapest to read in.
+    """
+    def preference(path):
+        if path.endswith('.metadata'):
+            return 0
+        return 1 if path.endswith('.whl') else 2
+
+    archives = {}
+    for filename in sorted(os.listdir(wheelhouse)):
+        name = _archive_name(filename)
+        if name is not None:
+            archives.setdefault(name, []).append(
+                os.path.join(wheelhouse, filename))
+
+    for paths in archives.values():
+        paths.sort(key=preference)
+    return archives
+
+
+def read_sdist_metadata(path):
+    """
+    Metadata text from an sdist's PKG-INFO.
+
+    Older sdists don't list their requirements in PKG-INFO, so any
+    Requires-Dist lines are made up from ``*.egg-info/requires.txt``.
+    """
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            return _sdist_metadata(path, archive.namelist(), archive.read)
+
+    with tarfile.open(path) as archive:
+        return _sdist_metadata(
+            path, [member.name for member in archive.getmembers()
+                   if member.isfile()],
+            lambda name: archive.extractfile(name).read())
+
+
+def _sdist_metadata(path, names, read):
+    pkg_info = [name for name in names if name.count('/') == 1 and
+                name.endswith('/PKG-INFO')]
+    if not pkg_info:
+        raise LockError("No PKG-INFO in %s" % path)
+
+    text = read(pkg_info[0]).decode('utf-8', 'replace')
+    headers = email.parser.Parser().parsestr(text, headersonly=True)
+    if headers.get_all('Requires-Dist'):
+        return text
+
+    requires = [name for name in names if name.count('/') == 2 and
+                name.endswith('.egg-info/requires.txt')]
+    if requires:
+        lines = read(requires[0]).decode('utf-8', 'replace')
+        extra = ''.join('Requires-Dist: %s\n' % line
+                        for line in _base_requirements(lines))
+        head, sep, body = text.partition('\n\n')
+        text = head.rstrip('\n') + '\n' + extra + sep + body
+    return text
+
+
+def _base_requirements(requires_txt):
+    """
+    Lines of requires.txt outside any [extra] section.
+
+    Sections for markers are evaluated here, and their lines kept without
+    the marker, the same as pkg_resources does for installed egg-info, so
+    the edges are the same either way.
+    """
+    section = None
+    for line in requires_txt.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('['):
+            section = line[1:-1]
+            continue
+        if section is None:
+            yield line
+        elif section.startswith(':') and _marker_ok(section[1:]):
+            # A section for a marker, not an extra
+            yield line
+
+
+def _marker_ok(marker):
+    try:
+        return evaluate_marker(marker)
+    except SyntaxError:
+        # pkg_resources drops requirements with invalid markers, too
+        return False
+
+
+def read_metadata(path):
+    """
+    The metadata text of an sdist or PEP 658 metadata file.
+
+    Wheels are read by wheelmeta.read_wheel_metadata instead.
+    """
+    if path.endswith('.metadata'):
+        with io.open(path, encoding='utf-8', errors='replace') as metadata:
+            return metadata.read()
+    return read_sdist_metadata(path)
+
+
+def file_hash(path, algorithm='sha256'):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as archive:
+        for block in iter(lambda: archive.read(1024 * 1024), b''):
+            digest.update(block)
+    return '%s:%s' % (algorithm, digest.hexdigest())
+
+
+class LockBackend(object):
+    """
+    A probe backend that looks up distributions in a lock file.
+
+    This has the same interface as the backends in probe, so
+    probe.find_dependencies can walk a lock file just like an environment.
+
+    Parameters:
+        entries - from read_requirements.
+        wheelhouse - the directory of archives.
+        verify_hashes - check that each archive read matches one of the
+            hashes in the lock file.
+        metadata_cache - optional cache.JSONFileCache for wheels'
+            metadata.
+    """
+    def __init__(self, entries, wheelhouse, verify_hashes=False,
+                 metadata_cache=None):
+        self.entries = entries
+        self.wheelhouse = wheelhouse
+        self.verify_hashes = verify_hashes
+        self.metadata_cache = metadata_cache
+        self._archives = None
+        self._metadata = {}  # canonical name -> parsed headers
+
+    def get_distribution(self, name):
+        entry = self.entries.get(canonical_name(name))
+        if entry is None:
+            raise LockError("%s isn't pinned in the lock file" % name)
+        return entry
+
+    def as_requirement(self, entry):
+        # The same form as pkg_resources' Distribution.as_requirement(),
+        # which spells the name the way the package's own metadata does
+        name = self._headers(entry)['name'] or entry.name
+        return '%s==%s' % (safe_name(name), safe_version(entry.version))
+
+    def _headers(self, entry):
+        key = canonical_name(entry.name)
+        if key not in self._metadata:
+            path = self._archive(entry)
+            if path.endswith('.whl'):
+                try:
+                    headers = wheelmeta.read_wheel_metadata(
+                        path, self.metadata_cache)
+                except wheelmeta.WheelError as exc:
+                    raise LockError(str(exc))
+            else:
+                headers = wheelmeta.parse_headers(read_metadata(path))
+            self._metadata[key] = headers
+        return self._metadata[key]
+
+    def _archive(self, entry):
+        if self._archives is None:
+            self._archives = find_archives(self.wheelhouse)
+
+        key = (canonical_name(entry.name), safe_version(entry.version))
+        paths = self._archives.get(key)
+        if not paths:
+            raise LockError("No archive for %s==%s in %s" % (
+                entry.name, entry.version, self.wheelhouse))
+
+        if not self.verify_hashes:
+            return paths[0]
+        if not entry.hashes:
+            # pip --require-hashes refuses these too
+            raise LockError("%s==%s has no hashes in the lock file" % (
+                entry.name, entry.version))
+
+        algorithms = set()
+        for pin in entry.hashes:
+            algorithm = pin.partition(':')[0]
+            if algorithm not in HASH_ALGORITHMS:
+                raise LockError("Can't check %s==%s against %r: only %s"
+                                " hashes can be checked" % (
+                                    entry.name, entry.version, pin,
+                                    ', '.join(HASH_ALGORITHMS)))
+            algorithms.add(algorithm)
+
+        # Metadata files aren't what the hashes are of
+        for path in paths:
+            if not path.endswith('.metadata') and any(
+                    file_hash(path, algorithm) in entry.hashes
+                    for algorithm in sorted(algorithms)):
+                return path
+        raise LockError("No archive for %s==%s matches the lock file's"
+                        " hashes" % (entry.name, entry.version))
+
+    def requires(self, entry):
+        "List (requirement string, project name) for a distribution."
+        requires = []
+        for line in self._headers(entry)['requires']:
+            req = Requirement.parse(line)
+            if req.marker and not req.marker.evaluate({'extra': ''}):
+                continue
+            requires.append((str(req), req.project_name))
+        return requires
+
+
+def find_dependencies(requirements_file, wheelhouse, packages,
+                      verify_hashes=False, metadata_cache=None):
+    """
+    Walk the dependencies of some packages in a lock file.
+
+    Returns (top_nodes, nodes, edges), like probe.find_dependencies.
+    metadata_cache, a cache.JSONFileCache, is saved afterwards.
+    """
+    backend = LockBackend(read_requirements(requirements_file), wheelhouse,
+                          verify_hashes=verify_hashes,
+                          metadata_cache=metadata_cache)
+    deps = probe.find_dependencies(packages, backend=backend)
+    if metadata_cache is not None:
+        metadata_cache.save()
+    return deps
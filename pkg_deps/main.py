@@ -1,13 +1,30 @@
 #!/usr/bin/env python
+import contextlib
+import functools
+import json
 import logging
+import os
 import sys
 
 import click
 
-from . import collector
+from . import requirements
 from . import annotators
 from . import writers
 
+# collector, cache and query are imported where they're used, and
+# instrument only for --profile and --profile-stage, so that the branches
+# that don't need them start faster
+
+
+# The stages --profile times, in the order they run
+STAGES = ['load', 'diff', 'probe', 'combine', 'query', 'check_dag',
+          'dependencies_should_be_met', 'add_available_updates',
+          'should_pin_precisely', 'should_pin_all', 'write']
+
+# Checks whose results depend on more than the graph, such as an index's
+# latest versions, so earlier results can't be kept
+EXTERNAL_CHECKS = ['outdated']
 
 _log_levels = [
     logging.CRITICAL,
@@ -18,13 +35,137 @@ _log_levels = [
 ]
 
 
+def run_checks(graph, top_nodes, outdated=False, precise_pin=False,
+               should_pin_all=False, max_cycles=None, latest=None,
+               index=None, affected=None, recorder=None):
+    """
+    Run the requested checks on a graph, returning whether any failed.
+
+    If affected is given, the graph was already checked and then patched by
+    collector.update_graph: checks that were done before are only run again
+    if something changed, and then only on the affected nodes where that's
+    enough.  Checks that need more than the graph (EXTERNAL_CHECKS) are
+    always run again in full, and failures of checks that weren't asked
+    for this time are cleared.
+
+    latest and index are passed on to annotators.add_available_updates, to
+    check for outdated packages against a snapshot or an index instead of
+    running pip.  Each check is timed as a stage of recorder, an
+    instrument.Recorder, if given.
+    """
+    done = set()
+    if affected is not None:
+        requested = set(['cyclic dependency', 'unmet'])
+        for check, asked in [('outdated', outdated),
+                             ('not precise', precise_pin),
+                             ('missing pin', should_pin_all)]:
+            if asked:
+                requested.add(check)
+
+        done = set(annotators.graph_checks(graph))
+        for check in done - requested:
+            annotators.forget_check(graph, check)
+        done = (done & requested) - set(EXTERNAL_CHECKS)
+
+    if recorder is None:
+        recorder = _NoRecorder()
+
+    def wanted(check):
+        return check not in done or bool(affected)
+
+    def scope(check):
+        return affected if check in done else None
+
+    any_problems = False
+
+    if wanted('cyclic dependency'):
+        with recorder.stage('check_dag'):
+            any_problems |= annotators.check_dag(graph, max_cycles)
+
+    if wanted('unmet'):
+        with recorder.stage('dependencies_should_be_met'):
+            any_problems |= annotators.dependencies_should_be_met(
+                graph, scope('unmet'))
+
+    if outdated and wanted('outdated'):
+        from .index_client import IndexFetchError
+        with recorder.stage('add_available_updates'), \
+                _reported(IndexFetchError):
+            any_problems |= annotators.add_available_updates(
+                graph, scope('outdated'), latest, index)
+
+    if precise_pin and wanted('not precise'):
+        pin_scope = scope('not precise')
+        with recorder.stage('should_pin_precisely'):
+            any_problems |= annotators.should_pin_precisely(
+                graph, [node for node in top_nodes
+                        if pin_scope is None or node in pin_scope])
+
+    if should_pin_all and wanted('missing pin'):
+        with recorder.stage('should_pin_all'):
+            any_problems |= annotators.should_pin_all(graph, top_nodes)
+
+    if affected is not None:
+        # Problems found before, in parts of the graph that weren't redone
+        any_problems = annotators.any_failed(graph)
+
+    return any_problems
+
+
 @click.command()
 @click.argument('packages', nargs=-1, required=True)
 @click.option('--outdated', is_flag=True, help="Look for outdated packages.")
-@click.option('--python', '-p', type=click.Path(), default=None,
+@click.option('--outdated-snapshot', type=click.Path(exists=True),
+              default=None, metavar='SNAPSHOT',
+              help="Look for outdated packages by comparing with the latest"
+              " versions in SNAPSHOT, instead of asking pip.  SNAPSHOT is a"
+              " file made by pkg-deps-snapshot, or a directory of simple"
+              " index pages.  Works with --python.")
+@click.option('--index-url', default=None, metavar='URL',
+              help="Look for outdated packages by asking the PEP 503 / PEP"
+              " 691 simple index at URL directly, instead of asking pip."
+              "  Works with --python.")
+@click.option('--index-jobs', type=int, default=None,
+              help="How many pages to fetch from --index-url at a time."
+              "  Default: 8")
+@click.option('--python', '-p', type=click.Path(), multiple=True,
               help="Look in this Python installation (i.e. virtualenv) to find"
               " dependency information.  PATH is the path to the python"
-              " executable itself.  Incompatible with --outdated for now.""")
+              " executable itself.  Can be given more than once, to check"
+              " several installations at the same time."
+              "  Incompatible with --outdated (but not --outdated-snapshot"
+              " or --index-url) for now.")
+@click.option('--python-list', type=click.File('r'), default=None,
+              help="Read more --python paths from this file, one per line.")
+@click.option('--split-environments', is_flag=True,
+              help="With several --python installations, print each one's"
+              " results separately instead of combining them into one graph.")
+@click.option('--output-dir', type=click.Path(file_okay=False), default=None,
+              help="With --split-environments and --json, write each"
+              " installation's graph to its own file in this directory,"
+              " numbered in the order the --python installations were given"
+              " (1.json, 2.json, ...), instead of to stdout.  --load-json"
+              " can read them back.")
+@click.option('--jobs', '-j', type=int, default=None,
+              help="How many --python installations to probe, or --load-json"
+              " files to read, at a time.  Default: one --python"
+              " installation per CPU, one --load-json file.")
+@click.option('--probe-timeout', type=float, default=None, metavar='SECONDS',
+              help="Give up if looking in a --python installation takes"
+              " longer than this.")
+@click.option('--lockfile', type=click.Path(exists=True, dir_okay=False),
+              default=None,
+              help="Instead of looking in a Python installation, read pinned"
+              " versions from this requirements file (e.g. from"
+              " pip-compile), and their dependencies from the archives in"
+              " --wheelhouse.  PACKAGES must be pinned in it.")
+@click.option('--wheelhouse', type=click.Path(exists=True, file_okay=False),
+              default=None,
+              help="Directory of wheels, sdists or .whl.metadata files for"
+              " the packages in --lockfile, as from pip download.")
+@click.option('--verify-hashes', is_flag=True,
+              help="Check the --wheelhouse archives against the --lockfile"
+              " hashes.")
 @click.option('--human', 'format', flag_value='human', default=True,
               help="Print results in simple human-readable form. (DEFAULT)")
 @click.option('--dot', 'format', flag_value='dot',
@@ -35,10 +176,20 @@ _log_levels = [
               " Python tools or d3.js.")
 @click.option('--teamcity', 'format', flag_value='teamcity',
               help="Write any problems as TeamCity buildProblem messages.")
+@click.option('--compact', is_flag=True,
+              help="With --json, leave out the indentation.")
+@click.option('--gzip', 'compress', is_flag=True,
+              help="With --json, gzip the output.  --load-json can read it"
+              " back.")
 @click.option('--load-json', 'argument_type', flag_value='json',
               help="Treat arguments as JSON files instead of package names;"
               " combine them, DON'T RUN any checks, and print the"
               " resulting graph.")
+@click.option('--diff', 'argument_type', flag_value='diff',
+              help="Treat the two arguments, OLD and NEW, as JSON files"
+              " from earlier runs, and show what changed between them:"
+              " packages, versions, dependencies and failed checks.  Fails"
+              " if any checks newly fail.")
 @click.option('--packages', 'argument_type', flag_value='packages',
               default=True,
               help="Treat arguments as package names; find their"
@@ -50,12 +201,73 @@ _log_levels = [
 @click.option('--should-pin-all', is_flag=True,
               help="Annotate packages that the top-level package depends on"
               " indirectly but not directly.")
+@click.option('--max-cycles', type=int, default=None, metavar='N',
+              help="List up to N example cycles for each group of packages"
+              " that depend on each other circularly.")
+@click.option('--ancestors-of', multiple=True, metavar='PACKAGE',
+              help="Only show PACKAGE and the packages that depend on it,"
+              " directly or not.  Can be given more than once.")
+@click.option('--descendants-of', multiple=True, metavar='PACKAGE',
+              help="Only show PACKAGE and the packages it depends on,"
+              " directly or not.  Can be given more than once.")
+@click.option('--depth', type=int, default=None, metavar='N',
+              help="With --ancestors-of or --descendants-of, only go N"
+              " steps from PACKAGE.")
+@click.option('--paths', nargs=2, multiple=True, metavar='FROM TO',
+              help="Only show the packages on chains of dependencies from"
+              " FROM to TO.  Can be given more than once.")
+@click.option('--only-failed', is_flag=True,
+              help="Only show the packages and dependencies with failed"
+              " checks.  With this or the options above, checks are only"
+              " run on the packages shown where that gives the same"
+              " answer, and the exit status says whether any of them have"
+              " problems.")
+@click.option('--watch', is_flag=True,
+              help="After writing the results, keep watching the"
+              " installation for packages being installed, upgraded or"
+              " removed, and each time, re-check what changed and write the"
+              " results again.  Stop with Ctrl-C.")
+@click.option('--watch-interval', type=float, default=1.0,
+              metavar='SECONDS',
+              help="With --watch, how often to look for changes."
+              "  Default: 1")
+@click.option('--since', type=click.Path(exists=True, dir_okay=False),
+              default=None,
+              help="Start from a graph saved with --json by an earlier run,"
+              " and only look up and re-check the packages whose metadata"
+              " has changed since then.")
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help="Where to keep saved dependency information, to skip"
+              " looking it up again when the environment hasn't changed."
+              "  Default: $PKG_DEPS_CACHE_DIR or ~/.cache/pkg-deps")
+@click.option('--no-cache', is_flag=True,
+              help="Always look up dependency information from scratch.")
+@click.option('--cache-requirements', is_flag=True,
+              help="Also keep what was learned about each requirement"
+              " string (its parts, and which versions satisfy it) in the"
+              " cache directory, so later runs can check the same"
+              " requirements without importing pkg_resources.  Clear the"
+              " cache after upgrading setuptools.")
+@click.option('--profile', default=None, metavar='REPORT',
+              help="Time each stage of the run (finding dependencies, each"
+              " check, writing the output), and write the times, CPU and"
+              " memory used and graph sizes to REPORT as JSON ('-' for"
+              " stderr).  With --teamcity they're also written as"
+              " buildStatisticValue messages.")
+@click.option('--profile-stage', type=click.Choice(STAGES), default=None,
+              help="Run this stage under cProfile.  The profile is saved to"
+              " REPORT.prof with --profile, or else summed up on stderr.")
 @click.option('--verbose', '-v', count=True,
               help="Control the logging level.")
 @click.option('--quiet', '-q', count=True,
               help="Control the logging level.")
-def main(packages, outdated, python, format, argument_type, precise_pin,
-         should_pin_all, verbose, quiet):
+def main(packages, outdated, outdated_snapshot, index_url, index_jobs, python,
+         python_list, split_environments, output_dir, jobs, probe_timeout,
+         lockfile, wheelhouse, verify_hashes, format, compact, compress,
+         argument_type, precise_pin, should_pin_all, max_cycles,
+         ancestors_of, descendants_of, depth, paths, only_failed, watch,
+         watch_interval, since, cache_dir, no_cache, cache_requirements,
+         profile, profile_stage, verbose, quiet):
     """
     Search the package dependencies in a virtualenv for various problems.
 
@@ -71,44 +283,472 @@ def main(packages, outdated, python, format, argument_type, precise_pin,
         level=_log_levels[min(log_level_requested, len(_log_levels) - 1)])
 
     any_problems = False
+    recorder = _recorder(profile, profile_stage)
+
+    if argument_type == 'diff':
+        _finish(_show_diff(packages, format, compact, compress, recorder),
+                recorder, profile, format)
+
+    write = _writer(format, compact, compress)
+
+    if cache_requirements and no_cache:
+        raise click.UsageError("--cache-requirements doesn't work with"
+                               " --no-cache")
+
+    probe_cache = None
+    if not no_cache:
+        from . import cache
+        probe_cache = cache.DiskCache(_cache_path(cache_dir, 'probe'))
+        if cache_requirements:
+            requirements.use_cache(cache.JSONFileCache(
+                _cache_path(cache_dir, 'requirements.json')))
+
+    pythons = list(python)
+    if python_list:
+        pythons.extend(line.strip() for line in python_list
+                       if line.strip() and not line.startswith('#'))
+
+    latest, index = _latest_versions(outdated_snapshot, index_url,
+                                     index_jobs, cache_dir, no_cache)
+    if latest is not None or index is not None:
+        outdated = True
+
+    check_options = dict(outdated=outdated, precise_pin=precise_pin,
+                         should_pin_all=should_pin_all, max_cycles=max_cycles,
+                         latest=latest, index=index, recorder=recorder)
+
+    query_options = None
+    if ancestors_of or descendants_of or paths:
+        query_options = dict(ancestors_of=ancestors_of,
+                             descendants_of=descendants_of, depth=depth,
+                             paths=paths)
+    if depth is not None and not (ancestors_of or descendants_of):
+        click.secho("--depth only works with --ancestors-of or"
+                    " --descendants-of", fg='red')
+        sys.exit(1)
+    show = functools.partial(
+        _show, write=write, recorder=recorder, query_options=query_options,
+        only_failed=only_failed, checked=argument_type == 'packages')
 
+    if split_environments and not pythons:
+        raise click.UsageError("--split-environments needs at least one"
+                               " --python")
+    if split_environments and format == 'json' and not output_dir:
+        # Several JSON documents in a row wouldn't be JSON any more
+        raise click.UsageError("--split-environments with --json needs"
+                               " --output-dir")
+    if output_dir and not (split_environments and format == 'json'):
+        raise click.UsageError("--output-dir only works with"
+                               " --split-environments and --json")
+
+    if watch and (argument_type != 'packages' or lockfile
+                  or len(pythons) > 1 or split_environments):
+        click.secho("--watch only works with one Python installation",
+                    fg='red')
+        sys.exit(1)
+
+    selected = None
     if argument_type == 'packages':
-        if python:
-            if outdated:
-                click.secho("--outdated is incompatible with --target-python"
-                            " for now - sorry!", fg='red')
-                # We could use the target python to run
-                # "python -m pip list --outdated"
-                # TODO!
+        if pythons and outdated and latest is None and index is None:
+            click.secho("--outdated is incompatible with --target-python"
+                        " for now - sorry!", fg='red')
+            # We could use the target python to run
+            # "python -m pip list --outdated"
+            # TODO!
+            sys.exit(1)
+
+        if len(pythons) > 1 or split_environments:
+            if since:
+                click.secho("--since only works with one --python",
+                            fg='red')
                 sys.exit(1)
-            graph, good_package_names = collector.collect_dependencies_elsewhere(
-                python, packages)
+
+            results = _collect_many(
+                pythons, packages, check_options, recorder,
+                cache=probe_cache, jobs=jobs, timeout=probe_timeout)
+
+            if split_environments:
+                for num, (graph, names, graph_problems) in enumerate(
+                        results, 1):
+                    if output_dir:
+                        write = _environment_writer(output_dir, num,
+                                                    compact, compress)
+                    any_problems |= show(graph, graph_problems, write=write)
+                _finish(any_problems, recorder, profile, format)
+
+            any_problems = any(problems for graph, names, problems
+                               in results)
+            from . import collector
+            with recorder.stage('combine') as record:
+                graph = collector.combine_graphs(
+                    [graph for graph, names, problems in results])
+                recorder.graph_size(record, graph)
+
         else:
-            graph, good_package_names = collector.collect_dependencies_here(
-                packages)
+            python = pythons[0] if pythons else None
+            if lockfile and (python or since or not wheelhouse):
+                click.secho("--lockfile needs --wheelhouse, and doesn't"
+                            " work with --python or --since", fg='red')
+                sys.exit(1)
 
-        any_problems |= annotators.check_dag(graph)
+            # The checks that don't change the graph's shape work on a
+            # CompactGraph, which the json and dot writers can write
+            # directly, so networkx needn't even be imported
+            compact_graph = format in ('json', 'dot') and not (
+                outdated or precise_pin or should_pin_all or query_options
+                or only_failed or watch)
 
-        any_problems |= annotators.dependencies_should_be_met(graph)
+            # --watch asks the same probe again after each change
+            server = None
+            if watch:
+                from . import collector
+                server = collector.ProbeServer(python or sys.executable)
 
-        if outdated:
-            any_problems |= annotators.add_available_updates(graph)
+            metadata_cache = None
+            if lockfile and not no_cache:
+                from . import cache
+                metadata_cache = cache.JSONFileCache(
+                    _cache_path(cache_dir, 'metadata.json'))
 
-        if precise_pin:
-            any_problems |= annotators.should_pin_precisely(graph,
-                                                            good_package_names)
+            graph, good_package_names, affected = _collect(
+                packages, recorder, python=python, server=server,
+                since=since, lockfile=lockfile, wheelhouse=wheelhouse,
+                verify_hashes=verify_hashes, cache=probe_cache,
+                metadata_cache=metadata_cache, timeout=probe_timeout,
+                compact=compact_graph)
 
-        if should_pin_all:
-            any_problems |= annotators.should_pin_all(graph,
-                                                      good_package_names)
+            if query_options and not watch:
+                # --watch checks the whole graph, so that later changes
+                # can be checked on their own
+                graph, good_package_names, affected, selected = \
+                    _check_region(graph, good_package_names, affected,
+                                  query_options, should_pin_all, recorder)
+
+            any_problems |= run_checks(
+                graph, good_package_names, affected=affected,
+                **check_options)
 
     else:
         assert argument_type == 'json'
-        graph = collector.combine_json_graphs(packages)
+        from . import collector
+        with recorder.stage('load') as record:
+            graph = collector.combine_json_graphs(
+                packages, jobs=jobs,
+                compact=format in ('json', 'dot') and len(packages) == 1
+                and not (query_options or only_failed))
+            recorder.graph_size(record, graph)
+
+    any_problems = show(graph, any_problems, selected=selected)
+
+    if watch:
+        any_problems = _watch(server, graph, packages, any_problems, show,
+                              check_options, interval=watch_interval)
+
+    _finish(any_problems, recorder, profile, format)
+
+
+def _watch(prober, graph, packages, any_problems, show, check_options,
+           **options):
+    """
+    For --watch: check and show the graph again as it changes, until Ctrl-C.
 
-    getattr(writers, format)(graph)
+    show is called like _show, and check_options are for run_checks.  The
+    prober is closed at the end, and options are passed on to watch.watch.
+    Returns whether the last results shown had problems.
+    """
+    from . import watch
+
+    results = [any_problems]
+
+    def rerun(graph, top_nodes, affected):
+        results.append(show(graph, run_checks(
+            graph, top_nodes, affected=affected, **check_options)))
+
+    try:
+        watch.watch(prober, graph, packages, rerun, **options)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        prober.close()
+    return results[-1]
+
+
+def _writer(format, compact=False, compress=False):
+    "The function in writers to write with, for the output options."
+    if compact or compress:
+        if format != 'json':
+            click.secho("--compact and --gzip only work with --json",
+                        fg='red')
+            sys.exit(1)
+        return functools.partial(writers.json, compact=compact,
+                                 compress=compress)
+    return getattr(writers, format)
+
+
+def _environment_writer(output_dir, num, compact=False, compress=False):
+    "For --output-dir: write the num'th environment's graph to its own file."
+    path = os.path.join(output_dir, '%d.json%s' % (num,
+                                                   '.gz' if compress else ''))
+
+    def write(graph):
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        with open(path, 'wb' if compress else 'w') as out:
+            writers.json(graph, compact=compact, compress=compress, out=out)
+    return write
+
+
+def _cache_path(cache_dir, name):
+    from . import cache
+    return os.path.join(cache_dir or cache.default_cache_dir(), name)
+
+
+def _latest_versions(snapshot_path, index_url, index_jobs, cache_dir,
+                     no_cache):
+    """
+    Where to find the latest versions, for --outdated-snapshot or --index-url.
+
+    Returns (latest, index) for annotators.add_available_updates; both are
+    None if neither option was given, so pip is asked instead.
+    """
+    latest = None
+    if snapshot_path:
+        from . import snapshot
+        latest = snapshot.load_latest_versions(snapshot_path)
+
+    index = None
+    if index_url:
+        from . import cache
+        from . import index_client
+        index = index_client.IndexClient(
+            index_url, jobs=index_jobs or index_client.DEFAULT_JOBS,
+            cache=None if no_cache else cache.DiskCache(
+                _cache_path(cache_dir, 'index')))
+
+    return latest, index
+
+
+def _collect_many(pythons, packages, check_options, recorder, cache=None,
+                  jobs=None, timeout=None):
+    """
+    Find the dependencies in several Python installations, and check them.
+
+    cache, jobs and timeout are passed on to
+    collector.collect_dependencies_many, and check_options to run_checks.
+
+    Returns a list of (graph, top nodes, whether any checks failed), one
+    per python.
+    """
+    from . import collector
+    with recorder.stage('probe') as record:
+        results = collector.collect_dependencies_many(
+            pythons, packages, cache=cache, jobs=jobs, timeout=timeout)
+        record['nodes'] = sum(len(graph) for graph, names in results)
+        record['edges'] = sum(graph.number_of_edges()
+                              for graph, names in results)
+
+    return [(graph, top_nodes, run_checks(graph, top_nodes, **check_options))
+            for graph, top_nodes in results]
+
+
+def _collect(packages, recorder, python=None, server=None, since=None,
+             lockfile=None, wheelhouse=None, verify_hashes=False, cache=None,
+             metadata_cache=None, timeout=None, compact=False):
+    """
+    Find the dependencies of packages in one place, as the 'probe' stage.
+
+    That's lockfile and wheelhouse if given, or else server (a
+    collector.ProbeServer), python, or this Python.  With since, a graph
+    saved by an earlier run, only what's changed since then is looked up.
+    The other parameters are passed on to the collector functions that
+    take them.
+
+    Returns (graph, top nodes, affected); affected is None without since,
+    see collector.update_graph.
+    """
+    from . import collector
+    previous = None
+    if since:
+        with recorder.stage('load') as record:
+            previous = collector.combine_json_graphs([since])
+            recorder.graph_size(record, previous)
+
+    affected = None
+    with recorder.stage('probe') as record:
+        if lockfile:
+            from .lockfile import LockError
+            with _reported(LockError):
+                graph, top_nodes = collector.collect_dependencies_from_lock(
+                    lockfile, wheelhouse, packages,
+                    verify_hashes=verify_hashes,
+                    metadata_cache=metadata_cache, compact=compact)
+        elif server is not None:
+            if previous is not None:
+                graph, top_nodes, affected = \
+                    collector.update_dependencies_with(
+                        server, previous, packages)
+            else:
+                graph, top_nodes = collector.collect_dependencies_with(
+                    server, packages, cache=cache)
+        elif previous is not None:
+            if python:
+                graph, top_nodes, affected = \
+                    collector.update_dependencies_elsewhere(
+                        python, previous, packages)
+            else:
+                graph, top_nodes, affected = \
+                    collector.update_dependencies_here(previous, packages)
+        elif python:
+            graph, top_nodes = collector.collect_dependencies_elsewhere(
+                python, packages, cache=cache, timeout=timeout,
+                compact=compact)
+        else:
+            graph, top_nodes = collector.collect_dependencies_here(
+                packages, cache=cache, compact=compact)
+        recorder.graph_size(record, graph)
+
+    return graph, top_nodes, affected
+
+
+def _select(graph, query_options, recorder):
+    "The nodes the query options ask for, and the region to check."
+    from . import query
+    with recorder.stage('query') as record:
+        try:
+            selected, region = query.select(graph, **query_options)
+        except ValueError as exc:
+            click.secho(str(exc), fg='red')
+            sys.exit(1)
+        record['nodes'] = len(selected)
+    return selected, region
+
+
+def _check_region(graph, top_nodes, affected, query_options, should_pin_all,
+                  recorder):
+    """
+    Cut a graph down to the part the query options ask about, to check.
+
+    Only that part needs checking for the results that are shown, except
+    that should_pin_all needs all of the top packages' descendants.
+
+    Returns (graph, top_nodes, affected, selected nodes).
+    """
+    from . import query
+    selected, region = _select(graph, query_options, recorder)
+    if should_pin_all:
+        region = region | query.descendants(
+            graph, [node for node in top_nodes if node in region])
+
+    graph = query.subgraph(graph, region)
+    top_nodes = [node for node in top_nodes if node in region]
+    if affected is not None:
+        affected = set(affected) & region
+    return graph, top_nodes, affected, selected
+
+
+def _show(graph, any_problems, write, recorder, query_options=None,
+          only_failed=False, checked=True, selected=None):
+    """
+    Write what was asked for, returning whether it has problems.
+
+    With query_options (for query.select) or only_failed, only part of the
+    graph is written, and if the graph was checked, that part alone decides
+    whether there are problems.  selected can be given if the query has
+    already been run.
+    """
+    if query_options or only_failed:
+        from . import query
+
+        if query_options and selected is None:
+            selected = _select(graph, query_options, recorder)[0]
+        graph = query.extract(graph, selected, only_failed)
+        if checked:
+            any_problems = annotators.any_failed(graph)
+
+    with recorder.stage('write'):
+        write(graph)
+    return any_problems
+
+
+def _show_diff(filenames, format, compact, compress, recorder):
+    "For --diff: write what changed, returning whether anything broke."
+    from . import diff
+
+    if len(filenames) != 2:
+        click.secho("--diff needs two files, OLD and NEW", fg='red')
+        sys.exit(1)
+    if format == 'dot' or compress:
+        click.secho("--diff doesn't work with --dot or --gzip", fg='red')
+        sys.exit(1)
+    if compact and format != 'json':
+        click.secho("--compact and --gzip only work with --json", fg='red')
+        sys.exit(1)
+
+    with recorder.stage('diff'):
+        changes = diff.diff_files(*filenames)
+
+    with recorder.stage('write'):
+        if format == 'json':
+            writers.json_diff(changes, compact=compact)
+        else:
+            getattr(writers, format + '_diff')(changes)
+    return bool(changes['new_failures'])
+
+
+def _recorder(profile, profile_stage):
+    """
+    The instrument.Recorder for --profile and --profile-stage, or a
+    _NoRecorder without them.
+    """
+    if not (profile or profile_stage):
+        return _NoRecorder()
+
+    from . import instrument
+    profile_output = None
+    if profile and profile != '-' and profile_stage:
+        profile_output = profile + '.prof'
+    return instrument.Recorder(profile_stage, profile_output)
+
+
+@contextlib.contextmanager
+def _reported(*errors):
+    "Turn errors into click.ClickExceptions: a message, not a traceback."
+    try:
+        yield
+    except errors as exc:
+        raise click.ClickException(str(exc))
+
+
+class _NoRecorder(object):
+    "Stands in for an instrument.Recorder when nothing is measured."
+    @contextlib.contextmanager
+    def stage(self, name):
+        yield {}
+
+    def graph_size(self, record, graph):
+        pass
+
+
+def _finish(any_problems, recorder, profile, format):
+    "Save what's worth keeping, write the --profile report, and exit."
+    requirements.save_cache()
+    if profile:
+        _write_report(recorder.report(), profile, format)
     sys.exit(any_problems)
 
 
+def _write_report(report, path, format):
+    "Write an instrument.Recorder report for --profile."
+    if path == '-':
+        json.dump(report, sys.stderr, indent=2, sort_keys=True)
+        sys.stderr.write('\n')
+    else:
+        with open(path, 'w') as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+
+    if format == 'teamcity':
+        writers.teamcity_statistics(report)
+
+
 if __name__ == '__main__':
     main()
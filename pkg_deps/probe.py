@@ -2,47 +2,586 @@
 Probe script to find dependencies.
 
 This file is meant to be run in a virtualenv that we're interested in,
-and it should only depend on the presence of setuptools.
+and it should only depend on the presence of setuptools (or, for the faster
+MetadataBackend, the ``packaging`` library or pip).
 
 To avoid duplication, it is also used directly as a library.  But it
 must not import anything else from pkg_deps, because it's used as
 a top-level Python script.
+
+``pkg_resources`` is only imported when dependencies are actually looked up,
+because importing it scans the whole environment.
 """
+import io
+import json
+import os
+import re
+import sys
+
+
+METADATA_SUFFIXES = ('.dist-info', '.egg-info', '.egg')
+METADATA_FILES = ('METADATA', 'PKG-INFO', 'requires.txt')
+
+
+def project_key(name):
+    "Same as pkg_resources.safe_name(name).lower(), without pkg_resources."
+    return re.sub('[^A-Za-z0-9.]+', '-', name).lower()
+
+
+def split_metadata_name(entry):
+    """
+    Split a metadata directory name into (name, version or None).
+
+    For example 'Foo_Bar-1.0-py3.7.egg-info' gives ('Foo_Bar', '1.0').
+    """
+    parts = os.path.splitext(os.path.basename(entry))[0].split('-')
+    return parts[0], (parts[1] if len(parts) > 1 else None)
+
+
+def metadata_entries(paths=None):
+    """
+    Find the metadata directories of installed distributions.
+
+    Yields (project key, path) pairs for each ``*.dist-info``, ``*.egg-info``
+    and ``*.egg`` entry directly inside the directories on ``paths`` (default
+    ``sys.path``) in path order, following ``*.egg-link`` files where they
+    appear, the way pkg_resources does.
+    """
+    if paths is None:
+        paths = sys.path
+
+    seen = set()
+
+    def entries(path):
+        path = os.path.abspath(path or os.curdir)
+        if path in seen or not os.path.isdir(path):
+            return
+        seen.add(path)
+
+        for entry in sorted(os.listdir(path)):
+            full = os.path.join(path, entry)
+            if entry.endswith(METADATA_SUFFIXES):
+                yield project_key(split_metadata_name(entry)[0]), full
+            elif entry.endswith('.egg-link'):
+                with open(full) as link:
+                    target = link.readline().strip()
+                for found in entries(os.path.join(path, target)):
+                    yield found
+
+    for path in paths:
+        if path.endswith('.egg'):
+            # An egg directly on the path
+            name = split_metadata_name(path)[0]
+            yield project_key(name), os.path.abspath(path)
+        else:
+            for found in entries(path):
+                yield found
+
+
+def metadata_stamps(paths=None):
+    """
+    Return a dict of project key -> a string that changes with its metadata.
+
+    The stamp is made of the metadata directory's path and the modification
+    times of it and its main metadata files, so it changes when a
+    distribution is installed, upgraded, or rewritten in place.  It's cheap:
+    nothing is read except directory listings and file stats.
+    """
+    stamps = {}
+    for key, path in metadata_entries(paths):
+        mtimes = [os.stat(path).st_mtime]
+        for filename in METADATA_FILES:
+            try:
+                mtimes.append(os.stat(os.path.join(path, filename)).st_mtime)
+            except OSError:
+                pass
+
+        stamp = '%s@%s' % (path, max(mtimes))
+        if key in stamps:
+            stamp = stamps[key] + ';' + stamp
+        stamps[key] = stamp
+
+    return stamps
+
+
+def find_dependencies(packages, known=(), backend=None):
+    """
+    Walk the dependencies of some packages.
+
+    Parameters:
+        packages - names of the packages to start from.
+        known - optional collection of nodes (like 'lxml==3.2.4') whose
+            dependencies are already known; edges to them are reported,
+            but they aren't walked any further or included in the nodes.
+        backend - how to look up distributions; by default a
+            MetadataBackend if this Python can use one, otherwise a
+            PkgResourcesBackend.  Both give the same results.
+
+    Returns:
+        (top_nodes, nodes, edges): the nodes for ``packages``, in order;
+        all the nodes found; and (source, requirement, target) tuples.
+    """
+    if backend is not None:
+        return _walk(backend, packages, known)
 
-import pkg_resources
+    return Prober().find_dependencies(packages, known)
 
 
-def find_dependencies(packages):
+class Prober(object):
+    """
+    Find dependencies with the best available backend.
+
+    The backends remember what they've looked up, so a Prober can answer
+    repeated queries quickly, until reset() is called because the
+    environment has changed.
+    """
+    def __init__(self):
+        self._metadata = None
+        self._pkg_resources = None
+        self._fresh = False
+
+    def reset(self):
+        if self._metadata:
+            self._metadata = None
+        self._pkg_resources = None
+        self._fresh = True
+
+    def find_dependencies(self, packages, known=()):
+        if self._metadata is None:
+            try:
+                self._metadata = MetadataBackend()
+            except Unsupported:
+                self._metadata = False
+
+        if self._metadata:
+            try:
+                return _walk(self._metadata, packages, known)
+            except Unsupported:
+                pass
+
+        if self._pkg_resources is None:
+            self._pkg_resources = PkgResourcesBackend(fresh=self._fresh)
+        return _walk(self._pkg_resources, packages, known)
+
+
+def _walk(backend, packages, known):
+    """
+    Walk the dependency graph with an explicit worklist.
+
+    Each project is looked up once, however many requirements name it, and
+    each distribution's requirements are read once.  There's no recursion,
+    so long dependency chains are fine.
+    """
+    known = set(known)
     nodes = set()  # Set of strings, the packages 'as requirements'
     edges = set()  # Set of tuples, (src, req, dest)
+    resolved = {}  # project key -> (as_req, dist)
+    todo = []  # (as_req, dist) for new nodes whose requirements are unread
 
-    def find_deps(lib_name):
-        dist = pkg_resources.get_distribution(lib_name)
-        as_req = str(dist.as_requirement())  # e.g. 'lxml==3.2.4'
+    def visit(lib_name):
+        key = project_key(lib_name)
+        if key not in resolved:
+            dist = backend.get_distribution(lib_name)
+            # e.g. 'lxml==3.2.4'
+            resolved[key] = (backend.as_requirement(dist), dist)
 
-        if as_req not in nodes:
+        as_req, dist = resolved[key]
+        if as_req not in nodes and as_req not in known:
             nodes.add(as_req)
+            todo.append((as_req, dist))
+
+        return as_req
 
-            for dependency in dist.requires():
-                dep_name = find_deps(dependency.project_name)
+    top_nodes = []
+    for pkg in packages:
+        top_nodes.append(visit(pkg))
 
+        while todo:
+            as_req, dist = todo.pop()
+            for requirement, dep_project in backend.requires(dist):
                 edges.add((
                     as_req,
-                    str(dependency),
-                    dep_name,
+                    requirement,
+                    visit(dep_project),
                 ))
 
-        return as_req
+    return (top_nodes, list(nodes), list(edges))
 
-    top_nodes = [find_deps(pkg) for pkg in packages]
 
-    return (top_nodes, list(nodes), list(edges))
+class Unsupported(Exception):
+    "The MetadataBackend can't handle something; use pkg_resources instead."
+
+
+class PkgResourcesBackend(object):
+    """
+    Look up distributions with pkg_resources.
+
+    This works with any setuptools, but importing pkg_resources builds a
+    working set of the whole environment first.  With fresh=True, another
+    working set is built, instead of using the one from when pkg_resources
+    was imported.
+    """
+    def __init__(self, fresh=False):
+        import pkg_resources
+        self.pkg_resources = pkg_resources
+        self.working_set = pkg_resources.working_set
+        if fresh:
+            self.working_set = pkg_resources.WorkingSet()
+
+    def get_distribution(self, name):
+        # Same as pkg_resources.get_distribution, but with our working set
+        requirement = self.pkg_resources.Requirement.parse(name)
+        return (self.working_set.find(requirement) or
+                self.working_set.require(str(requirement))[0])
+
+    def as_requirement(self, dist):
+        return str(dist.as_requirement())
+
+    def requires(self, dist):
+        "List (requirement string, project name) for a distribution."
+        return [(str(dependency), dependency.project_name)
+                for dependency in dist.requires()]
+
+
+class MetadataBackend(object):
+    """
+    Look up distributions by reading their metadata files directly.
+
+    Distributions are found the same way pkg_resources finds them, but only
+    directory listings are read up front, and only the metadata of the
+    distributions that are actually asked for is parsed.  This needs the
+    ``packaging`` library (pip's copy will do) to parse requirements and
+    evaluate markers.  Raises Unsupported for anything unusual, such as eggs
+    or distributions it can't find.
+    """
+    def __init__(self, paths=None):
+        try:
+            from packaging import markers, requirements, version
+        except ImportError:
+            try:
+                from pip._vendor.packaging import (
+                    markers, requirements, version)
+            except ImportError:
+                raise Unsupported("packaging is not available")
+
+        self.markers = markers
+        self.requirements = requirements
+        self.version = version
+        self.paths = paths
+        self._entries = None
+
+    def _find_entries(self):
+        "Map project keys to metadata paths, preferring the first found."
+        entries = {}
+        for key, path in metadata_entries(self.paths):
+            current = entries.get(key)
+            if current is None or (
+                    os.path.dirname(current) == os.path.dirname(path) and
+                    self._sort_version(path) > self._sort_version(current)):
+                # Within one directory, pkg_resources takes the newest
+                entries[key] = path
+
+        # Also look up names normalized per PEP 503 as a fallback
+        normalized = {}
+        for key, path in entries.items():
+            normalized.setdefault(re.sub('[-_.]+', '-', key), path)
+
+        return entries, normalized
+
+    def _sort_version(self, path):
+        version = split_metadata_name(path)[1]
+        try:
+            return (1, self.version.Version(version or ''))
+        except self.version.InvalidVersion:
+            return (0, version or '')
+
+    def get_distribution(self, name):
+        if self._entries is None:
+            self._entries = self._find_entries()
+
+        entries, normalized = self._entries
+        key = project_key(name)
+        path = entries.get(key) or normalized.get(re.sub('[-_.]+', '-', key))
+        if path is None:
+            raise Unsupported("Distribution not found: %s" % name)
+        if path.endswith('.egg'):
+            raise Unsupported("Eggs aren't supported: %s" % path)
+
+        return path
+
+    def _read(self, path, *names):
+        filename = os.path.join(path, *names)
+        if not os.path.isfile(filename):
+            return None
+        with io.open(filename, encoding='utf-8', errors='replace') as f:
+            return f.read()
+
+    def _headers(self, path):
+        import email.parser
+
+        if os.path.isfile(path):
+            # Old-style single-file PKG-INFO
+            return email.parser.Parser().parsestr(self._read(path))
+
+        text = self._read(path, 'METADATA') or self._read(path, 'PKG-INFO')
+        return email.parser.Parser().parsestr(text or '')
+
+    def as_requirement(self, path):
+        name, version = split_metadata_name(path)
+        if version is None:
+            version = self._headers(path)['Version']
+
+        # Same as pkg_resources.safe_version
+        try:
+            return '%s==%s' % (re.sub('[^A-Za-z0-9.]+', '-', name),
+                               self.version.Version(version))
+        except self.version.InvalidVersion:
+            version = re.sub('[^A-Za-z0-9.]+', '-', version.replace(' ', '.'))
+            return '%s===%s' % (re.sub('[^A-Za-z0-9.]+', '-', name), version)
+
+    def requires(self, path):
+        "List (requirement string, project name) for a distribution."
+        if path.endswith('.dist-info'):
+            lines = self._headers(path).get_all('Requires-Dist') or []
+            reqs = [req for req in map(self._parse, lines)
+                    if not req.marker or req.marker.evaluate({'extra': ''})]
+        elif os.path.isdir(path):
+            reqs = [self._parse(line)
+                    for line in self._base_requires_txt(path)]
+        else:
+            reqs = []
+
+        return [(str(req), re.sub('[^A-Za-z0-9.]+', '-', req.name))
+                for req in reqs]
+
+    def _parse(self, line):
+        req = self.requirements.Requirement(line.strip())
+        # pkg_resources.Requirement normalizes extras this way
+        req.extras = set(re.sub('[^A-Za-z0-9.-]+', '_', extra).lower()
+                         for extra in req.extras)
+        return req
+
+    def _base_requires_txt(self, path):
+        "Requirement lines in requires.txt that don't belong to an extra."
+        lines = []
+        section = None
+        for line in (self._read(path, 'requires.txt') or '').splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('['):
+                section = line.strip('[]')
+                continue
+
+            if section is None:
+                lines.append(line)
+            elif section.startswith(':') and self._marker_ok(section[1:]):
+                lines.append(line)
+
+        return lines
+
+    def _marker_ok(self, marker):
+        try:
+            return self.markers.Marker(marker).evaluate()
+        except Exception:
+            # pkg_resources drops requirements with invalid markers, too
+            return False
+
+
+# Wire format
+#
+# When run as a script, the probe writes its results to stdout as
+# newline-delimited JSON, so the parent can parse them while they're still
+# being written, one small record at a time.  The first line is a header,
+# {"pkg-deps-probe": WIRE_VERSION, "kind": "dependencies", "stamps" or
+# "stamped"}, and the last is ["end"], so a truncated stream can be
+# detected.  "stamped" is dependencies along with the stamps from just
+# before they were looked up.  In between:
+#
+#   ["s", "text"]               define the next string id (0, 1, 2...)
+#   ["n", node]                 a node
+#   ["e", source, req, target]  an edge
+#   ["t", node]                 the next top node
+#   ["m", "key", "stamp"]       a metadata stamp
+#   ["error", "message"]        the request failed (only when serving)
+#
+# Nodes, requirements and targets are string ids: each distinct string is
+# sent once, however many edges use it.  Everything is ASCII (non-ASCII is
+# escaped by JSON), so the encoding of the pipe doesn't matter.
+
+WIRE_VERSION = 2
+
+
+class WireWriter(object):
+    def __init__(self, stream, kind):
+        self.stream = stream
+        self.strings = {}
+        self.write({'pkg-deps-probe': WIRE_VERSION, 'kind': kind})
+
+    def write(self, record):
+        self.stream.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def intern(self, text):
+        if text not in self.strings:
+            self.strings[text] = len(self.strings)
+            self.write(['s', text])
+        return self.strings[text]
+
+    def end(self):
+        self.write(['end'])
+        self.stream.flush()
+
+
+def write_dependencies(deps, stream, stamps=None):
+    top_nodes, nodes, edges = deps
+    out = WireWriter(stream, 'dependencies' if stamps is None else 'stamped')
+    for key, stamp in (stamps or {}).items():
+        out.write(['m', key, stamp])
+    for node in nodes:
+        out.write(['n', out.intern(node)])
+    for source, requirement, target in edges:
+        out.write(['e', out.intern(source), out.intern(requirement),
+                   out.intern(target)])
+    for node in top_nodes:
+        out.write(['t', out.intern(node)])
+    out.end()
+
+
+def write_stamps(stamps, stream):
+    out = WireWriter(stream, 'stamps')
+    for key, stamp in stamps.items():
+        out.write(['m', key, stamp])
+    out.end()
+
+
+def write_error(message, stream):
+    out = WireWriter(stream, 'error')
+    out.write(['error', message])
+    out.end()
+
+
+def read_wire(header, lines):
+    """
+    Parse the records that follow a header line.
+
+    Parameters:
+        header - the header, already decoded from JSON.
+        lines - an iterable of the remaining lines (str or bytes).
+
+    Returns:
+        (top_nodes, nodes, edges), a stamps dict, or both as a pair,
+        depending on the kind.
+    """
+    if header.get('pkg-deps-probe') != WIRE_VERSION:
+        raise ValueError("Unknown probe output version: %r" % header)
+
+    strings = []
+    top_nodes, nodes, edges = [], [], []
+    stamps = {}
+    error = None
+    for line in lines:
+        if not isinstance(line, str):
+            line = line.decode('ascii')
+        record = json.loads(line)
+        kind = record[0]
+        if kind == 's':
+            strings.append(record[1])
+        elif kind == 'n':
+            nodes.append(strings[record[1]])
+        elif kind == 'e':
+            edges.append((strings[record[1]], strings[record[2]],
+                          strings[record[3]]))
+        elif kind == 't':
+            top_nodes.append(strings[record[1]])
+        elif kind == 'm':
+            stamps[record[1]] = record[2]
+        elif kind == 'error':
+            error = record[1]
+        elif kind == 'end':
+            break
+        else:
+            raise ValueError("Unknown probe output record: %r" % line)
+    else:
+        raise ValueError("Probe output ended early")
+
+    if error is not None:
+        raise RuntimeError("Probe failed: %s" % error)
+    if header.get('kind') == 'stamps':
+        return stamps
+    if header.get('kind') == 'stamped':
+        return (top_nodes, nodes, edges), stamps
+    return (top_nodes, nodes, edges)
+
+
+def serve(requests, stream):
+    """
+    Answer requests for dependencies until there aren't any more.
+
+    Each request is a line of JSON: {"stamps": true} for the environment's
+    metadata stamps, or {"packages": [...], "known": [...]} for
+    find_dependencies.  Each answer is written to stream in the wire
+    format.  What's been looked up is kept between requests, and forgotten
+    when the metadata stamps change.
+    """
+    prober = Prober()
+    results = {}
+    last_stamps = None
+
+    while True:
+        line = requests.readline()
+        if not line:
+            break
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+
+        stamps = metadata_stamps()
+        if stamps != last_stamps:
+            if last_stamps is not None:
+                prober.reset()
+                results.clear()
+            last_stamps = stamps
+
+        request = json.loads(line)
+        if request.get('stamps'):
+            write_stamps(stamps, stream)
+            continue
+
+        key = (tuple(request['packages']), frozenset(request.get('known', ())))
+        if len(results) > 100:
+            results.clear()
+
+        try:
+            if key not in results:
+                results[key] = prober.find_dependencies(*key)
+        except Exception as exc:
+            write_error('%s: %s' % (type(exc).__name__, exc), stream)
+        else:
+            write_dependencies(results[key], stream)
 
 
 if __name__ == '__main__':
-    import sys
-    import pprint
     args = list(sys.argv[1:])
-    deps = find_dependencies(args)
-    # TODO: handle package names with non-ascii chars
-    pprint.pprint(deps)
+    if args == ['--serve']:
+        try:
+            serve(getattr(sys.stdin, 'buffer', sys.stdin), sys.stdout)
+        except KeyboardInterrupt:
+            # Ctrl-C reaches the whole process group, but it's up to
+            # whoever started the server to stop
+            pass
+    elif args == ['--stamps']:
+        write_stamps(metadata_stamps(), sys.stdout)
+    elif args and args[0] == '--stamped':
+        # Saves starting another Python just for the stamps
+        stamps = metadata_stamps()
+        write_dependencies(find_dependencies(args[1:]), sys.stdout, stamps)
+    else:
+        known = ()
+        if args and args[0] == '--known':
+            # One known node per line on stdin, in UTF-8
+            args.pop(0)
+            stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+            known = [line.decode('utf-8').strip() for line in stdin
+                     if line.strip()]
+        write_dependencies(find_dependencies(args, known), sys.stdout)
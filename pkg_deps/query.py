@@ -0,0 +1,171 @@
+"""
+Pick out the part of a dependency graph that a question is about.
+
+A whole environment's graph can have thousands of packages, too many to
+read or draw.  These functions select the packages around a few of
+interest: what they depend on, what depends on them, or what connects two
+of them.  They only walk outwards from those packages, so the cost goes
+with the size of the answer rather than the size of the graph.
+
+main runs the checks on just the selected part, where that gives the same
+answer as checking the whole graph.  Every edge on a dependency cycle
+through a selected package lies inside the region ``select`` returns, so
+even the cycle check can be limited to it.
+
+Packages are named by requirement strings, as elsewhere, and found through
+the graph's index (``index.node_index``).
+"""
+from pkg_deps import annotators as ann
+
+
+def find_nodes(graph, requirements):
+    "The node for each requirement string; ValueError if one isn't found."
+    return [ann.find_matching_node(graph, req) for req in requirements]
+
+
+def descendants(graph, sources, depth=None):
+    """
+    The sources and the nodes they depend on, directly or not.
+
+    If depth is given, only nodes up to that many steps away are included.
+    """
+    return _walk(graph.successors_iter, sources, depth)
+
+
+def ancestors(graph, sources, depth=None):
+    """
+    The sources and the nodes that depend on them, directly or not.
+
+    If depth is given, only nodes up to that many steps away are included.
+    """
+    return _walk(graph.predecessors_iter, sources, depth)
+
+
+def paths_between(graph, source, target):
+    """
+    The nodes on any chain of dependencies from source to target.
+
+    Both ends are included; if target can't be reached, nothing is.
+    """
+    below = descendants(graph, [source])
+    if target not in below:
+        return set()
+
+    return _walk(_within(graph.predecessors_iter, below), [target], None)
+
+
+def _within(neighbors, nodes):
+    "neighbors, but only the ones in nodes."
+    return lambda node: (other for other in neighbors(node)
+                         if other in nodes)
+
+
+def _walk(neighbors, sources, depth):
+    "Breadth-first search from sources, up to depth steps if given."
+    seen = set(sources)
+    frontier = list(seen)
+    steps = 0
+    while frontier and (depth is None or steps < depth):
+        steps += 1
+        found = []
+        for node in frontier:
+            for neighbor in neighbors(node):
+                if neighbor not in seen:
+                    seen.add(neighbor)
+                    found.append(neighbor)
+        frontier = found
+    return seen
+
+
+def select(graph, ancestors_of=(), descendants_of=(), depth=None,
+           paths=()):
+    """
+    Select the nodes a query asks about.
+
+    The parts of the query are combined: a node is selected if any of them
+    selects it.
+
+    Parameters:
+        graph - a networkx.DiGraph.
+        ancestors_of - requirement strings; selects those packages and the
+            ones that depend on them.
+        descendants_of - requirement strings; selects those packages and
+            the ones they depend on.
+        depth - optional limit on how many steps from ancestors_of and
+            descendants_of to go.
+        paths - (source, target) pairs of requirement strings; selects the
+            packages on the chains of dependencies from source to target.
+
+    Returns:
+        (selected, region).  Both are sets of nodes.  region also holds
+        the rest of every dependency cycle through a selected node, which
+        only matters with depth; without it the two are the same.
+
+    Raises ValueError if a requirement string doesn't match any package.
+    """
+    up = find_nodes(graph, ancestors_of)
+    down = find_nodes(graph, descendants_of)
+    ends = [find_nodes(graph, pair) for pair in paths]
+
+    selected = ancestors(graph, up, depth) | descendants(graph, down, depth)
+    for source, target in ends:
+        selected |= paths_between(graph, source, target)
+
+    region = selected
+    if depth is not None:
+        # The rest of a cycle through a selected node may be further away,
+        # but it's all reachable the same way, and leads back to the node
+        below = descendants(graph, down)
+        above = ancestors(graph, up)
+        region = selected | \
+            _walk(_within(graph.predecessors_iter, below),
+                  selected & below, None) | \
+            _walk(_within(graph.successors_iter, above),
+                  selected & above, None)
+    return selected, region
+
+
+def subgraph(graph, nodes):
+    """
+    The part of graph with just these nodes and the edges between them.
+
+    As with networkx's subgraph, the attribute dicts are shared with graph,
+    so annotations made on it show up on graph too.
+    """
+    return graph.subgraph(nodes)
+
+
+def failed_only(graph):
+    """
+    The part of graph with failed checks.
+
+    That's the nodes that failed a check, and the edges that did, along
+    with the nodes at their ends.
+    """
+    result = graph.__class__()
+    result.graph = graph.graph
+    for node, data in graph.nodes_iter(data=True):
+        if ann.failed_checks(data):
+            result.add_node(node, data)
+    for source, dest, data in graph.edges_iter(data=True):
+        if ann.failed_checks(data):
+            for node in (source, dest):
+                if node not in result:
+                    result.add_node(node, graph.node[node])
+            result.add_edge(source, dest, data)
+    return result
+
+
+def extract(graph, nodes=None, only_failed=False):
+    """
+    Cut a checked graph down to what's to be written.
+
+    Parameters:
+        nodes - optional nodes to keep, from select.
+        only_failed - keep only the nodes and edges with failed checks.
+    """
+    if nodes is not None:
+        graph = subgraph(graph, nodes)
+    if only_failed:
+        graph = failed_only(graph)
+    return graph
@@ -0,0 +1,231 @@
+"""
+Parsed requirements, shared by everything that looks at a graph's edges.
+
+Edges keep their requirements as strings, so graphs stay easy to write out
+and read back, but parsing one with ``Requirement.parse`` is slow, and the
+same strings come up again and again: every annotator and writer that looks
+at requirements used to parse them all over.  ``parse`` instead looks them
+up in a bounded intern table, so each string is parsed once (when
+``collector.dependencies_to_graph`` adds its edge), and the checks after
+that just look it up.
+
+Importing pkg_resources takes a good part of a short run, so it's put off
+until something really needs parsing.  Plain project names, which any
+version satisfies, never do.  And with ``use_cache``, what was parsed, and
+which versions each requirement was found to allow, is saved for later
+runs, so checking a graph seen before needn't parse anything.
+
+The table keeps two generations of entries: when the current one fills
+up, it becomes the old one, and the old one is dropped.  Anything used in
+the meantime is moved back into the current generation, so what's dropped
+is what hasn't been used for a while.
+"""
+import re
+
+from pkg_deps.probe import project_key
+
+
+MAX_REQUIREMENTS = 100000
+
+# Bump this when what's saved by RequirementTable.save changes
+SAVED_FORMAT = 1
+
+# A requirement that's just a project name, which any version satisfies
+_BARE_NAME = re.compile(r'^[A-Za-z0-9]([A-Za-z0-9._-]*[A-Za-z0-9])?$')
+
+
+class ParsedRequirement(object):
+    """
+    A requirement string, parsed.
+
+    Besides the parts of the requirement, this remembers which versions it
+    has already been checked against, since the specifiers' comparisons
+    aren't cheap either.
+
+    Parameters:
+        text - the requirement string.
+        saved - optional fields from an earlier saved(), to use instead of
+            parsing text.
+    """
+    __slots__ = ('text', '_requirement', 'key', 'project_name', 'pinned',
+                 '_matches')
+
+    def __init__(self, text, saved=None):
+        self.text = text
+        self._requirement = None
+
+        if saved is not None:
+            self.key, self.project_name, self.pinned, matches = saved
+            self._matches = None if matches is None else dict(matches)
+        elif _BARE_NAME.match(text):
+            self.key = project_key(text)
+            self.project_name = re.sub('[^A-Za-z0-9.]+', '-', text)
+            self.pinned = False
+            self._matches = None
+        else:
+            req = self.requirement
+            self.key = req.key
+            self.project_name = req.project_name
+            self.pinned = any(op in ('==', '===') for op, version in req.specs)
+            self._matches = {} if req.specs else None
+
+    @property
+    def requirement(self):
+        "The pkg_resources Requirement."
+        if self._requirement is None:
+            from pkg_resources import Requirement
+            self._requirement = Requirement.parse(self.text)
+        return self._requirement
+
+    @property
+    def specifier(self):
+        return self.requirement.specifier
+
+    @property
+    def extras(self):
+        return self.requirement.extras
+
+    @property
+    def marker(self):
+        return self.requirement.marker
+
+    @property
+    def unconstrained(self):
+        "Is every version of the project good enough?"
+        return self._matches is None
+
+    def satisfied_by(self, version, parse=None):
+        """
+        Does a version, as a string, satisfy this requirement?
+
+        The answer is remembered by the string.  parse turns the string
+        into a parsed version if it's needed, for callers that already
+        keep them (default: parse_version).
+        """
+        matches = self._matches
+        if matches is None:
+            return True  # no specifiers, so anything does
+        try:
+            return matches[version]
+        except KeyError:
+            match = matches[version] = (parse or parse_version)(version) \
+                in self
+            return match
+
+    def __contains__(self, version):
+        "Does a version, parsed or as a string, satisfy this requirement?"
+        if self._matches is None:
+            return True
+        if isinstance(version, (type(u''), type(b''))):
+            version = parse_version(version)
+        return self.specifier.contains(version, prereleases=True)
+
+    def saved(self):
+        "The fields to save, to make this again without parsing."
+        return [self.key, self.project_name, self.pinned, self._matches]
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return 'ParsedRequirement(%r)' % self.text
+
+
+class RequirementTable(object):
+    """
+    A bounded table of requirement string -> ParsedRequirement.
+
+    Parameters:
+        max_size - how many to keep.
+        cache - optional cache.JSONFileCache to look in before parsing a
+            string, and to save to.
+    """
+    def __init__(self, max_size=MAX_REQUIREMENTS, cache=None):
+        self.max_size = max_size
+        self.cache = cache
+        self._current = {}
+        self._old = {}
+
+    def __len__(self):
+        return len(self._current) + len(self._old)
+
+    def parse(self, text):
+        try:
+            return self._current[text]
+        except KeyError:
+            pass
+
+        parsed = self._old.pop(text, None)
+        if parsed is None:
+            saved = None
+            if self.cache is not None:
+                saved = self.cache.get(_cache_key(text))
+            parsed = ParsedRequirement(text, saved)
+
+        if len(self._current) >= self.max_size // 2:
+            self._old = self._current
+            self._current = {}
+        self._current[text] = parsed
+        return parsed
+
+    def save(self):
+        "Save what's new in the table to its cache."
+        if self.cache is None:
+            return
+
+        for table in (self._old, self._current):
+            for text, parsed in table.items():
+                key = _cache_key(text)
+                fields = parsed.saved()
+                if self.cache.get(key) != fields:
+                    self.cache.put(key, fields)
+        self.cache.save()
+
+    def clear(self):
+        self._current = {}
+        self._old = {}
+
+
+def _cache_key(text):
+    return '%d %s' % (SAVED_FORMAT, text)
+
+
+_table = RequirementTable()
+
+
+def use_cache(cache):
+    """
+    Keep parsed requirements in a cache.JSONFileCache between runs.
+
+    Call save_cache() to save them.
+    """
+    _table.cache = cache
+
+
+def save_cache():
+    _table.save()
+
+
+def parse(requirement):
+    """
+    Return the ParsedRequirement for a requirement.
+
+    requirement may be a string, a ParsedRequirement, or a pkg_resources
+    Requirement.
+    """
+    if isinstance(requirement, ParsedRequirement):
+        return requirement
+    if not isinstance(requirement, (type(u''), type(b''))):
+        requirement = str(requirement)
+    return _table.parse(requirement)
+
+
+def is_pinned(requirement):
+    "Does a requirement pin an exact version (== or ===)?"
+    return parse(requirement).pinned
+
+
+def parse_version(version):
+    "pkg_resources.parse_version, which is only imported when it's needed."
+    from pkg_resources import parse_version
+    return parse_version(version)
@@ -0,0 +1,228 @@
+"""
+Find the latest versions of packages without asking pip or the network.
+
+A snapshot is either a directory of "simple" index pages, as written by
+index mirroring tools (one ``<project>/index.html`` or ``index.json`` per
+project, PEP 503 or PEP 691), or a compact JSON file of the latest version
+of each project, built from such a directory by ``pkg-deps-snapshot``.
+Either one is read into a dict of canonical project name -> latest version,
+which ``annotators.add_available_updates`` compares the graph against.
+"""
+import json
+import logging
+import os
+import re
+
+import click
+
+try:
+    from html.parser import HTMLParser
+except ImportError:  # Python 2
+    from HTMLParser import HTMLParser
+
+
+logger = logging.getLogger(__name__)
+
+
+SNAPSHOT_FORMAT = 1
+
+# What index mirrors call the pages for one project
+PAGE_NAMES = ('index.json', 'index.v1_json', 'index.html', 'index.v1_html')
+
+ARCHIVE_SUFFIXES = ('.tar.gz', '.tar.bz2', '.tar.xz', '.tgz', '.zip',
+                    '.tar')
+
+
+def canonical_name(name):
+    "Normalize a project name as PEP 503 does, like index URLs are."
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+class _LinkParser(HTMLParser):
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.files = []
+        self._yanked = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self._yanked = 'data-yanked' in dict(attrs)
+            self.files.append(['', self._yanked])
+
+    def handle_data(self, data):
+        if self._yanked is not None:
+            self.files[-1][0] += data
+
+    def handle_endtag(self, tag):
+        if tag == 'a':
+            self._yanked = None
+
+
+def parse_html_page(text):
+    """
+    Read a PEP 503 project page.
+
+    Returns a list of (filename, yanked) pairs.
+    """
+    parser = _LinkParser()
+    parser.feed(text)
+    parser.close()
+    return [(filename.strip(), yanked) for filename, yanked in parser.files]
+
+
+def parse_json_page(data):
+    """
+    Read a PEP 691 project page, already decoded from JSON.
+
+    Returns a list of (filename, yanked) pairs.
+    """
+    return [(info['filename'], bool(info.get('yanked')))
+            for info in data.get('files', ())]
+
+
+def file_version(project, filename):
+    "The version in a distribution's filename, or None if it can't tell."
+    if filename.endswith(('.whl', '.egg')):
+        parts = filename.split('-')
+        return parts[1] if len(parts) > 2 else None
+
+    for suffix in ARCHIVE_SUFFIXES:
+        if filename.endswith(suffix):
+            base = filename[:-len(suffix)]
+            break
+    else:
+        return None
+
+    # The project name can contain dashes too, so find where it ends
+    key = canonical_name(project)
+    for pos, char in enumerate(base):
+        if char == '-' and canonical_name(base[:pos]) == key:
+            return base[pos + 1:]
+    return None
+
+
+def latest_version(project, files):
+    """
+    The latest version among a project's files, or None.
+
+    Yanked files are skipped, and so are pre-releases unless there's
+    nothing else, as pip does.
+    """
+    from pkg_resources import parse_version
+
+    versions = set()
+    for filename, yanked in files:
+        version = file_version(project, filename)
+        if version and not yanked:
+            versions.add(version)
+
+    parsed = sorted((parse_version(version), version) for version in versions)
+    final = [pair for pair in parsed if not pair[0].is_prerelease]
+    if final or parsed:
+        return (final or parsed)[-1][1]
+    return None
+
+
+def read_page(path):
+    """
+    Read one project page, HTML or JSON.
+
+    Returns (project name or None, list of (filename, yanked) pairs).
+    """
+    with open(path, 'rb') as page:
+        text = page.read().decode('utf-8')
+
+    return parse_page(text, path.endswith(('json', 'JSON')))
+
+
+def parse_page(text, is_json):
+    """
+    Read a project page's text, HTML or JSON.
+
+    Returns (project name or None, list of (filename, yanked) pairs).
+    """
+    if is_json:
+        data = json.loads(text)
+        return data.get('name'), parse_json_page(data)
+    return None, parse_html_page(text)
+
+
+def _project_pages(directory):
+    for entry in sorted(os.listdir(directory)):
+        path = os.path.join(directory, entry)
+        if os.path.isdir(path):
+            for page in PAGE_NAMES:
+                if os.path.isfile(os.path.join(path, page)):
+                    yield entry, os.path.join(path, page)
+                    break
+        elif entry.endswith(('.html', '.json')):
+            yield os.path.splitext(entry)[0], path
+
+
+def read_snapshot_dir(directory):
+    "Find the latest version of each project in a directory of pages."
+    latest = {}
+    for project, path in _project_pages(directory):
+        try:
+            name, files = read_page(path)
+        except (IOError, OSError, ValueError) as exc:
+            logger.warning("Skipping index page %s: %s", path, exc)
+            continue
+
+        name = name or project
+        version = latest_version(name, files)
+        if version:
+            latest[canonical_name(name)] = version
+    return latest
+
+
+def load_latest_versions(path):
+    """
+    Load a snapshot, either a directory of pages or a snapshot file.
+
+    Returns a dict of canonical project name -> latest version string.
+    """
+    if os.path.isdir(path):
+        return read_snapshot_dir(path)
+
+    with open(path, 'r') as snapshot:
+        data = json.load(snapshot)
+    if data.get('pkg-deps-snapshot') != SNAPSHOT_FORMAT:
+        raise ValueError("%s isn't a pkg-deps snapshot file" % path)
+    return data['latest']
+
+
+def write_snapshot(latest, path):
+    "Save a dict of latest versions as a snapshot file."
+    data = {'pkg-deps-snapshot': SNAPSHOT_FORMAT, 'latest': latest}
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as out:
+        json.dump(data, out, sort_keys=True, separators=(',', ':'))
+    os.rename(tmp_path, path)
+
+
+@click.command()
+@click.argument('sources', nargs=-1, required=True,
+                type=click.Path(exists=True, file_okay=False))
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              required=True, help="The snapshot file to write.")
+@click.option('--update', is_flag=True,
+              help="Start from the versions already in --output, and only"
+              " replace those found in SOURCES.")
+def main(sources, output, update):
+    """
+    Build a snapshot file of the latest version of each project, from
+    directories of simple index pages, for pkg-deps --outdated-snapshot.
+    """
+    latest = {}
+    if update and os.path.exists(output):
+        latest = load_latest_versions(output)
+    for source in sources:
+        latest.update(read_snapshot_dir(source))
+
+    write_snapshot(latest, output)
+    click.echo("Wrote %d projects to %s" % (len(latest), output))
+
+
+if __name__ == '__main__':
+    main()
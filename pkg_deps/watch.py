@@ -0,0 +1,101 @@
+"""
+Keep checking an environment while it changes.
+
+``watch`` polls the environment's metadata stamps
+(``probe.metadata_stamps``).  Getting them only lists the directories on
+the path and stats a few files in each, so it's cheap enough to do every
+second.  When the stamps change, the graph is patched with
+``collector.update_graph``, which only looks up the distributions whose
+stamps changed, and the caller checks the affected nodes again.  The probe
+is a ``collector.ProbeServer``, so none of this starts a new Python.
+
+There's no portable way to be told when a directory changes without
+another dependency, so this polls.  A pip install touches its distributions
+one after another, over a second or more, so a change is only acted on once
+the stamps have stayed the same for DEBOUNCE seconds.  That way each
+install is handled once, not once per distribution.
+"""
+import logging
+import time
+
+from pkg_deps import collector
+
+
+logger = logging.getLogger(__name__)
+
+
+INTERVAL = 1.0
+
+DEBOUNCE = 0.5
+
+
+def changes(stamps, last, interval=INTERVAL, debounce=DEBOUNCE,
+            sleep=time.sleep):
+    """
+    Yield the environment's stamps each time they change, forever.
+
+    Parameters:
+        stamps - a function returning the current stamps, like
+            ProbeServer.stamps.
+        last - the stamps to compare the first poll with.
+        interval - seconds between polls.
+        debounce - seconds the stamps have to stay the same before a change
+            is yielded.
+        sleep - the function to wait with.
+    """
+    while True:
+        sleep(interval)
+        current = stamps()
+        if current == last:
+            continue
+
+        while True:
+            sleep(debounce)
+            settled = stamps()
+            if settled == current:
+                break
+            current = settled
+
+        last = current
+        yield current
+
+
+def watch(prober, graph, packages, rerun, interval=INTERVAL,
+          debounce=DEBOUNCE, sleep=time.sleep):
+    """
+    Keep a graph up to date with an environment, until interrupted.
+
+    Parameters:
+        prober - a collector.ProbeServer (or other probe) for the
+            environment the graph was made from.
+        graph - the graph, already checked.  It's updated in place.
+        packages - the names of the top-level packages.
+        rerun - called as rerun(graph, top_nodes, affected) after each
+            update, to check the affected nodes again and show the results;
+            see collector.update_graph.
+        interval, debounce, sleep - passed on to changes().
+
+    If the probe fails to look up a change (with RuntimeError, as
+    ProbeServer does), that's logged and watching goes on.
+    """
+    def update(stamps):
+        started = time.time()
+        try:
+            updated, top_nodes, affected = collector.update_graph(
+                graph, packages, stamps, prober.find_dependencies)
+        except RuntimeError as exc:
+            # Perhaps caught in the middle of an install; the graph is left
+            # as it was, so the next change picks this one up too
+            logger.error("Couldn't look up the changes: %s", exc)
+            return
+        rerun(updated, top_nodes, affected)
+        logger.info("Environment changed: re-checked %d packages in %.3fs",
+                    len(affected), time.time() - started)
+
+    stamps = prober.stamps()
+    if collector.stale_nodes(graph, stamps):
+        # It changed while the graph was being checked
+        update(stamps)
+
+    for stamps in changes(prober.stamps, stamps, interval, debounce, sleep):
+        update(stamps)
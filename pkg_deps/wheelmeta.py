@@ -0,0 +1,208 @@
+"""
+Read the metadata of wheels quickly, and remember it between runs.
+
+A wheel is a zip file, and its METADATA is one small entry in it.  Instead
+of opening it with zipfile, which reads and decodes the whole central
+directory into objects, the file is memory-mapped, the end-of-central-
+directory record is found at the end, and the directory is scanned for just
+the ``*.dist-info/METADATA`` entry, which is then read (and inflated) on its
+own.  Nothing else in the archive is touched.
+
+The central directory also has the entry's CRC-32 and size, so those, along
+with the entry's name, identify its contents without reading them.  The
+parsed fields are kept in a cache.JSONFileCache under that key, so a later
+run that sees the same METADATA, in the same or a rebuilt wheel, skips
+reading and parsing it.
+"""
+import mmap
+import struct
+import zlib
+
+from pkg_deps import cache as _cache
+
+
+# Bump this when the parsed fields change
+METADATA_FORMAT = 1
+
+_EOCD = b'PK\x05\x06'
+_ZIP64_LOCATOR = b'PK\x06\x07'
+_ZIP64_EOCD = b'PK\x06\x06'
+_CENTRAL = b'PK\x01\x02'
+_LOCAL = b'PK\x03\x04'
+
+_MAX_COMMENT = 0xffff
+
+
+class WheelError(Exception):
+    pass
+
+
+def parse_headers(text):
+    """
+    Pick the fields pkg-deps needs out of a METADATA file.
+
+    Returns a dict with 'name', 'version' and 'requires', the list of
+    Requires-Dist values.  Only the headers are read, not the description.
+    """
+    fields = {'name': None, 'version': None, 'requires': []}
+    last = None
+    for line in text.splitlines():
+        if not line:
+            break
+        if line[0] in ' \t':
+            # A continuation of the last header
+            if last == 'requires':
+                fields['requires'][-1] += ' ' + line.strip()
+            continue
+
+        header, _, value = line.partition(':')
+        header = header.lower()
+        value = value.strip()
+        last = None
+        if header == 'name':
+            fields['name'] = value
+        elif header == 'version':
+            fields['version'] = value
+        elif header == 'requires-dist':
+            fields['requires'].append(value)
+            last = 'requires'
+    return fields
+
+
+def _find_central_directory(data):
+    "Return (offset, size) of a zip's central directory."
+    start = max(0, len(data) - 22 - _MAX_COMMENT)
+    eocd = data.rfind(_EOCD, start)
+    if eocd < 0:
+        raise WheelError("not a zip file")
+
+    size, offset = struct.unpack('<II', data[eocd + 12:eocd + 20])
+    if offset == 0xffffffff or size == 0xffffffff:
+        locator = eocd - 20
+        if data[locator:locator + 4] != _ZIP64_LOCATOR:
+            raise WheelError("bad zip64 end of central directory")
+        zip64, = struct.unpack('<Q', data[locator + 8:locator + 16])
+        if data[zip64:zip64 + 4] != _ZIP64_EOCD:
+            raise WheelError("bad zip64 end of central directory")
+        size, offset = struct.unpack('<QQ', data[zip64 + 40:zip64 + 56])
+
+    return offset, size
+
+
+def _zip64_offset(extra, sizes_missing):
+    "The local header offset from a zip64 extra field."
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, length = struct.unpack('<HH', extra[pos:pos + 4])
+        if tag == 1:
+            # Uncompressed and compressed sizes come first, if they overflowed
+            skip = 8 * sizes_missing
+            return struct.unpack('<Q', extra[pos + 4 + skip:
+                                             pos + 12 + skip])[0]
+        pos += 4 + length
+    raise WheelError("missing zip64 extra field")
+
+
+def find_metadata_entry(data):
+    """
+    Find a wheel's METADATA in its central directory.
+
+    Returns (name, method, crc, compressed size, size, local header offset).
+    """
+    offset, size = _find_central_directory(data)
+    end = offset + size
+
+    # Rather than decode every entry, look for the name, and check the
+    # header just before it really is its header
+    suffix = b'.dist-info/METADATA'
+    found = data.find(suffix, offset, end)
+    while found >= 0:
+        pos = data.rfind(_CENTRAL, offset, found)
+        if pos >= 0:
+            entry = _central_entry(data, pos, suffix)
+            if entry is not None and \
+                    pos + 46 + len(entry[0]) == found + len(suffix):
+                return entry
+        found = data.find(suffix, found + 1, end)
+
+    # Nothing so simple; go through the entries in order
+    pos = offset
+    while pos < end:
+        if data[pos:pos + 4] != _CENTRAL:
+            raise WheelError("bad central directory")
+        entry = _central_entry(data, pos, suffix)
+        if entry is not None:
+            return entry
+        name_len, extra_len, comment_len = struct.unpack(
+            '<HHH', data[pos + 28:pos + 34])
+        pos += 46 + name_len + extra_len + comment_len
+
+    raise WheelError("no .dist-info/METADATA")
+
+
+def _central_entry(data, pos, suffix):
+    "The entry at pos in the central directory, if it's the METADATA."
+    (method, crc, compressed, uncompressed, name_len, extra_len
+     ) = struct.unpack('<H4xIIIHH', data[pos + 10:pos + 32])
+    name = data[pos + 46:pos + 46 + name_len]
+    if not name.endswith(suffix) or name.count(b'/') != 1:
+        return None
+
+    local, = struct.unpack('<I', data[pos + 42:pos + 46])
+    if local == 0xffffffff:
+        extra = data[pos + 46 + name_len:pos + 46 + name_len + extra_len]
+        local = _zip64_offset(extra, (uncompressed == 0xffffffff) +
+                              (compressed == 0xffffffff))
+    return (name.decode('utf-8'), method, crc, compressed, uncompressed,
+            local)
+
+
+def _read_entry(data, method, crc, compressed, local):
+    if data[local:local + 4] != _LOCAL:
+        raise WheelError("bad local file header")
+    name_len, extra_len = struct.unpack('<HH', data[local + 26:local + 30])
+    start = local + 30 + name_len + extra_len
+    raw = data[start:start + compressed]
+
+    if method == 0:
+        content = raw
+    elif method == 8:
+        content = zlib.decompress(raw, -15)
+    else:
+        raise WheelError("unsupported compression method %d" % method)
+
+    if zlib.crc32(content) & 0xffffffff != crc:
+        raise WheelError("bad CRC-32 for METADATA")
+    return content
+
+
+def read_wheel_metadata(path, cache=None):
+    """
+    Read the fields in a wheel's METADATA, as from parse_headers.
+
+    Parameters:
+        path - the .whl file.
+        cache - optional cache.JSONFileCache.
+    """
+    with open(path, 'rb') as wheel:
+        try:
+            data = mmap.mmap(wheel.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            raise WheelError("%s is empty" % path)
+
+        try:
+            name, method, crc, compressed, size, local = \
+                find_metadata_entry(data)
+
+            key = _cache.make_key(METADATA_FORMAT, name, crc, size)
+            fields = cache.get(key) if cache is not None else None
+            if fields is None:
+                content = _read_entry(data, method, crc, compressed, local)
+                fields = parse_headers(content.decode('utf-8', 'replace'))
+                if cache is not None:
+                    cache.put(key, fields)
+            return fields
+        except WheelError as exc:
+            raise WheelError("%s: %s" % (path, exc))
+        finally:
+            data.close()
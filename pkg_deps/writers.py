@@ -1,11 +1,13 @@
 from __future__ import print_function
+import gzip
 import json as _json
 import click
-import networkx as nx
-from networkx.readwrite.json_graph import node_link
 import sys
 
 from . import annotators as ann
+from .compact import CompactGraph
+from .index import split_node
+from .requirements import is_pinned
 
 
 def human_format_problems(obj, prefix_if_any='- '):
@@ -18,17 +20,26 @@ def human_format_problems(obj, prefix_if_any='- '):
         for check, message in problems.items())
 
 
+def format_cycle(nodes):
+    return ' -> '.join(list(nodes) + [nodes[0]])
+
+
 def human(graph):
+    graph = _networkx(graph)
     print("# Dependency tree starting with these packages:")
     print("# ", "   ".join(graph.graph['query packages']))
     print("# Checked for:", ", ".join(ann.graph_checks(graph)))
+    environments = graph.graph.get('environments', [])
+    if environments:
+        print("# Environments:", ", ".join(environments))
 
-    packages = sorted(graph)
-    try:
-        packages = nx.topological_sort(graph, packages)
-    except nx.exception.NetworkXUnfeasible:
-        # Can happen if graph is cyclic; we've already warned by now.
-        pass
+    cycles = graph.graph.get('cycles')
+    if cycles:
+        print("# Example dependency cycles:")
+        for cycle in cycles:
+            click.echo(click.style("#   " + format_cycle(cycle), fg='red'))
+
+    packages = _topological_order(graph)
 
     for pkg in packages:
         node_data = graph.node[pkg]
@@ -36,6 +47,9 @@ def human(graph):
         problems = click.style(human_format_problems(node_data))
         if problems:
             problems = click.style(problems, bold=True)
+        if len(environments) > 1:
+            problems = "[in %s] %s" % (
+                ", ".join(node_data.get('environments', [])), problems)
         click.echo(" ".join([pkg, problems]))
 
         for src, dest, data in sorted(graph.out_edges([pkg], data=True)):
@@ -43,8 +57,15 @@ def human(graph):
             if problems:
                 problems = click.style(problems, fg='red')
 
-            click.echo('  depends on %s (%s is installed) %s' % (
-                data['requirement'], dest, problems))
+            click.echo('  depends on %s (%s) %s' % (
+                data['requirement'], _installed(dest), problems))
+
+
+def _installed(node):
+    "Which version of a dependency is installed, if any."
+    if split_node(node)[1]:
+        return '%s is installed' % node
+    return 'not installed'
 
 
 _dot_colors = {
@@ -56,70 +77,240 @@ _dot_colors = {
 }
 
 
-def dot(graph):
-    # Set colors and labels for edges
-    for source, dest, data in graph.edges_iter(data=True):
-        for check in ann.failed_checks(data):
-            if check in _dot_colors:
-                data['color'] = _dot_colors[check]
-                break
+def dot(graph, out=None):
+    """
+    Write the graph in Graphviz's DOT language.
 
-        if '==' in data['requirement']:
-            data['style'] = 'dashed'
+    Edges are colored by their first failed check and nodes by their last
+    one, pinned requirements are dashed, and the query packages are boxes.
+    Each node and edge is written as it's reached, straight from the graph
+    (networkx or compact), which isn't changed.
 
-        data['label'] = data['requirement']
+    Parameters:
+        out - a file to write to; default is stdout.
+    """
+    if out is None:
+        out = sys.stdout
 
-        problems = ", ".join(ann.failed_checks(data).keys())
-        if problems:
-            data['label'] += ' (%s)' % problems
+    title = "Dependency tree rooted at square node(s)\nChecked for: " + \
+        ', '.join(ann.graph_checks(graph))
+    out.write('strict digraph {\n')
+    out.write('label=%s;\nrankdir=LR;\n' % _dot_quote(title))
+
+    query_packages = set(graph.graph['query packages'])
+    nodes, edges = _nodes_and_edges(graph)
 
-    # Set colors and labels for nodes
-    for package in graph.node:
-        data = graph.node[package]
+    for package, data in nodes:
+        attrs = [('label', _dot_label(data.get('as_requirement', package),
+                                      data))]
+        color = None
+        for check in ann.failed_checks(data):
+            color = _dot_colors.get(check, color)
+        if color:
+            attrs.append(('color', color))
+        if package in query_packages:
+            attrs.append(('shape', 'box'))
+        out.write('%s [%s];\n' % (_dot_quote(package), _dot_attrs(attrs)))
+
+    for source, dest, data in edges:
+        attrs = [('label', _dot_label(data['requirement'], data))]
         for check in ann.failed_checks(data):
             if check in _dot_colors:
-                data['color'] = _dot_colors[check]
-
-        data['label'] = data['as_requirement']
-
-        problems = ", ".join(ann.failed_checks(data).keys())
-        if problems:
-            data['label'] += ' (%s)' % problems
-
-        if package in graph.graph['query packages']:
-            data['shape'] = 'box'
-
-    dot = nx.nx_pydot.to_pydot(graph)
+                attrs.append(('color', _dot_colors[check]))
+                break
+        if is_pinned(data['requirement']):
+            attrs.append(('style', 'dashed'))
+        out.write('%s -> %s [%s];\n' % (
+            _dot_quote(source), _dot_quote(dest), _dot_attrs(attrs)))
 
-    # Set graph title (only works after conversion)
-    dot.set_label(" ".join((
-        "Dependency tree rooted at square node(s)"
-        "\nChecked for:",
-        ', '.join(ann.graph_checks(graph)),
-    )))
-    dot.set_rankdir('LR')
-    print(dot.to_string())
+    out.write('}\n')
+    out.flush()
+
+
+def _dot_label(text, data):
+    problems = ", ".join(ann.failed_checks(data).keys())
+    if problems:
+        return '%s (%s)' % (text, problems)
+    return text
+
+
+def _dot_quote(text):
+    "A DOT quoted string, with quotes, backslashes and newlines escaped."
+    return '"%s"' % text.replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _dot_attrs(attrs):
+    return ', '.join('%s=%s' % (name, _dot_quote(value))
+                     for name, value in attrs)
+
+
+def _nodes_and_edges(graph):
+    "(node, data) and (source, dest, data) iterators, for either graph type."
+    if not isinstance(graph, CompactGraph):
+        return graph.nodes_iter(data=True), graph.edges_iter(data=True)
+
+    def nodes():
+        for num, key in enumerate(graph.keys):
+            yield key, graph.nodes[num].to_dict() if graph.nodes else {}
+
+    def edges():
+        keys = graph.keys
+        for source in range(len(graph)):
+            for pos in range(graph.offsets[source],
+                             graph.offsets[source + 1]):
+                record = graph.edge_records[pos]
+                yield keys[source], keys[graph.targets[pos]], \
+                    record.to_dict()
+
+    return nodes(), edges()
+
+
+JSON_CHUNK_SIZE = 1000
+
+
+def json(graph, compact=False, compress=False, out=None):
+    """
+    Write the graph in node-link JSON form, as node_link_data would.
+
+    Nodes and links are written straight from the graph a chunk at a time,
+    instead of building the whole structure in memory first.
+
+    Parameters:
+        compact - leave out the indentation and spaces.
+        compress - gzip the output.
+        out - a file to write to; default is stdout.
+    """
+    if out is None:
+        out = getattr(sys.stdout, 'buffer', sys.stdout) if compress \
+            else sys.stdout
+
+    if compress:
+        with gzip.GzipFile(fileobj=out, mode='wb') as gzipped:
+            for chunk in _json_chunks(graph, compact):
+                gzipped.write(chunk.encode('utf-8'))
+    else:
+        for chunk in _json_chunks(graph, compact):
+            out.write(chunk)
+    out.flush()
+
+
+def _json_chunks(graph, compact):
+    if compact:
+        dumps = _json.JSONEncoder(separators=(',', ':')).encode
+        start, sep, end = '[', ',', ']'
+    else:
+        encode = _json.JSONEncoder(indent=2).encode
+
+        def dumps(obj):
+            return encode(obj).replace('\n', '\n    ')
+
+        start, sep, end = '[\n    ', ',\n    ', '\n  ]'
+
+    header = [('directed', True),
+              ('multigraph', False),
+              ('graph', graph.graph)]
+    if compact:
+        yield '{' + ''.join('%s:%s,' % (dumps(key), dumps(value))
+                            for key, value in header)
+    else:
+        yield '{\n' + ''.join('  %s: %s,\n' % (
+            dumps(key), encode(value).replace('\n', '\n  '))
+            for key, value in header)
+
+    if isinstance(graph, CompactGraph):
+        nodes, links = _compact_nodes(graph), _compact_links(graph)
+    else:
+        nodes, links = _networkx_nodes_and_links(graph)
 
+    for name, items in [('nodes', nodes), ('links', links)]:
+        yield '%s:' % dumps(name) if compact else '  %s: ' % dumps(name)
+        first = True
+        chunk = []
+        for item in items:
+            chunk.append((start if first else sep) + dumps(item))
+            first = False
+            if len(chunk) >= JSON_CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+        yield ''.join(chunk) + (end if not first else '[]')
+        if name == 'nodes':
+            yield ',' if compact else ',\n'
+
+    yield '}' if compact else '\n}\n'
+
+
+def _networkx_nodes_and_links(graph):
+    mapping = {}
+
+    def nodes():
+        for num, (node, data) in enumerate(graph.nodes_iter(data=True)):
+            mapping[node] = num
+            item = dict(data)
+            item['id'] = node
+            yield item
+
+    def links():
+        for source, target, data in graph.edges_iter(data=True):
+            item = dict(data)
+            item['source'] = mapping[source]
+            item['target'] = mapping[target]
+            yield item
+
+    return nodes(), links()
+
+
+def _compact_nodes(graph):
+    for num, key in enumerate(graph.keys):
+        item = graph.nodes[num].to_dict() if graph.nodes else {}
+        item['id'] = key
+        yield item
+
+
+def _compact_links(graph):
+    for source in range(len(graph)):
+        for pos in range(graph.offsets[source], graph.offsets[source + 1]):
+            record = graph.edge_records[pos]
+            item = record.to_dict() if record else {}
+            item['source'] = source
+            item['target'] = graph.targets[pos]
+            yield item
+
+
+def _networkx(graph):
+    "The writers other than json need a networkx graph."
+    if isinstance(graph, CompactGraph):
+        return graph.to_networkx()
+    return graph
+
+
+def _topological_order(graph):
+    "The packages in dependency order, if there is one, else sorted."
+    import networkx as nx
 
-def json(graph):
-    rep = node_link.node_link_data(graph)
-    _json.dump(rep, sys.stdout, indent=2)
+    packages = sorted(graph)
+    try:
+        packages = nx.topological_sort(graph, packages)
+    except nx.exception.NetworkXUnfeasible:
+        # Can happen if graph is cyclic; we've already warned by now.
+        pass
+    return packages
 
 
 def teamcity(graph):
     import teamcity.messages
+    graph = _networkx(graph)
     tc = teamcity.messages.TeamcityServiceMessages()
 
     print("Dependency tree starting with these packages:")
     print("   ".join(graph.graph['query packages']))
     print("Checked for:", ", ".join(ann.graph_checks(graph)))
 
-    packages = sorted(graph)
-    try:
-        packages = nx.topological_sort(graph, packages)
-    except nx.exception.NetworkXUnfeasible:
-        # Can happen if graph is cyclic; we've already warned by now.
-        pass
+    for cycle in graph.graph.get('cycles', []):
+        tc.buildProblem("Dependency cycle: %s" % format_cycle(cycle),
+                        'pkg_deps.dependency_cycle')
+
+    packages = _topological_order(graph)
 
     for pkg in packages:
         node_data = graph.node[pkg]
@@ -133,6 +324,127 @@ def teamcity(graph):
             problems = human_format_problems(data)
             if problems:
                 tc.buildProblem(
-                    '%s depends on %s (%s is installed): %s' % (
-                        pkg, data['requirement'], dest, problems),
-                'pkg_deps.dependency_problem')
+                    '%s depends on %s (%s): %s' % (
+                        pkg, data['requirement'], _installed(dest),
+                        problems),
+                    'pkg_deps.dependency_problem')
+
+
+def teamcity_statistics(report, out=None):
+    """
+    Write an instrument.Recorder report as TeamCity statistics.
+
+    Each measurement of each stage becomes a buildStatisticValue, keyed
+    like ``pkg_deps.check_dag.wall``, so TeamCity can chart them from build
+    to build.  out is passed on to TeamcityServiceMessages (default: stdout).
+    """
+    import teamcity.messages
+    tc = teamcity.messages.TeamcityServiceMessages(output=out)
+
+    stages = [(record['stage'], record) for record in report['stages']]
+    stages.append(('total', report['total']))
+    for stage, record in stages:
+        for measure in sorted(record):
+            value = record[measure]
+            if measure != 'stage' and value is not None:
+                _teamcity_statistic(
+                    tc, 'pkg_deps.%s.%s' % (stage, measure), value)
+
+
+def _teamcity_statistic(tc, key, value):
+    # teamcity-messages has no method for buildStatisticValue
+    tc.message('buildStatisticValue', key=key, value='%s' % value)
+
+
+def _describe_diff(diff):
+    """
+    The lines of a diff from diff.diff_indexes, for people to read.
+
+    Yields (section, line, is it bad news) for each change.
+    """
+    for item in diff['added']:
+        yield ('Added packages', '+ %s %s' % (
+            item['package'], ', '.join(item['versions'])), False)
+    for item in diff['removed']:
+        yield ('Removed packages', '- %s %s' % (
+            item['package'], ', '.join(item['versions'])), False)
+    for item in diff['changed']:
+        yield ('Changed versions', '~ %s %s -> %s' % (
+            item['package'], ', '.join(item['old']),
+            ', '.join(item['new'])), False)
+    for item in diff['added_dependencies']:
+        yield ('Added dependencies', '+ %s depends on %s' % (
+            item['source'], item['requirement']), False)
+    for item in diff['removed_dependencies']:
+        yield ('Removed dependencies', '- %s depends on %s' % (
+            item['source'], item['requirement']), False)
+    for item in diff['changed_requirements']:
+        yield ('Changed requirements', '~ %s depends on %s, was %s' % (
+            item['source'], item['new'], item['old']), False)
+    for item in diff['new_failures']:
+        yield ('New problems', '! %s' % _describe_failure(item), True)
+    for item in diff['fixed_failures']:
+        yield ('Fixed problems', '  %s' % _describe_failure(item), False)
+
+
+def _describe_failure(item):
+    where = item.get('package') or '%s -> %s' % (item['source'],
+                                                 item['target'])
+    check = item['check']
+    if item['message']:
+        check += ': ' + item['message']
+    return '%s: %s' % (where, check)
+
+
+def human_diff(diff, out=None):
+    "Write a diff from diff.diff_indexes as text, a section per kind."
+    checks = diff['checks']
+    print("# Checked for:", ", ".join(checks['new']), file=out)
+    if set(checks['old']) != set(checks['new']):
+        click.secho("# The old graph was checked for: %s" %
+                    ", ".join(checks['old']), file=out, fg='red')
+
+    section = None
+    for heading, line, bad in _describe_diff(diff):
+        if heading != section:
+            print("%s:" % heading, file=out)
+            section = heading
+        click.echo('  ' + (click.style(line, fg='red') if bad else line),
+                   file=out)
+
+    if section is None:
+        print("No changes", file=out)
+
+
+def json_diff(diff, compact=False, out=None):
+    "Write a diff from diff.diff_indexes as JSON."
+    if out is None:
+        out = sys.stdout
+    if compact:
+        _json.dump(diff, out, separators=(',', ':'), sort_keys=True)
+    else:
+        _json.dump(diff, out, indent=2, sort_keys=True)
+        out.write('\n')
+    out.flush()
+
+
+def teamcity_diff(diff, out=None):
+    """
+    Write a diff from diff.diff_indexes for TeamCity.
+
+    New problems are buildProblems, and the number of each kind of change
+    is a buildStatisticValue, like ``pkg_deps.diff.added``.
+    """
+    import teamcity.messages
+    tc = teamcity.messages.TeamcityServiceMessages(output=out)
+
+    for heading, line, bad in _describe_diff(diff):
+        if bad:
+            tc.buildProblem(line[2:], 'pkg_deps.new_problem')
+        else:
+            print("%s: %s" % (heading, line), file=out)
+
+    for kind in sorted(diff):
+        if kind != 'checks':
+            _teamcity_statistic(tc, 'pkg_deps.diff.%s' % kind,
+                                len(diff[kind]))
@@ -15,16 +15,14 @@ setup(
     description="Print dependency info in graph form and check for problems",
     long_description=open('README.md').read(),
     packages=find_packages(exclude=['tests']),
-    install_requires=['pydotplus', 'networkx<2', 'click'],
+    install_requires=['networkx<2', 'click'],
     tests_require=tests_require,
-    # entry_points based script is really slow (0.5 seconds)
-    # might want to switch to normal script, since windows
-    # version isn't a concern right now
-    entry_points={
-        'console_scripts': [
-            'pkg-deps = pkg_deps.main:main',
-        ],
-    },
+    # Plain scripts, not console_scripts entry points: the generated
+    # wrappers import pkg_resources, which made startup really slow
+    # (0.5 seconds).  Plain scripts don't get the .exe launchers that pip
+    # makes for entry points on Windows, so there pkg-deps has to be run
+    # as "python -m pkg_deps".
+    scripts=['bin/pkg-deps', 'bin/pkg-deps-snapshot'],
     extras_require={
         'teamcity': ['teamcity-messages'],
     },
@@ -1,14 +1,49 @@
+import importlib
+import io
 import json
+import multiprocessing
 import os
-from pkg_resources import Requirement
+from pkg_resources import Requirement, parse_version
+import pprint
+import pstats
+import re
 import shutil
 import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
 import unittest
+import zipfile
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
 
 import networkx as nx
+from networkx.readwrite.json_graph import node_link
 
 from pkg_deps import annotators as ann
+from pkg_deps import cache
+from pkg_deps import collector
+from pkg_deps import compact
+from pkg_deps import diff
+from pkg_deps import index
+from pkg_deps import index_client
+from pkg_deps import instrument
+from pkg_deps import jsonstream
+from pkg_deps import lockfile
+from pkg_deps import main
+from pkg_deps import probe
+from pkg_deps import query
+from pkg_deps import requirements
+from pkg_deps import snapshot
+from pkg_deps import watch
+from pkg_deps import wheelmeta
+from pkg_deps import writers
 
 
 class DummyDist:
@@ -22,7 +57,7 @@ class DummyDist:
 
 def add_node(graph, pkg, version):
     as_req = str(Requirement.parse('%s==%s' % (pkg, version)))
-    graph.add_node(as_req, as_requirement=as_req)
+    index.add_node(graph, as_req, as_requirement=as_req)
     return as_req
 
 
@@ -31,6 +66,23 @@ def add_edge(graph, pkg, req_str):
     graph.add_edge(pkg, dest, requirement=req_str)
 
 
+def teamcity_messages(output):
+    "Parse TeamCity service messages into (name, attributes) pairs."
+    messages = []
+    for name, attrs in re.findall(r"##teamcity\[(\w+) (.*)\]", output):
+        attrs = dict(re.findall(r"(\w+)='((?:[^'|]|\|.)*)'", attrs))
+        attrs.pop('timestamp', None)
+        messages.append((name, attrs))
+    return messages
+
+
+def need_teamcity(test):
+    try:
+        importlib.import_module('teamcity.messages')
+    except ImportError:
+        test.skipTest("teamcity-messages is not available")
+
+
 class UnitTestCase(unittest.TestCase):
     def test_precise_pin(self):
         graph = nx.DiGraph()
@@ -85,6 +137,15 @@ class UnitTestCase(unittest.TestCase):
         self.assertIn(joist, graph[sit].keys())
         self.assertNotIn('missing pin', ann.failed_checks(graph[sit][joist]))
 
+    def test_descendant_sets(self):
+        graph = nx.gnp_random_graph(60, 0.04, seed=3, directed=True)
+        graph.add_edge(7, 7)
+        sources = list(range(0, 60, 4)) + [7]
+
+        found = ann.descendant_sets(graph, sources)
+        for source in sources:
+            self.assertEqual(nx.descendants(graph, source), found[source])
+
     def test_check_dag(self):
         graph = nx.DiGraph()
 
@@ -105,6 +166,38 @@ class UnitTestCase(unittest.TestCase):
         self.assertIn('cyclic dependency',
                       ann.failed_checks(graph[narcissism][narcissism]))
 
+    def test_check_dag_components(self):
+        graph = nx.DiGraph()
+
+        # Two cycles sharing a node, plus an edge leaving them
+        a = add_node(graph, 'a', '1')
+        b = add_node(graph, 'b', '1')
+        c = add_node(graph, 'c', '1')
+        d = add_node(graph, 'd', '1')
+        add_edge(graph, a, 'b')
+        add_edge(graph, b, 'a')
+        add_edge(graph, b, 'c')
+        add_edge(graph, c, 'a')
+        add_edge(graph, c, 'd')
+
+        self.assertTrue(ann.check_dag(graph, max_cycles=1))
+
+        for src, dest in [(a, b), (b, a), (b, c), (c, a)]:
+            self.assertIn('cyclic dependency',
+                          ann.failed_checks(graph[src][dest]))
+        self.assertNotIn('cyclic dependency',
+                         ann.failed_checks(graph[c][d]))
+        self.assertEqual(1, len(graph.graph['cycles']))
+
+    def test_check_dag_acyclic(self):
+        graph = nx.DiGraph()
+        a = add_node(graph, 'a', '1')
+        add_node(graph, 'b', '1')
+        add_edge(graph, a, 'b')
+
+        self.assertFalse(ann.check_dag(graph))
+        self.assertNotIn('cycles', graph.graph)
+
     def test_deps_should_be_met(self):
         graph = nx.DiGraph()
 
@@ -135,6 +228,1692 @@ class UnitTestCase(unittest.TestCase):
         except ValueError:
             pass
 
+    def test_node_index(self):
+        graph = nx.DiGraph()
+        old = add_node(graph, 'Some_Thing', '1.0')
+        new = add_node(graph, 'some-thing', '2.0')
+
+        idx = index.node_index(graph)
+        self.assertEqual(set([old, new]), set(idx.nodes_for('SOME_THING')))
+        self.assertEqual(new, ann.find_matching_node(graph, 'some-thing>1'))
+
+        index.remove_node(graph, new)
+        self.assertNotIn(new, graph)
+        self.assertEqual([old], idx.nodes_for('some-thing'))
+
+        # Nodes added behind the index's back are picked up too
+        graph.add_node('other==3', as_requirement='other==3')
+        self.assertEqual('other==3',
+                         ann.find_matching_node(graph, 'other'))
+
+        # A node replaced directly needs the index invalidated
+        graph.remove_node('other==3')
+        graph.add_node('other==4', as_requirement='other==4')
+        index.invalidate(graph)
+        self.assertEqual('other==4',
+                         ann.find_matching_node(graph, 'other'))
+
+    def test_node_index_parses_lazily(self):
+        parsed = []
+
+        def parse_version(version):
+            parsed.append(version)
+            return requirements.parse_version(version)
+
+        original = index.parse_version
+        index.parse_version = parse_version
+        try:
+            idx = index.NodeIndex(['lib==1.0', 'lib==2.0', 'other==1.0'])
+            self.assertEqual([], parsed)
+
+            self.assertEqual('lib==2.0',
+                             idx.find(requirements.parse('lib>1')))
+            self.assertEqual(requirements.parse_version('1.0'),
+                             idx.version('other==1.0'))
+            self.assertEqual(requirements.parse_version('2.0'),
+                             idx.version('lib==2.0'))
+        finally:
+            index.parse_version = original
+        self.assertEqual(sorted(set(parsed)), sorted(parsed))
+
+
+def fake_find_dependencies(env, walked):
+    "Make a probe.find_dependencies stand-in for an environment dict."
+    def find_dependencies(packages, known=()):
+        nodes = set()
+        edges = set()
+
+        def find_deps(name):
+            as_req, requires = env[name]
+            if as_req not in nodes and as_req not in known:
+                nodes.add(as_req)
+                walked.append(as_req)
+                for req in requires:
+                    edges.add((as_req, req, find_deps(req.split('>')[0])))
+            return as_req
+
+        top_nodes = [find_deps(pkg) for pkg in packages]
+        return (top_nodes, list(nodes), list(edges))
+
+    return find_dependencies
+
+
+class RequirementsTestCase(unittest.TestCase):
+    def test_parse_once(self):
+        table = requirements.RequirementTable()
+        parsed = table.parse('Some_Thing[extra]>=1.0,<2')
+        self.assertIs(parsed, table.parse('Some_Thing[extra]>=1.0,<2'))
+        self.assertEqual('some-thing', parsed.key)
+        self.assertEqual(('extra',), parsed.extras)
+        self.assertFalse(parsed.pinned)
+
+        self.assertIn(parse_version('1.5'), parsed)
+        self.assertNotIn(parse_version('2.0'), parsed)
+        self.assertIn('1.5', parsed)
+
+    def test_satisfied_by(self):
+        parsed = requirements.RequirementTable().parse('lib>=1.0,<2')
+        seen = []
+
+        def parse(version):
+            seen.append(version)
+            return parse_version(version)
+
+        self.assertTrue(parsed.satisfied_by('1.5', parse))
+        self.assertFalse(parsed.satisfied_by('2.0', parse))
+        self.assertTrue(parsed.satisfied_by('1.5', parse))  # remembered
+        self.assertTrue(parsed.satisfied_by('1.5'))
+
+        # Any version satisfies a bare name, without parsing it
+        self.assertTrue(requirements.RequirementTable().parse(
+            'lib').satisfied_by('1.5', parse))
+        self.assertEqual(['1.5', '2.0'], seen)
+
+    def test_bounded(self):
+        table = requirements.RequirementTable(max_size=4)
+        first = table.parse('a')
+        for name in 'bcdef':
+            table.parse(name)
+        self.assertLessEqual(len(table), 4)
+        self.assertIsNot(first, table.parse('a'))
+
+    def test_saved(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache_path = os.path.join(tmpdir, 'requirements.json')
+
+        table = requirements.RequirementTable(
+            cache=cache.JSONFileCache(cache_path))
+        self.assertTrue(table.parse('lib>=1.0').satisfied_by('1.5'))
+        table.parse('other')
+        table.save()
+
+        # A new table gets the requirement and what it was checked against
+        # from the cache, without parsing anything
+        table = requirements.RequirementTable(
+            cache=cache.JSONFileCache(cache_path))
+        parse_version = requirements.parse_version
+        requirements.parse_version = None
+        try:
+            parsed = table.parse('lib>=1.0')
+            self.assertTrue(parsed.satisfied_by('1.5'))
+            self.assertIsNone(parsed._requirement)
+            self.assertEqual('lib', parsed.key)
+            self.assertTrue(table.parse('other').unconstrained)
+        finally:
+            requirements.parse_version = parse_version
+
+    def test_is_pinned(self):
+        self.assertTrue(requirements.is_pinned('a==1.0'))
+        self.assertTrue(requirements.is_pinned('a===1.0'))
+        self.assertFalse(requirements.is_pinned('a>=1.0'))
+        self.assertFalse(requirements.is_pinned(
+            'a; python_version == "3.7"'))
+        self.assertTrue(requirements.is_pinned(Requirement.parse('a==1')))
+
+
+class CombineTestCase(unittest.TestCase):
+    def test_combine_graphs(self):
+        one = nx.DiGraph(environments=['one'])
+        a = add_node(one, 'a', '1')
+        add_node(one, 'b', '1')
+        add_edge(one, a, 'b')
+        ann.mark_check_failed(one[a]['b==1'], 'unmet', 'one')
+        one.node[a]['environments'] = ['one']
+
+        two = nx.DiGraph(environments=['two'])
+        add_node(two, 'a', '1')
+        add_node(two, 'b', '1')
+        add_edge(two, a, 'b')
+        ann.mark_check_failed(two[a]['b==1'], 'not precise', 'two')
+        two.node[a]['environments'] = ['two']
+
+        combined = collector.combine_graphs([one, two])
+        self.assertEqual(['one', 'two'], combined.graph['environments'])
+        self.assertEqual(['one', 'two'], combined.node[a]['environments'])
+        self.assertEqual({'unmet': 'one', 'not precise': 'two'},
+                         ann.failed_checks(combined[a]['b==1']))
+        self.assertEqual('b==1',
+                         ann.find_matching_node(combined, 'b'))
+
+    def test_json_round_trip(self):
+        graph = nx.DiGraph()
+        graph.graph['query packages'] = ['a==1']
+        graph.graph['checks'] = ['unmet']
+        a = add_node(graph, 'a', '1')
+        add_node(graph, 'b', '1')
+        add_edge(graph, a, 'b')
+        ann.mark_check_failed(graph[a]['b==1'], 'unmet', 'b>1')
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        for options in [{}, {'compact': True}, {'compress': True}]:
+            filename = os.path.join(tmpdir, 'graph.json')
+            with open(filename, 'wb' if options.get('compress') else 'w') \
+                    as out:
+                writers.json(graph, out=out, **options)
+
+            loaded = collector.combine_json_graphs([filename])
+            self.assertEqual(['a==1'], loaded.graph['query packages'])
+            self.assertEqual(sorted(graph.nodes(data=True)),
+                             sorted(loaded.nodes(data=True)))
+            self.assertEqual(graph.edges(data=True),
+                             loaded.edges(data=True))
+
+            # Read straight into a CompactGraph, it writes out the same
+            small = collector.combine_json_graphs([filename], compact=True)
+            self.assertIsInstance(small, compact.CompactGraph)
+            text, small_text = io.StringIO(), io.StringIO()
+            writers.json(loaded, out=text)
+            writers.json(small, out=small_text)
+            self.assertEqual(json.loads(text.getvalue()),
+                             json.loads(small_text.getvalue()))
+
+    def test_read_node_link(self):
+        graph = nx.DiGraph(checks=['unmet'])
+        for num in range(50):
+            add_node(graph, 'p%d' % num, '1.%d' % num)
+        for num in range(49):
+            graph.add_edge('p%d==1.%d' % (num, num),
+                           'p%d==1.%d' % (num + 1, num + 1),
+                           requirement='p%d' % (num + 1), weight=12345)
+
+        text = io.StringIO()
+        writers.json(graph, out=text)
+        # Small chunks, so values get cut off in the middle
+        records = list(jsonstream.read_node_link(
+            io.StringIO(text.getvalue()), chunk_size=7))
+
+        self.assertEqual(('graph', {'checks': ['unmet']}), records[0])
+        self.assertEqual(sorted(graph.nodes(data=True)),
+                         sorted(r[1:] for r in records if r[0] == 'node'))
+        self.assertEqual(sorted(graph.edges(data=True)),
+                         sorted(r[1:] for r in records if r[0] == 'link'))
+
+    def test_combine_json_graphs_threaded(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        filenames = []
+        for num in range(6):
+            graph = nx.DiGraph()
+            graph.graph['query packages'] = ['top==%d' % num]
+            graph.graph['checks'] = ['unmet']
+            top = add_node(graph, 'top', str(num))
+            shared = add_node(graph, 'shared', '1')
+            graph.add_edge(top, shared, requirement='shared')
+            ann.mark_check_failed(graph[top][shared], 'unmet', str(num))
+            ann.mark_check_failed(graph.node[shared], 'check%d' % num)
+
+            filenames.append(os.path.join(tmpdir, '%d.json' % num))
+            with open(filenames[-1], 'w') as out:
+                writers.json(graph, out=out)
+
+        combined = collector.combine_json_graphs(filenames, jobs=3)
+        self.assertEqual(['top==%d' % num for num in range(6)],
+                         combined.graph['query packages'])
+        self.assertEqual(7, combined.number_of_nodes())
+        self.assertEqual(set('check%d' % num for num in range(6)),
+                         set(ann.failed_checks(combined.node['shared==1'])))
+
+    def test_threaded_readers_stop(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        # Small batches, so the readers soon fill the queue and wait
+        batch_size = collector._BATCH_SIZE
+        collector._BATCH_SIZE = 1
+        self.addCleanup(setattr, collector, '_BATCH_SIZE', batch_size)
+
+        filenames = []
+        for num in range(4):
+            graph = nx.DiGraph()
+            for node in range(50):
+                add_node(graph, 'pkg%d' % node, str(num))
+            filenames.append(os.path.join(tmpdir, '%d.json' % num))
+            with open(filenames[-1], 'w') as out:
+                writers.json(graph, out=out)
+        before = threading.active_count()
+
+        # Stopping early
+        records = collector._read_json_graphs_threaded(filenames, 2)
+        next(records)
+        records.close()
+        self.assertEqual(before, threading.active_count())
+
+        # A file that can't be read
+        with open(filenames[2], 'w') as out:
+            out.write('{"nodes": [')
+        records = collector._read_json_graphs_threaded(filenames, 2)
+        self.assertRaises(ValueError, list, records)
+        self.assertEqual(before, threading.active_count())
+
+    def test_default_jobs(self):
+        self.assertEqual(1, collector._default_jobs(0))
+        self.assertEqual(1, collector._default_jobs(1))
+        self.assertLessEqual(collector._default_jobs(1000),
+                             multiprocessing.cpu_count())
+
+
+class CompactTestCase(unittest.TestCase):
+    def dependencies(self):
+        nodes = ['a==1', 'b==1', 'c==2', 'd==1', 'e==1']
+        edges = [('a==1', 'b', 'b==1'), ('b==1', 'c>2', 'c==2'),
+                 ('c==2', 'a', 'a==1'), ('a==1', 'd==1', 'd==1'),
+                 ('e==1', 'e', 'e==1')]
+        return ['a==1'], nodes, edges
+
+    def test_matches_networkx(self):
+        graph, top_nodes = collector.dependencies_to_graph(
+            *self.dependencies())
+        small, top_nodes = collector.dependencies_to_graph(
+            *self.dependencies(), compact=True)
+
+        for annotate in [lambda g: ann.check_dag(g, max_cycles=5),
+                         ann.dependencies_should_be_met]:
+            self.assertEqual(annotate(graph), annotate(small))
+
+        converted = small.to_networkx()
+        self.assertEqual(sorted(graph.nodes(data=True)),
+                         sorted(converted.nodes(data=True)))
+        self.assertEqual(sorted(graph.edges(data=True)),
+                         sorted(converted.edges(data=True)))
+        self.assertEqual(sorted(map(sorted, graph.graph['cycles'])),
+                         sorted(map(sorted, small.graph['cycles'])))
+
+        again = compact.CompactGraph.from_networkx(converted).to_networkx()
+        self.assertEqual(sorted(converted.edges(data=True)),
+                         sorted(again.edges(data=True)))
+
+    def test_components(self):
+        graph = nx.gnp_random_graph(80, 0.03, seed=5, directed=True)
+        small = compact.CompactGraph.from_networkx(graph, data=False)
+
+        found = [set(small.keys[num] for num in comp)
+                 for comp in small.strongly_connected_components()]
+        self.assertEqual(
+            sorted(map(sorted, nx.strongly_connected_components(graph))),
+            sorted(map(sorted, found)))
+
+        # Sinks first: nothing depends on a component found later
+        seen = set()
+        for comp in found:
+            for node in comp:
+                self.assertTrue(set(graph[node]) <= seen | comp)
+            seen |= comp
+
+    def test_json(self):
+        small, top_nodes = collector.dependencies_to_graph(
+            *self.dependencies(), compact=True)
+        ann.dependencies_should_be_met(small)
+
+        text = io.StringIO()
+        writers.json(small, out=text)
+        loaded = node_link.node_link_graph(json.loads(text.getvalue()))
+        self.assertEqual(sorted(small.to_networkx().edges(data=True)),
+                         sorted(loaded.edges(data=True)))
+
+
+class DiffTestCase(unittest.TestCase):
+    def write(self, graph, name):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as out:
+            writers.json(graph, out=out)
+        return path
+
+    def test_diff(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        old = nx.DiGraph(checks=['unmet'])
+        top = add_node(old, 'top', '1')
+        for name, version in [('Mid_Lib', '1'), ('gone', '1'),
+                              ('same', '1')]:
+            add_node(old, name, version)
+        add_edge(old, top, 'mid-lib>=1')
+        add_edge(old, top, 'gone')
+        add_edge(old, top, 'same')
+        ann.mark_check_failed(old[top]['same==1'], 'unmet', 'was broken')
+
+        new = nx.DiGraph(checks=['unmet', 'missing pin'])
+        top = add_node(new, 'top', '1')
+        for name, version in [('mid-lib', '2'), ('new', '1'),
+                              ('same', '1')]:
+            add_node(new, name, version)
+        add_edge(new, top, 'mid-lib>=2')
+        add_edge(new, 'mid-lib==2', 'new')
+        add_edge(new, top, 'same')
+        new.add_edge(top, 'new==1', requirement='new==1')
+        ann.mark_check_failed(new[top]['new==1'], 'missing pin', 'new==1')
+
+        changes = diff.diff_files(self.write(old, 'old.json'),
+                                  self.write(new, 'new.json'))
+        self.assertEqual([{'package': 'new', 'versions': ['1']}],
+                         changes['added'])
+        self.assertEqual([{'package': 'gone', 'versions': ['1']}],
+                         changes['removed'])
+        self.assertEqual([{'package': 'mid-lib', 'old': ['1'],
+                           'new': ['2']}], changes['changed'])
+        self.assertEqual([{'source': 'mid-lib', 'target': 'new',
+                           'requirement': 'new'}],
+                         changes['added_dependencies'])
+        self.assertEqual([{'source': 'top', 'target': 'gone',
+                           'requirement': 'gone'}],
+                         changes['removed_dependencies'])
+        self.assertEqual([{'source': 'top', 'target': 'mid-lib',
+                           'old': 'mid-lib>=1', 'new': 'mid-lib>=2'}],
+                         changes['changed_requirements'])
+        self.assertEqual([{'source': 'top', 'target': 'new',
+                           'check': 'missing pin', 'message': 'new==1'}],
+                         changes['new_failures'])
+        self.assertEqual([{'source': 'top', 'target': 'same',
+                           'check': 'unmet', 'message': 'was broken'}],
+                         changes['fixed_failures'])
+
+        text = io.StringIO()
+        writers.json_diff(changes, out=text)
+        self.assertEqual(changes, json.loads(text.getvalue()))
+
+        same = diff.diff_files(self.write(new, 'a.json'),
+                               self.write(new, 'b.json'))
+        self.assertFalse(any(same[kind] for kind in same
+                             if kind != 'checks'))
+
+        text = io.StringIO()
+        writers.human_diff(same, out=text)
+        self.assertEqual('# Checked for: unmet, missing pin\nNo changes\n',
+                         text.getvalue())
+
+    def sample_diff(self):
+        "Two graphs where top is upgraded, and its new version is unmet."
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        old = nx.DiGraph(checks=['unmet'])
+        add_edge(old, add_node(old, 'top', '1'),
+                 add_node(old, 'lib', '1').replace('==', '>='))
+
+        new = nx.DiGraph(checks=['unmet'])
+        top = add_node(new, 'top', '2')
+        add_node(new, 'lib', '1')
+        new.add_edge(top, 'lib==1', requirement='lib>=2')
+        ann.mark_check_failed(new[top]['lib==1'], 'unmet',
+                              'lib>=2 is not installed')
+
+        return self.write(old, 'old.json'), self.write(new, 'new.json')
+
+    def test_human_diff(self):
+        changes = diff.diff_files(*self.sample_diff())
+        text = io.StringIO()
+        writers.human_diff(changes, out=text)
+        self.assertEqual([
+            '# Checked for: unmet',
+            'Changed versions:',
+            '  ~ top 1 -> 2',
+            'Changed requirements:',
+            '  ~ top depends on lib>=2, was lib>=1',
+            'New problems:',
+            '  ! top -> lib: unmet: lib>=2 is not installed',
+        ], text.getvalue().splitlines())
+
+    def test_teamcity_diff(self):
+        need_teamcity(self)
+        changes = diff.diff_files(*self.sample_diff())
+        raw = io.BytesIO()
+        out = io.TextIOWrapper(raw, encoding='utf-8', line_buffering=True)
+        writers.teamcity_diff(changes, out=out)
+
+        output = raw.getvalue().decode('utf-8')
+        self.assertIn('Changed versions: ~ top 1 -> 2\n', output)
+        messages = teamcity_messages(output)
+        self.assertEqual(
+            ('buildProblem', {
+                'description': 'top -> lib: unmet: lib>=2 is not installed',
+                'identity': 'pkg_deps.new_problem'}),
+            messages[0])
+        statistics = dict((attrs['key'], attrs['value'])
+                          for name, attrs in messages[1:])
+        self.assertEqual('1', statistics['pkg_deps.diff.changed'])
+        self.assertEqual('1', statistics['pkg_deps.diff.new_failures'])
+        self.assertEqual('0', statistics['pkg_deps.diff.added'])
+
+    def test_exit_status(self):
+        old, new = self.sample_diff()
+        pkg_deps = [sys.executable, '-m', 'pkg_deps', '--diff']
+        with open(os.devnull, 'w') as devnull:
+            self.assertEqual(1, subprocess.call(pkg_deps + [old, new],
+                                                stdout=devnull))
+            # Going back fixes the problem, which isn't a failure
+            self.assertEqual(0, subprocess.call(pkg_deps + [new, old],
+                                                stdout=devnull))
+
+
+class DotTestCase(unittest.TestCase):
+    def test_dot(self):
+        graph = nx.DiGraph()
+        graph.graph['query packages'] = ['a==1']
+        a = add_node(graph, 'a', '1')
+        add_node(graph, 'b', '2')
+        add_edge(graph, a, 'b==2; python_version > "2"')
+        ann.dependencies_should_be_met(graph)
+        ann.mark_check_failed(graph.node['b==2'], 'outdated', 'latest is 3')
+        before = json.dumps([sorted(graph.nodes(data=True)),
+                             graph.edges(data=True)], sort_keys=True)
+
+        text = io.StringIO()
+        writers.dot(graph, out=text)
+        lines = text.getvalue().splitlines()
+        self.assertEqual(before, json.dumps(
+            [sorted(graph.nodes(data=True)), graph.edges(data=True)],
+            sort_keys=True))
+        self.assertEqual(
+            ['strict digraph {',
+             'label="Dependency tree rooted at square node(s)\\n'
+             'Checked for: unmet";',
+             'rankdir=LR;'], lines[:3])
+        self.assertIn('"a==1" [label="a==1", shape="box"];', lines)
+        self.assertIn('"b==2" [label="b==2 (outdated)", color="#0000bb"];',
+                      lines)
+        self.assertIn('"a==1" -> "b==2" [label="b==2; python_version >'
+                      ' \\"2\\"", style="dashed"];', lines)
+        self.assertEqual('}', lines[-1])
+
+        small = compact.CompactGraph.from_networkx(graph)
+        small_text = io.StringIO()
+        writers.dot(small, out=small_text)
+        self.assertEqual(sorted(lines),
+                         sorted(small_text.getvalue().splitlines()))
+
+
+class QueryTestCase(unittest.TestCase):
+    def setUp(self):
+        # top -> a -> b -> c -> d, with c -> b a cycle, and other -> c
+        self.graph = nx.DiGraph()
+        self.graph.graph['query packages'] = ['top==1']
+        for name in ['top', 'a', 'b', 'c', 'd', 'other']:
+            add_node(self.graph, name, '1')
+        for src, dest in [('top', 'a'), ('a', 'b'), ('b', 'c'), ('c', 'd'),
+                          ('c', 'b'), ('other', 'c')]:
+            add_edge(self.graph, src + '==1', dest)
+
+    def names(self, nodes):
+        return sorted(node.split('==')[0] for node in nodes)
+
+    def test_traversals(self):
+        graph = self.graph
+        self.assertEqual(['a', 'b', 'c', 'd'],
+                         self.names(query.descendants(graph, ['a==1'])))
+        self.assertEqual(['a', 'b'],
+                         self.names(query.descendants(graph, ['a==1'], 1)))
+        self.assertEqual(['a', 'b', 'c', 'other', 'top'],
+                         self.names(query.ancestors(graph, ['b==1'])))
+        self.assertEqual(['a', 'b', 'c'], self.names(
+            query.paths_between(graph, 'a==1', 'c==1')))
+        self.assertEqual(set(), query.paths_between(graph, 'd==1', 'a==1'))
+
+    def test_select(self):
+        selected, region = query.select(self.graph, descendants_of=['top'],
+                                        depth=2)
+        self.assertEqual(['a', 'b', 'top'], self.names(selected))
+        # The cycle through b goes on past the depth limit
+        self.assertEqual(['a', 'b', 'c', 'top'], self.names(region))
+
+        selected, region = query.select(self.graph, ancestors_of=['d'],
+                                        paths=[('other', 'd')])
+        self.assertIs(selected, region)
+        self.assertEqual(['a', 'b', 'c', 'd', 'other', 'top'],
+                         self.names(selected))
+
+        self.assertRaises(ValueError, query.select, self.graph,
+                          descendants_of=['nosuch'])
+
+    def test_checks_on_region(self):
+        selected, region = query.select(self.graph, descendants_of=['a'])
+        part = query.subgraph(self.graph, region)
+        self.assertTrue(ann.check_dag(part))
+        ann.check_dag(self.graph)
+        self.assertEqual(sorted(self.graph.edges(region, data=True)),
+                         sorted(part.edges(data=True)))
+
+    def test_failed_only(self):
+        ann.check_dag(self.graph)
+        ann.mark_check_failed(self.graph.node['top==1'], 'outdated')
+        shown = query.extract(self.graph, only_failed=True)
+        self.assertEqual(['b', 'c', 'top'], self.names(shown))
+        self.assertEqual([('b==1', 'c==1'), ('c==1', 'b==1')],
+                         sorted(shown.edges()))
+        self.assertEqual(['top==1'], shown.graph['query packages'])
+
+
+class ElsewhereTestCase(unittest.TestCase):
+    def test_many_pythons(self):
+        pythons = [sys.executable, sys.executable]
+        results = collector.collect_dependencies_many(
+            pythons, ['pkg-deps'], timeout=60)
+
+        self.assertEqual(2, len(results))
+        for graph, top_nodes in results:
+            self.assertEqual([sys.executable],
+                             graph.graph['environments'])
+            self.assertEqual([sys.executable],
+                             graph.node[top_nodes[0]]['environments'])
+
+    def test_stamped(self):
+        expected = collector.LocalProbe().find_dependencies(['pkg-deps'])
+        deps, stamps = collector.ScriptProbe(
+            sys.executable).stamped_dependencies(['pkg-deps'])
+        self.assertEqual(expected[0], deps[0])
+        self.assertEqual(sorted(expected[1]), sorted(deps[1]))
+        self.assertEqual(probe.metadata_stamps(), stamps)
+
+        # Without a cache, that's all it takes to get the stamps too
+        graph, top_nodes = collector.collect_dependencies_elsewhere(
+            sys.executable, ['pkg-deps'])
+        self.assertEqual(stamps['pkg-deps'],
+                         graph.node[top_nodes[0]]['stamp'])
+
+    def test_probe_server(self):
+        expected = collector.LocalProbe().find_dependencies(['pkg-deps'])
+
+        with collector.ProbeServer(sys.executable) as server:
+            for i in range(2):
+                deps = server.find_dependencies(['pkg-deps'])
+                self.assertEqual(sorted(expected[1]), sorted(deps[1]))
+                self.assertEqual(sorted(expected[2]), sorted(deps[2]))
+
+            self.assertIn('pkg-deps', server.stamps())
+
+            with self.assertRaises(RuntimeError):
+                server.find_dependencies(['no-such-package-here'])
+
+            # Still works after an error
+            self.assertEqual(expected[0],
+                             server.find_dependencies(['pkg-deps'])[0])
+
+    def test_probe_timeout(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            slow_python = os.path.join(tmp, 'python')
+            with open(slow_python, 'w') as script:
+                script.write('#!/bin/sh\nexec sleep 10\n')
+            os.chmod(slow_python, 0o755)
+
+            with self.assertRaises(RuntimeError):
+                collector.run_probe(slow_python, ['pkg-deps'], timeout=0.1)
+        finally:
+            shutil.rmtree(tmp)
+
+
+class UpdateTestCase(unittest.TestCase):
+    def test_update_graph(self):
+        env = {
+            'top': ('top==1', ['mid>=1', 'other']),
+            'mid': ('mid==1', ['leaf']),
+            'leaf': ('leaf==1', []),
+            'other': ('other==1', []),
+        }
+        stamps = dict((name, '1') for name in env)
+        walked = []
+        find = fake_find_dependencies(env, walked)
+
+        graph, top = collector.dependencies_to_graph(
+            *find(['top']), stamps=stamps)
+        self.assertFalse(ann.check_dag(graph))
+
+        # Upgrade mid, which now depends on new instead of leaf
+        env['mid'] = ('mid==2', ['new'])
+        env['new'] = ('new==1', [])
+        del env['leaf']
+        stamps.update(mid='2', new='1')
+        del stamps['leaf']
+        del walked[:]
+
+        graph, top, affected = collector.update_graph(
+            graph, ['top'], stamps, find)
+
+        self.assertEqual(['top==1'], top)
+        self.assertEqual(['mid==2', 'new==1'], sorted(walked))
+        self.assertEqual(set(['top==1', 'mid==2', 'new==1']), affected)
+        self.assertEqual(set(['top==1', 'mid==2', 'new==1', 'other==1']),
+                         set(graph))
+        self.assertEqual('mid>=1', graph['top==1']['mid==2']['requirement'])
+        self.assertEqual('2', graph.node['mid==2']['stamp'])
+
+        # Nothing changed: nothing is walked
+        del walked[:]
+        graph, top, affected = collector.update_graph(
+            graph, ['top'], stamps, find)
+        self.assertEqual([], walked)
+        self.assertEqual(set(), affected)
+
+    def test_removed_dependency(self):
+        env = {
+            'top': ('top==1', ['mid']),
+            'mid': ('mid==1', ['leaf>=1']),
+            'leaf': ('leaf==1', []),
+        }
+        stamps = dict((name, '1') for name in env)
+        find = fake_find_dependencies(env, [])
+        graph, top = collector.dependencies_to_graph(
+            *find(['top']), stamps=stamps)
+
+        # pip uninstall leaf
+        del env['leaf']
+        del stamps['leaf']
+        graph, top, affected = collector.update_graph(
+            graph, ['top'], stamps, find)
+        self.assertEqual(set(['mid==1']), affected)
+        self.assertEqual(set(['top==1', 'mid==1', 'leaf']), set(graph))
+        self.assertTrue(ann.dependencies_should_be_met(graph, affected))
+        self.assertEqual({'unmet': 'leaf>=1 is not installed'},
+                         ann.failed_checks(graph['mid==1']['leaf']))
+        self.assertEqual(set(), collector.stale_nodes(graph, stamps))
+
+        # And install it again
+        env['leaf'] = ('leaf==2', [])
+        stamps['leaf'] = '2'
+        graph, top, affected = collector.update_graph(
+            graph, ['top'], stamps, find)
+        self.assertEqual(set(['mid==1', 'leaf==2']), affected)
+        self.assertEqual(set(['top==1', 'mid==1', 'leaf==2']), set(graph))
+        self.assertFalse(ann.dependencies_should_be_met(graph, affected))
+
+    def test_saved_checks(self):
+        env = {
+            'top': ('top==1', ['mid']),
+            'mid': ('mid==1', []),
+        }
+        stamps = dict((name, '1') for name in env)
+        find = fake_find_dependencies(env, [])
+        graph, top = collector.dependencies_to_graph(
+            *find(['top']), stamps=stamps)
+
+        # Saved by a run with --outdated, when mid 2 was out
+        self.assertTrue(main.run_checks(graph, top, outdated=True,
+                                        latest={'mid': '2'}))
+        self.assertIn('outdated', ann.failed_checks(graph.node['mid==1']))
+
+        # Nothing has changed, but this run doesn't ask for --outdated
+        graph, top, affected = collector.update_graph(
+            graph, ['top'], stamps, find)
+        self.assertEqual(set(), affected)
+        self.assertFalse(main.run_checks(graph, top, affected=affected))
+        self.assertEqual({}, ann.failed_checks(graph.node['mid==1']))
+        self.assertNotIn('outdated', ann.graph_checks(graph))
+
+        # And when it does, it's checked again, not taken from before
+        main.run_checks(graph, top, outdated=True, latest={'mid': '2'})
+        self.assertFalse(main.run_checks(graph, top, outdated=True,
+                                         latest={'mid': '1'},
+                                         affected=set()))
+        self.assertEqual({}, ann.failed_checks(graph.node['mid==1']))
+
+
+class StopWatching(Exception):
+    pass
+
+
+class WatchTestCase(unittest.TestCase):
+    def test_changes_debounced(self):
+        # A pip install changes one thing, then another, then settles
+        polls = iter(['a', 'a', 'b', 'c', 'c', 'd', 'd', 'd'])
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+
+        changes = watch.changes(lambda: next(polls), 'a', interval=1,
+                                debounce=0.5, sleep=sleep)
+        self.assertEqual('c', next(changes))
+        self.assertEqual([1, 1, 1, 0.5, 0.5], slept)
+        self.assertEqual('d', next(changes))
+
+    def test_watch(self):
+        env = {
+            'top': ('top==1', ['mid']),
+            'mid': ('mid==1', []),
+        }
+        stamps = {'top': '1', 'mid': '1'}
+        walked = []
+
+        class Prober(object):
+            def stamps(self):
+                return dict(stamps)
+
+            find_dependencies = staticmethod(
+                fake_find_dependencies(env, walked))
+
+        prober = Prober()
+        graph, top = collector.dependencies_to_graph(
+            *prober.find_dependencies(['top']), stamps=stamps)
+
+        def sleep(seconds):
+            if len(sleeps) == 2:
+                # Upgrade mid, to a version with an unmet requirement
+                env['mid'] = ('mid==2', ['new>1'])
+                env['new'] = ('new==1', [])
+                stamps.update(mid='2', new='1')
+            elif len(sleeps) > 5:
+                raise StopWatching()
+            sleeps.append(seconds)
+
+        sleeps = []
+        reruns = []
+
+        def rerun(graph, top_nodes, affected):
+            reruns.append(affected)
+            self.assertTrue(ann.dependencies_should_be_met(graph, affected))
+
+        del walked[:]
+        self.assertRaises(StopWatching, watch.watch, prober, graph, ['top'],
+                          rerun, sleep=sleep)
+        self.assertEqual([set(['top==1', 'mid==2', 'new==1'])], reruns)
+        self.assertEqual(['mid==2', 'new==1'], sorted(walked))
+        self.assertEqual(set(['top==1', 'mid==2', 'new==1']), set(graph))
+
+    def test_watch_removed(self):
+        env = {
+            'top': ('top==1', ['mid']),
+            'mid': ('mid==1', ['leaf']),
+            'leaf': ('leaf==1', []),
+        }
+        stamps = dict((name, '1') for name in env)
+        fail = []
+        find = fake_find_dependencies(env, [])
+
+        class Prober(object):
+            def stamps(self):
+                return dict(stamps)
+
+            def find_dependencies(self, packages, known=()):
+                if fail:
+                    fail.pop()
+                    raise RuntimeError("Probe failed")
+                return find(packages, known)
+
+        prober = Prober()
+        graph, top = collector.dependencies_to_graph(
+            *prober.find_dependencies(['top']), stamps=stamps)
+
+        def sleep(seconds):
+            if len(sleeps) == 2:
+                # pip uninstall leaf
+                del env['leaf']
+                del stamps['leaf']
+            elif len(sleeps) == 5:
+                # Upgrade mid, but the probe fails
+                env['mid'] = ('mid==2', [])
+                stamps['mid'] = '2'
+                fail.append(True)
+            elif len(sleeps) == 7:
+                # Another change, and the upgrade is picked up after all
+                stamps['other'] = '1'
+            elif len(sleeps) > 8:
+                raise StopWatching()
+            sleeps.append(seconds)
+
+        sleeps = []
+        reruns = []
+
+        def rerun(graph, top_nodes, affected):
+            reruns.append((affected, ann.dependencies_should_be_met(
+                graph, affected)))
+
+        self.assertRaises(StopWatching, watch.watch, prober, graph, ['top'],
+                          rerun, sleep=sleep)
+        self.assertEqual([(set(['mid==1']), True),
+                          (set(['top==1', 'mid==2']), False)], reruns)
+        self.assertEqual(set(['top==1', 'mid==2']), set(graph))
+
+
+class ProbeTestCase(unittest.TestCase):
+    def test_backends_agree(self):
+        # pkg-deps itself has to be installed for the integration tests
+        packages = ['pkg-deps']
+        try:
+            backend = probe.MetadataBackend()
+        except probe.Unsupported:
+            self.skipTest("packaging is not available")
+
+        fast = probe.find_dependencies(packages, backend=backend)
+        slow = probe.find_dependencies(
+            packages, backend=probe.PkgResourcesBackend())
+
+        self.assertEqual(slow[0], fast[0])
+        self.assertEqual(sorted(slow[1]), sorted(fast[1]))
+        self.assertEqual(sorted(slow[2]), sorted(fast[2]))
+
+    def test_long_chain(self):
+        class ChainBackend(object):
+            "pkg0 -> pkg1 -> ... -> pkgN, with every package also on pkg0"
+            def __init__(self, length):
+                self.length = length
+                self.lookups = []
+
+            def get_distribution(self, name):
+                self.lookups.append(name)
+                return int(name[3:])
+
+            def as_requirement(self, num):
+                return 'pkg%d==1.0' % num
+
+            def requires(self, num):
+                reqs = [('pkg0', 'pkg0')]
+                if num + 1 < self.length:
+                    reqs.append(('pkg%d>=1' % (num + 1), 'pkg%d' % (num + 1)))
+                return reqs
+
+        backend = ChainBackend(5000)
+        top_nodes, nodes, edges = probe.find_dependencies(
+            ['pkg0', 'PKG0'], backend=backend)
+
+        self.assertEqual(['pkg0==1.0', 'pkg0==1.0'], top_nodes)
+        self.assertEqual(5000, len(nodes))
+        self.assertEqual(2 * 5000 - 1, len(edges))
+        self.assertIn(('pkg4998==1.0', 'pkg4999>=1', 'pkg4999==1.0'), edges)
+        # Each project is only looked up once
+        self.assertEqual(5000, len(backend.lookups))
+
+    def test_wire_format(self):
+        deps = (['caf\xe9==1.0'],
+                ['caf\xe9==1.0', 'six==1.9.0'],
+                [('caf\xe9==1.0', 'six>=1.5', 'six==1.9.0')])
+        out = io.StringIO()
+        probe.write_dependencies(deps, out)
+
+        stream = io.BytesIO(out.getvalue().encode('ascii'))
+        self.assertEqual(deps, collector.read_probe_output(stream))
+
+        out = io.StringIO()
+        probe.write_dependencies(deps, out, stamps={'six': 'x@1'})
+        stream = io.BytesIO(out.getvalue().encode('ascii'))
+        self.assertEqual((deps, {'six': 'x@1'}),
+                         collector.read_probe_output(stream))
+
+        # Old probes used pprint
+        old = io.BytesIO(pprint.pformat(deps).encode())
+        self.assertEqual(deps, collector.read_probe_output(old))
+
+        # Truncated output is an error
+        truncated = out.getvalue().rsplit('["end"]', 1)[0]
+        with self.assertRaises(ValueError):
+            collector.read_probe_output(
+                io.BytesIO(truncated.encode('ascii')))
+
+    def test_split_metadata_name(self):
+        self.assertEqual(('Foo_Bar', '1.0'),
+                         probe.split_metadata_name(
+                             '/x/Foo_Bar-1.0-py3.7.egg-info'))
+        self.assertEqual(('foo', None),
+                         probe.split_metadata_name('foo.egg-info'))
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        os.mkdir(os.path.join(self.tmpdir, 'zope-interface'))
+        with open(os.path.join(self.tmpdir, 'zope-interface', 'index.html'),
+                  'w') as page:
+            page.write(
+                '<html><body>\n'
+                '<a href="../f/1">zope.interface-4.1.tar.gz</a><br/>\n'
+                '<a href="../f/2">zope.interface-4.2-py2.py3-none-any.whl'
+                '</a><br/>\n'
+                '<a href="../f/3" data-yanked="">zope.interface-5.0.zip</a>\n'
+                '<a href="../f/4">zope.interface-4.3b1.tar.gz</a>\n'
+                '</body></html>\n')
+
+        with open(os.path.join(self.tmpdir, 'six.json'), 'w') as page:
+            json.dump({'meta': {'api-version': '1.0'}, 'name': 'six',
+                       'files': [{'filename': 'six-1.9.0.tar.gz'},
+                                 {'filename': 'six-1.10.0.tar.gz'}]}, page)
+
+    def test_read_snapshot_dir(self):
+        self.assertEqual({'zope-interface': '4.2', 'six': '1.10.0'},
+                         snapshot.read_snapshot_dir(self.tmpdir))
+
+    def test_outdated_from_snapshot(self):
+        filename = os.path.join(self.tmpdir, 'latest.json')
+        snapshot.write_snapshot(snapshot.read_snapshot_dir(self.tmpdir),
+                                filename)
+        latest = snapshot.load_latest_versions(filename)
+
+        graph = nx.DiGraph()
+        zope = add_node(graph, 'zope.interface', '4.2')
+        six = add_node(graph, 'six', '1.9.0')
+        add_node(graph, 'unknown', '1.0')
+
+        self.assertTrue(ann.add_available_updates(graph, latest=latest))
+        self.assertEqual({'outdated': 'latest is 1.10.0'},
+                         ann.failed_checks(graph.node[six]))
+        self.assertEqual({}, ann.failed_checks(graph.node[zope]))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeIndexHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_GET(self):
+        page = self.server.pages.get(self.path)
+        etag = '"%s"' % self.path
+        if page is None:
+            status, body = 404, b''
+        elif self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        else:
+            status, body = 200, json.dumps(page).encode('utf-8')
+        self.server.requests.append((self.client_address, self.path, status))
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if page is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Content-Type',
+                             'application/vnd.pypi.simple.v1+json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class IndexClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeIndexHandler)
+        self.server.requests = []
+        self.server.pages = {}
+        for num in range(6):
+            self.server.pages['/pkg%d/' % num] = {
+                'name': 'pkg%d' % num,
+                'files': [{'filename': 'pkg%d-1.%d.tar.gz' % (num, minor)}
+                          for minor in range(3)]}
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def client(self):
+        return index_client.IndexClient(
+            self.url, jobs=2, cache=cache.DiskCache(self.tmpdir))
+
+    def test_latest_versions(self):
+        names = ['pkg%d' % num for num in range(6)] + ['missing']
+        expected = dict(('pkg%d' % num, '1.2') for num in range(6))
+
+        self.assertEqual(expected, self.client().latest_versions(names))
+        statuses = [status for _, _, status in self.server.requests]
+        self.assertEqual([200] * 6 + [404], sorted(statuses))
+
+        # Connections are reused between requests
+        self.assertLessEqual(
+            len(set(addr for addr, _, _ in self.server.requests)), 2)
+
+        # Later runs only need to check the pages haven't changed
+        del self.server.requests[:]
+        self.assertEqual(expected, self.client().latest_versions(names))
+        statuses = [status for _, _, status in self.server.requests]
+        self.assertEqual([304] * 6 + [404], sorted(statuses))
+
+    def test_connections_closed(self):
+        client = self.client()
+        client.latest_versions(['pkg1', 'pkg2'])
+        self.assertEqual([], client._connections)
+
+        with self.client() as client:
+            client.fetch(self.url + 'pkg1/')
+            connections = list(client._connections)
+        self.assertEqual(1, len(connections))
+        self.assertIsNone(connections[0].sock)
+
+    def test_fetch_error(self):
+        # Nothing listens on the discard port
+        status, out, err = run_pkg_deps(
+            ['--index-url', 'http://127.0.0.1:9/', '--no-cache', 'pkg-deps'])
+        self.assertEqual(1, status)
+        self.assertIn("Error: Couldn't fetch http://127.0.0.1:9/", err)
+        self.assertNotIn('Traceback', err)
+
+    def test_outdated_from_index(self):
+        graph = nx.DiGraph()
+        old = add_node(graph, 'pkg1', '1.0')
+        new = add_node(graph, 'pkg2', '1.2')
+
+        self.assertTrue(ann.add_available_updates(graph,
+                                                  index=self.client()))
+        self.assertEqual({'outdated': 'latest is 1.2'},
+                         ann.failed_checks(graph.node[old]))
+        self.assertEqual({}, ann.failed_checks(graph.node[new]))
+        self.assertEqual(['/pkg1/', '/pkg2/'],
+                         sorted(path for _, path, _ in self.server.requests))
+
+
+class LockfileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        self.wheel('app', '1.0', ['lib>=1.0',
+                                  'winonly; sys_platform == "win32"',
+                                  'docs; extra == "docs"'])
+        self.wheel('lib', '1.0', ['Other_Thing'])
+
+        sdist = os.path.join(self.tmpdir, 'Other_Thing-2.0.tar.gz')
+        with tarfile.open(sdist, 'w:gz') as archive:
+            for name, text in [
+                    ('Other_Thing-2.0/PKG-INFO',
+                     'Metadata-Version: 1.1\nName: Other_Thing\n'
+                     'Version: 2.0\n'),
+                    ('Other_Thing-2.0/Other_Thing.egg-info/requires.txt',
+                     '\n[test]\npytest\n'
+                     '[:python_version >= "2.7"]\nlib>=1.0\n'
+                     '[:sys_platform == "nonesuch"]\nwinonly\n')]:
+                data = text.encode('utf-8')
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+
+        self.requirements = os.path.join(self.tmpdir, 'requirements.txt')
+        with open(self.requirements, 'w') as out:
+            out.write('# pinned\n'
+                      'app==1.0 \\\n'
+                      '    --hash=sha256:%s\n'
+                      'lib==1.0\n'
+                      'other-thing==2.0  # a comment\n'
+                      'unpinned>=3\n' % lockfile.file_hash(
+                          os.path.join(self.tmpdir,
+                                       'app-1.0-py3-none-any.whl'))[7:])
+
+    def wheel(self, name, version, requires):
+        path = os.path.join(self.tmpdir,
+                            '%s-%s-py3-none-any.whl' % (name, version))
+        with zipfile.ZipFile(path, 'w') as wheel:
+            wheel.writestr('%s/__init__.py' % name, '')
+            wheel.writestr(
+                '%s-%s.dist-info/METADATA' % (name, version),
+                'Metadata-Version: 2.1\nName: %s\nVersion: %s\n' % (
+                    name, version) +
+                ''.join('Requires-Dist: %s\n' % req for req in requires))
+
+    def test_graph_from_lock(self):
+        graph, top_nodes = collector.collect_dependencies_from_lock(
+            self.requirements, self.tmpdir, ['app'])
+
+        self.assertEqual(['app==1.0'], top_nodes)
+        self.assertEqual(['Other-Thing==2.0', 'app==1.0', 'lib==1.0'],
+                         sorted(graph))
+        self.assertEqual('lib>=1.0',
+                         graph['app==1.0']['lib==1.0']['requirement'])
+        self.assertEqual('Other_Thing',
+                         graph['lib==1.0']['Other-Thing==2.0']['requirement'])
+        # Like installed egg-info: the marker is applied, and left out
+        self.assertEqual('lib>=1.0',
+                         graph['Other-Thing==2.0']['lib==1.0']['requirement'])
+        self.assertFalse(ann.dependencies_should_be_met(graph))
+
+    def test_missing_pin(self):
+        with open(self.requirements, 'w') as out:
+            out.write('app==1.0\n')
+        self.assertRaises(lockfile.LockError,
+                          collector.collect_dependencies_from_lock,
+                          self.requirements, self.tmpdir, ['app'])
+
+    def test_hash_mismatch(self):
+        with open(self.requirements, 'a') as out:
+            out.write('lib==1.0 --hash=sha256:0000\n')
+        self.assertRaises(lockfile.LockError,
+                          collector.collect_dependencies_from_lock,
+                          self.requirements, self.tmpdir, ['app'],
+                          verify_hashes=True)
+
+    def test_hash_algorithms(self):
+        def pin(name, algorithm):
+            path = os.path.join(self.tmpdir, '%s-1.0-py3-none-any.whl' % name)
+            return '%s==1.0 --hash=%s\n' % (
+                name, lockfile.file_hash(path, algorithm))
+
+        with open(self.requirements, 'w') as out:
+            out.write(pin('app', 'sha512') + pin('lib', 'sha384') +
+                      'other-thing==2.0 --hash=sha256:0000 --hash=%s\n' %
+                      lockfile.file_hash(os.path.join(
+                          self.tmpdir, 'Other_Thing-2.0.tar.gz')))
+        graph, top_nodes = collector.collect_dependencies_from_lock(
+            self.requirements, self.tmpdir, ['app'], verify_hashes=True)
+        self.assertEqual(3, len(graph))
+
+        # A hash that can't be checked isn't taken as a match
+        with open(self.requirements, 'a') as out:
+            out.write('lib==1.0 --hash=md5:0000\n')
+        with self.assertRaises(lockfile.LockError) as raised:
+            collector.collect_dependencies_from_lock(
+                self.requirements, self.tmpdir, ['app'], verify_hashes=True)
+        self.assertIn("'md5:0000'", str(raised.exception))
+
+    def test_lock_error_reported(self):
+        with open(self.requirements, 'w') as out:
+            out.write('app==1.0\n')
+        status, out, err = run_pkg_deps(
+            ['--lockfile', self.requirements, '--wheelhouse', self.tmpdir,
+             '--no-cache', 'app'])
+        self.assertEqual(1, status)
+        self.assertIn("Error: lib isn't pinned in the lock file", err)
+        self.assertNotIn('Traceback', err)
+
+
+class WheelMetadataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        self.path = os.path.join(self.tmpdir, 'app-1.0-py3-none-any.whl')
+        with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED) as wheel:
+            wheel.writestr('app/__init__.py', 'x = 1\n' * 1000)
+            wheel.writestr('app/METADATA', 'not this one')
+            wheel.writestr(
+                'app-1.0.dist-info/METADATA',
+                'Metadata-Version: 2.1\nName: App\nVersion: 1.0\n'
+                'Requires-Dist: lib>=1.0\n'
+                'Requires-Dist: docs;\n extra == "docs"\n'
+                '\nRequires-Dist: in the description\n')
+            wheel.comment = b'a comment'
+
+    def test_read(self):
+        self.assertEqual({'name': 'App', 'version': '1.0',
+                          'requires': ['lib>=1.0', 'docs; extra == "docs"']},
+                         wheelmeta.read_wheel_metadata(self.path))
+
+    def test_stored(self):
+        path = os.path.join(self.tmpdir, 'lib-1.0-py3-none-any.whl')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as wheel:
+            wheel.writestr('lib-1.0.dist-info/METADATA',
+                           'Name: lib\nVersion: 1.0\n')
+        self.assertEqual({'name': 'lib', 'version': '1.0', 'requires': []},
+                         wheelmeta.read_wheel_metadata(path))
+
+    def test_not_a_wheel(self):
+        path = os.path.join(self.tmpdir, 'bad-1.0-py3-none-any.whl')
+        with open(path, 'wb') as out:
+            out.write(b'not a zip file')
+        self.assertRaises(wheelmeta.WheelError,
+                          wheelmeta.read_wheel_metadata, path)
+
+    def test_cache(self):
+        cache_path = os.path.join(self.tmpdir, 'cache', 'metadata.json')
+        metadata_cache = cache.JSONFileCache(cache_path)
+        fields = wheelmeta.read_wheel_metadata(self.path, metadata_cache)
+        metadata_cache.save()
+
+        # A new cache reads the entry back from the file, so the wheel's
+        # METADATA isn't decompressed again
+        metadata_cache = cache.JSONFileCache(cache_path)
+        read_entry = wheelmeta._read_entry
+        wheelmeta._read_entry = None
+        try:
+            self.assertEqual(fields, wheelmeta.read_wheel_metadata(
+                self.path, metadata_cache))
+        finally:
+            wheelmeta._read_entry = read_entry
+
+    def test_cache_limit(self):
+        cache_path = os.path.join(self.tmpdir, 'metadata.json')
+        metadata_cache = cache.JSONFileCache(cache_path, max_entries=2)
+        for key in 'abc':
+            metadata_cache.put(key, {})
+        metadata_cache.save()
+
+        metadata_cache = cache.JSONFileCache(cache_path)
+        self.assertEqual(2, sum(metadata_cache.get(key) is not None
+                                for key in 'abc'))
+
+
+class InstrumentTestCase(unittest.TestCase):
+    def test_stages(self):
+        recorder = instrument.Recorder()
+        with recorder.stage('probe') as record:
+            graph = nx.DiGraph()
+            graph.add_edge('a==1', 'b==1')
+            recorder.graph_size(record, graph)
+        with recorder.stage('check_dag'):
+            subprocess.check_call([sys.executable, '-c', 'pass'])
+
+        report = recorder.report()
+        self.assertEqual(['probe', 'check_dag'],
+                         [record['stage'] for record in report['stages']])
+        probe_record, check_record = report['stages']
+        self.assertEqual((2, 1), (probe_record['nodes'],
+                                  probe_record['edges']))
+        self.assertNotIn('nodes', check_record)
+        for record in report['stages'] + [report['total']]:
+            self.assertGreaterEqual(record['wall'], 0)
+            self.assertGreaterEqual(record['subprocess_cpu'], 0)
+        self.assertGreaterEqual(report['total']['wall'],
+                                check_record['wall'])
+        json.dumps(report)
+
+    def test_teamcity_statistics(self):
+        need_teamcity(self)
+        report = {
+            'stages': [{'stage': 'probe', 'wall': 1.5, 'nodes': 3,
+                        'peak_rss': None}],
+            'total': {'wall': 2.0},
+        }
+        out = io.BytesIO()
+        writers.teamcity_statistics(report, out=out)
+
+        self.assertEqual([
+            ('buildStatisticValue', {'key': 'pkg_deps.probe.nodes',
+                                     'value': '3'}),
+            ('buildStatisticValue', {'key': 'pkg_deps.probe.wall',
+                                     'value': '1.5'}),
+            ('buildStatisticValue', {'key': 'pkg_deps.total.wall',
+                                     'value': '2.0'}),
+        ], teamcity_messages(out.getvalue().decode('utf-8')))
+
+    def test_profile_stage(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        output = os.path.join(tmpdir, 'check_dag.prof')
+
+        recorder = instrument.Recorder('check_dag', output)
+        with recorder.stage('probe'):
+            pass
+        self.assertFalse(os.path.exists(output))
+        with recorder.stage('check_dag'):
+            ann.check_dag(nx.DiGraph([('a==1', 'b==1')]))
+
+        stats = pstats.Stats(output)
+        self.assertTrue(any(name == 'check_dag'
+                            for (path, line, name) in stats.stats))
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_probe_results_are_reused(self):
+        probe_cache = cache.DiskCache(self.cache_dir)
+        calls = []
+
+        def find_dependencies():
+            calls.append(1)
+            return (['a==1'], ['a==1', 'b==2'], [('a==1', 'b', 'b==2')])
+
+        stamps = {'a': 'a-1.dist-info@1', 'b': 'b-2.dist-info@1'}
+        for i in range(2):
+            deps = collector._cached_probe(
+                probe_cache, 'python', ['a'], stamps, find_dependencies)
+        self.assertEqual(1, len(calls))
+        self.assertEqual([['a==1', 'b', 'b==2']], deps[2])
+
+        # Changed environment means a different key
+        stamps['b'] = 'b-3.dist-info@2'
+        collector._cached_probe(
+            probe_cache, 'python', ['a'], stamps, find_dependencies)
+        self.assertEqual(2, len(calls))
+
+    def test_eviction(self):
+        probe_cache = cache.DiskCache(self.cache_dir, max_bytes=250)
+        for num in range(5):
+            probe_cache.put(str(num), 'x' * 100)
+            # Make sure the modification times are distinct and ordered
+            os.utime(os.path.join(self.cache_dir, '%d.json' % num),
+                     (num, num))
+            probe_cache.get('0')
+
+        self.assertEqual('x' * 100, probe_cache.get('0'))
+        self.assertEqual('x' * 100, probe_cache.get('4'))
+        self.assertIsNone(probe_cache.get('3'))
+
+
+def run_pkg_deps(args):
+    "Run pkg-deps, returning (exit status, stdout, stderr)."
+    proc = subprocess.Popen([sys.executable, '-m', 'pkg_deps'] + args,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return proc.returncode, out.decode('utf-8'), err.decode('utf-8')
+
+
+class MainTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def sample_graph(self):
+        "top -> mid -> leaf, and top -> other; mid -> leaf is unmet."
+        graph = nx.DiGraph(checks=['unmet'])
+        graph.graph['query packages'] = ['top==1']
+        top = add_node(graph, 'top', '1')
+        mid = add_node(graph, 'mid', '1')
+        add_node(graph, 'leaf', '1')
+        add_node(graph, 'other', '1')
+        add_edge(graph, top, 'mid')
+        add_edge(graph, top, 'other')
+        add_edge(graph, mid, 'leaf')
+        ann.mark_check_failed(graph[mid]['leaf==1'], 'unmet', 'leaf>1')
+        return graph
+
+    def shown_nodes(self, args):
+        "Run pkg-deps --json --load-json on sample_graph, with args."
+        path = os.path.join(self.tmpdir, 'graph.json')
+        with open(path, 'w') as out:
+            writers.json(self.sample_graph(), out=out)
+
+        status, out, err = run_pkg_deps(
+            ['--json', '--load-json', path] + args)
+        self.assertEqual(0, status, err)
+        return set(node['id'] for node in json.loads(out)['nodes'])
+
+    def test_query_options(self):
+        self.assertEqual(set(['mid==1', 'leaf==1']),
+                         self.shown_nodes(['--descendants-of', 'mid']))
+        self.assertEqual(set(['top==1', 'mid==1']),
+                         self.shown_nodes(['--ancestors-of', 'mid',
+                                           '--depth', '1']))
+        self.assertEqual(set(['top==1', 'mid==1', 'leaf==1']),
+                         self.shown_nodes(['--paths', 'top', 'leaf']))
+        self.assertEqual(set(['mid==1', 'leaf==1']),
+                         self.shown_nodes(['--only-failed']))
+        self.assertEqual(set(), self.shown_nodes(['--only-failed',
+                                                  '--ancestors-of', 'other']))
+
+    def test_query_errors(self):
+        status, out, err = run_pkg_deps(['--depth', '1', 'pkg-deps'])
+        self.assertEqual(1, status)
+        self.assertIn('--depth only works with', out)
+
+        status, out, err = run_pkg_deps(
+            ['--no-cache', '--descendants-of', 'no-such-package-here',
+             'pkg-deps'])
+        self.assertEqual(1, status)
+        self.assertIn("Couldn't find any packages matching"
+                      " no-such-package-here", out)
+
+    def test_check_region(self):
+        graph = self.sample_graph()
+        query_options = dict(descendants_of=['top'], depth=1)
+        recorder = instrument.Recorder()
+
+        region, top_nodes, affected, selected = main._check_region(
+            graph, ['top==1'], set(['leaf==1', 'other==1']), query_options,
+            False, recorder)
+        self.assertEqual(set(['top==1', 'mid==1', 'other==1']), set(region))
+        self.assertEqual(set(region), selected)
+        self.assertEqual(['top==1'], top_nodes)
+        self.assertEqual(set(['other==1']), affected)
+
+        # That check needs everything below the top packages
+        region, top_nodes, affected, selected = main._check_region(
+            graph, ['top==1'], None, query_options, True, recorder)
+        self.assertEqual(set(graph), set(region))
+        self.assertEqual(set(['top==1', 'mid==1', 'other==1']), selected)
+        self.assertIsNone(affected)
+
+        self.assertEqual(['query', 'query'],
+                         [record['stage'] for record
+                          in recorder.report()['stages']])
+
+    def test_show(self):
+        graph = self.sample_graph()
+        recorder = instrument.Recorder()
+        shown = []
+
+        # Only the part shown decides whether there are problems
+        self.assertFalse(main._show(
+            graph, True, shown.append, recorder,
+            query_options=dict(ancestors_of=['mid'])))
+        self.assertEqual(set(['top==1', 'mid==1']), set(shown[-1]))
+
+        self.assertTrue(main._show(graph, False, shown.append, recorder,
+                                   only_failed=True))
+        self.assertEqual(set(['mid==1', 'leaf==1']), set(shown[-1]))
+
+        # Unless it wasn't checked here
+        self.assertFalse(main._show(graph, False, shown.append, recorder,
+                                    only_failed=True, checked=False))
+
+        self.assertTrue(main._show(graph, True, shown.append, recorder))
+        self.assertIs(graph, shown[-1])
+
+    def test_collect(self):
+        recorder = instrument.Recorder()
+        graph, top_nodes, affected = main._collect(['pkg-deps'], recorder)
+        self.assertIsNone(affected)
+        self.assertIn(top_nodes[0], graph)
+
+        saved = os.path.join(self.tmpdir, 'saved.json')
+        with open(saved, 'w') as out:
+            writers.json(graph, out=out)
+
+        # Nothing has changed since
+        graph, top_nodes, affected = main._collect(
+            ['pkg-deps'], recorder, python=sys.executable, since=saved)
+        self.assertEqual(set(), affected)
+        self.assertEqual(['probe', 'load', 'probe'],
+                         [record['stage'] for record
+                          in recorder.report()['stages']])
+
+    def test_collect_many(self):
+        recorder = instrument.Recorder()
+        results = main._collect_many(
+            [sys.executable, sys.executable], ['pkg-deps'],
+            dict(recorder=recorder), recorder)
+        self.assertEqual(2, len(results))
+        for graph, top_nodes, problems in results:
+            self.assertFalse(problems)
+            self.assertEqual(['cyclic dependency', 'unmet'],
+                             ann.graph_checks(graph))
+
+        probe_record = recorder.report()['stages'][0]
+        self.assertEqual('probe', probe_record['stage'])
+        self.assertEqual(2 * len(results[0][0]), probe_record['nodes'])
+
+    def test_watch(self):
+        env = {
+            'top': ('top==1', ['mid']),
+            'mid': ('mid==1', []),
+        }
+        stamps = {'top': '1', 'mid': '1'}
+        closed = []
+
+        class Prober(object):
+            find_dependencies = staticmethod(
+                fake_find_dependencies(env, []))
+
+            def stamps(self):
+                return dict(stamps)
+
+            def close(self):
+                closed.append(True)
+
+        prober = Prober()
+        graph, top = collector.dependencies_to_graph(
+            *prober.find_dependencies(['top']), stamps=stamps)
+        main.run_checks(graph, top)
+
+        def sleep(seconds):
+            if not stamps['mid'] == '2':
+                # Upgrade mid, to a version with an unmet requirement
+                env['mid'] = ('mid==2', ['new>1'])
+                env['new'] = ('new==1', [])
+                stamps.update(mid='2', new='1')
+            elif len(shown) == 1:
+                raise KeyboardInterrupt()
+
+        shown = []
+
+        def show(graph, any_problems):
+            shown.append(set(graph))
+            return any_problems
+
+        self.assertTrue(main._watch(prober, graph, ['top'], False, show, {},
+                                    sleep=sleep))
+        self.assertEqual([set(['top==1', 'mid==2', 'new==1'])], shown)
+        self.assertEqual([True], closed)
+
+    def test_recorder(self):
+        self.assertEqual(os.path.join(self.tmpdir, 'report.json.prof'),
+                         main._recorder(os.path.join(self.tmpdir,
+                                                     'report.json'),
+                                        'write').profile_output)
+        self.assertIsNone(main._recorder('-', 'write').profile_output)
+        self.assertIsInstance(main._recorder(None, None), main._NoRecorder)
+
+    def test_lazy_imports(self):
+        # What a plain run doesn't use, it doesn't import
+        script = (
+            'import json, sys\n'
+            'from pkg_deps.main import main\n'
+            'try:\n'
+            '    main(["--json", "pkg-deps"])\n'
+            'except SystemExit:\n'
+            '    pass\n'
+            'sys.stderr.write(json.dumps(sorted(\n'
+            '    name for name in sys.modules\n'
+            '    if name.startswith("pkg_deps."))))\n')
+        process = subprocess.Popen([sys.executable, '-c', script],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        imported = json.loads(err.decode('utf-8').splitlines()[-1])
+        self.assertIn('pkg_deps.collector', imported)
+        for name in ['pkg_deps.instrument', 'pkg_deps.query',
+                     'pkg_deps.watch', 'pkg_deps.diff']:
+            self.assertNotIn(name, imported)
+
+    def test_profile(self):
+        report_file = os.path.join(self.tmpdir, 'report.json')
+        status, out, err = run_pkg_deps(
+            ['--json', '--no-cache', '--profile', report_file,
+             '--profile-stage', 'check_dag', 'pkg-deps'])
+        self.assertEqual(0, status)
+        top, = dict(json.loads(out)['graph'])['query packages']
+        self.assertTrue(top.startswith('pkg-deps=='))
+
+        with open(report_file) as report:
+            stages = json.load(report)['stages']
+        self.assertEqual(['probe', 'check_dag', 'dependencies_should_be_met',
+                          'write'], [record['stage'] for record in stages])
+        self.assertGreater(stages[0]['nodes'], 0)
+
+        functions = [function for filename, line, function
+                     in pstats.Stats(report_file + '.prof').stats]
+        self.assertIn('_check_compact_dag', functions)
+        self.assertNotIn('find_dependencies', functions)
+
+    def test_profile_to_stderr(self):
+        status, out, err = run_pkg_deps(
+            ['--json', '--no-cache', '--profile', '-', '--profile-stage',
+             'write', 'pkg-deps'])
+        self.assertEqual(0, status)
+        # The profile summary when the stage ends, then the report
+        summary, report = err.rsplit('\n{\n', 1)
+        self.assertIn('"stage": "write"', report)
+        self.assertIn('function calls', summary)
+
+    def test_profile_teamcity(self):
+        need_teamcity(self)
+        status, out, err = run_pkg_deps(
+            ['--teamcity', '--no-cache', '--profile',
+             os.path.join(self.tmpdir, 'report.json'), 'pkg-deps'])
+        self.assertEqual(0, status)
+        keys = [attrs['key'] for name, attrs in teamcity_messages(out)
+                if name == 'buildStatisticValue']
+        self.assertIn('pkg_deps.probe.wall', keys)
+        self.assertIn('pkg_deps.total.wall', keys)
+
+    def test_split_environments_needs_python(self):
+        status, out, err = run_pkg_deps(['--split-environments', 'pkg'])
+        self.assertEqual(2, status)
+        self.assertEqual('', out)
+        self.assertIn('--split-environments needs at least one --python',
+                      err)
+
+    def test_cache_requirements(self):
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        saved = os.path.join(cache_dir, 'requirements.json')
+        args = ['--json', '--cache-dir', cache_dir, 'pkg-deps']
+
+        status, out, err = run_pkg_deps(args)
+        self.assertEqual(0, status, err)
+        self.assertFalse(os.path.exists(saved))
+
+        status, out, err = run_pkg_deps(['--cache-requirements'] + args)
+        self.assertEqual(0, status, err)
+        self.assertTrue(os.path.exists(saved))
+
+        status, out, err = run_pkg_deps(
+            ['--cache-requirements', '--no-cache', 'pkg-deps'])
+        self.assertEqual(2, status)
+
+    def test_split_environments_json(self):
+        # Several JSON documents on stdout can't be read back
+        status, out, err = run_pkg_deps(
+            ['--split-environments', '--json', '-p', sys.executable,
+             'pkg-deps'])
+        self.assertEqual(2, status)
+        self.assertIn('--split-environments with --json needs --output-dir',
+                      err)
+
+        status, out, err = run_pkg_deps(
+            ['--output-dir', self.tmpdir, 'pkg-deps'])
+        self.assertEqual(2, status)
+
+        # So each environment gets its own file, which --load-json reads
+        output_dir = os.path.join(self.tmpdir, 'out')
+        status, out, err = run_pkg_deps(
+            ['--split-environments', '--json', '--output-dir', output_dir,
+             '--no-cache', '-p', sys.executable, '-p', sys.executable,
+             'pkg-deps'])
+        self.assertEqual(0, status, err)
+        self.assertEqual('', out)
+        self.assertEqual(['1.json', '2.json'], sorted(os.listdir(output_dir)))
+
+        paths = [os.path.join(output_dir, name) for name in ['1.json',
+                                                             '2.json']]
+        for path in paths:
+            graph = collector.combine_json_graphs([path])
+            self.assertEqual([sys.executable], graph.graph['environments'])
+            self.assertTrue(any(node.startswith('pkg-deps==')
+                                for node in graph))
+
+        status, out, err = run_pkg_deps(['--json', '--load-json'] + paths)
+        self.assertEqual(0, status, err)
+        self.assertEqual(set(graph), set(node['id']
+                                         for node in json.loads(out)['nodes']))
+
 
 class IntegrationTestCase(unittest.TestCase):
     @classmethod